@@ -1,4 +1,8 @@
 from multiprocessing import Process
+import zipfile
+import shutil
+import signal
+import time
 import os
 
 from spatial_access.p2p import TransitMatrix
@@ -8,45 +12,287 @@ from spatial_access.Models import DestSum
 from spatial_access.Models import AccessTime
 from spatial_access.Models import AccessCount
 from spatial_access.Models import AccessModel
+from spatial_access.BaseModel import ModelData
+from spatial_access.NetworkInterface import NetworkInterface
 
+from ResourceManagerExceptions import ResourceManagerBaseException
 from ResourceManagerExceptions import UnrecognizedJobTypeException
 from ResourceManagerExceptions import MissingHintsException
 from ResourceManagerExceptions import MissingColumnNamesException
 from ResourceManagerExceptions import MissingResourceException
+from ResourceManagerExceptions import TileMismatchException
 
 from Manifest import Manifest
 from Job import Job
+from JobProgress import JobProgress
+from JobProfiler import JobProfiler
+from MatrixStore import MatrixStore
+from ResultsStore import ResultsStore
+from ResourceStore import ResourceStore
+import Metrics
 
 
 class Consumer(Process):
+    # files kept in the job folder but left out of the results archive:
+    # the progress timeline, the memory-mapped matrix behind /matrix and
+    # the archive of the job's profile
+    unarchived_files = (JobProgress.filename, MatrixStore.matrix_filename, MatrixStore.index_filename,
+                        JobProfiler.archive_filename)
+    # folders of the job left out of the results archive
+    unarchived_folders = (JobProgress.tiles_folder, JobProfiler.folder)
+    # models that map destination categories into their TransitMatrix
+    # when built, so no two of them may share one
+    category_model_types = {'AccessTime', 'AccessCount'}
+    # init_kwargs that do not change the travel times in a matrix: the
+    # models' own settings, the files read and logging
+    matrix_neutral_kwargs = {'decay_function', 'debug', 'sources_filename', 'destinations_filename',
+                             'transit_matrix_filename', 'primary_input', 'secondary_input', 'read_from_file'}
+    # matrix of a pipeline written out for models that cannot share it
+    pipeline_matrix_filename = 'pipeline_matrix.tmx'
+    # matrix of a model job merged from its tiles, read back by the model
+    tiled_matrix_filename = 'tiled_matrix.csv'
 
-    def __init__(self, job_queue, manifest):
+    def __init__(self, job_queue, manifest, archive_compression=zipfile.ZIP_DEFLATED,
+                 archive_compresslevel=None, matrix_cache=None, network_cache=None,
+                 result_queue=None, slot=None, event_queue=None, results_format=None):
         Process.__init__(self)
         self.job_queue = job_queue
+        self.event_queue = event_queue
+        self.result_queue = result_queue
+        self.slot = slot
         self.manifest = manifest
+        self.matrix_cache = matrix_cache
+        self.network_cache = network_cache
+        self.archive_compression = archive_compression
+        self.archive_compresslevel = archive_compresslevel
+        # 'parquet' or 'arrow' to write a columnar copy of model results
+        self.results_format = results_format
+        # progress of the job being executed
+        self.progress = None
 
     def run(self):
+        # the server's handlers are inherited: shutting down is up to
+        # the ResourceManager, which stops Consumers with SIGTERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        if self.network_cache is not None:
+            self.network_cache.install()
+        self.install_progress_hooks()
+        ResourceStore.install()
         while True:
             next_job = self.job_queue.get()
+            start_time = time.time()
             self.execute_job(next_job)
-            self.job_queue.task_done()
+            # tell the dispatcher this worker is free again
+            self.result_queue.put((self.slot, next_job.job_id, time.time() - start_time))
+
+    def install_progress_hooks(self):
+        """
+        Split matrix computation into loading the street network and
+        computing shortest paths, by wrapping the (possibly cached)
+        NetworkInterface.load_network in this process.
+        """
+        consumer = self
+        load_network = NetworkInterface.load_network
+
+        def load_network_with_progress(interface, *args, **kwargs):
+            if consumer.progress is not None:
+                consumer.progress.start_stage('loading_network')
+            load_network(interface, *args, **kwargs)
+            if consumer.progress is not None:
+                consumer.progress.start_stage('computing_matrix')
+
+        NetworkInterface.load_network = load_network_with_progress
 
     @staticmethod
-    def run_matrix_job(job):
+    def get_matrix_cache_key(job, manifest, matrix_cache, init_kwargs=None):
+        """
+        Returns: the MatrixCache key for the matrix this job needs, or
+            None if the matrix cannot be cached. Every init_kwarg that
+            reaches TransitMatrix goes into the key, all but the
+            location hints as given, so matrix jobs and every model
+            type over the same inputs and settings share entries.
+            init_kwargs defaults to those of the job's orders.
+        """
+        if matrix_cache is None:
+            return None
+        if init_kwargs is None:
+            init_kwargs = job.orders['init_kwargs']
+        matrix_kwargs = {key: value for key, value in init_kwargs.items()
+                         if key not in Consumer.matrix_neutral_kwargs}
+        if job.job_type != 'matrix':
+            # models pass their column names on as the matrix's hints
+            matrix_kwargs['primary_hints'] = matrix_kwargs.pop('source_column_names', None)
+            matrix_kwargs['secondary_hints'] = matrix_kwargs.pop('dest_column_names', None)
+        primary_hash = manifest.get_resource_hash(job.primary_resource_id)
+        secondary_hash = None
+        if job.secondary_resource is not None:
+            secondary_hash = manifest.get_resource_hash(job.secondary_resource_id)
+            if secondary_hash is None:
+                return None
+        if primary_hash is None:
+            return None
+
+        def location_hints(hints):
+            if not isinstance(hints, dict):
+                return hints
+            return {key: hints[key] for key in ['idx', 'lat', 'lon'] if key in hints}
+
+        matrix_kwargs['primary_hints'] = location_hints(matrix_kwargs.get('primary_hints'))
+        matrix_kwargs['secondary_hints'] = location_hints(matrix_kwargs.get('secondary_hints'))
+        matrix_kwargs.setdefault('configs', None)
+        return matrix_cache.get_key(primary_hash, secondary_hash, matrix_kwargs)
+
+    def run_matrix_job(self, job):
         if 'primary_hints' not in job.orders['init_kwargs']:
             raise MissingHintsException('primary_hints')
         if job.secondary_resource is not None and 'secondary_hints' not in job.orders['init_kwargs']:
             raise MissingHintsException('secondary_hints')
+        output_filename = job.job_folder + 'output.csv'
+        cache_key = self.get_matrix_cache_key(job, self.manifest, self.matrix_cache)
+        if job.num_tiles is not None:
+            self.merge_tiles(job, output_filename)
+            if cache_key is not None:
+                self.progress.start_stage('caching_matrix')
+                matrix = TransitMatrix(job.orders['init_kwargs']['network_type'], read_from_file=output_filename)
+                self.matrix_cache.store(cache_key, matrix.write_tmx)
+            self.build_matrix_store(job, output_filename)
+            return
+        if cache_key is not None:
+            cached_filename = self.matrix_cache.lookup(cache_key)
+            if cached_filename is not None:
+                self.progress.start_stage('reading_cached_matrix')
+                try:
+                    matrix = TransitMatrix(job.orders['init_kwargs']['network_type'],
+                                           read_from_file=cached_filename)
+                    matrix.write_csv(output_filename)
+                    self.build_matrix_store(job, output_filename)
+                    return
+                except Exception as exception:
+                    # evicted or unreadable entry, fall through and recompute
+                    print('matrix cache read failed:', str(exception))
         job.orders['init_kwargs']['primary_input'] = job.primary_resource
         job.orders['init_kwargs']['secondary_input'] = job.secondary_resource
+        self.progress.start_stage('reading_inputs')
         matrix = TransitMatrix(**job.orders['init_kwargs'])
         matrix.process()
-        output_filename = job.job_folder + 'output.csv'
+        self.progress.start_stage('writing_output')
         matrix.write_csv(output_filename)
+        if cache_key is not None:
+            self.progress.start_stage('caching_matrix')
+            self.matrix_cache.store(cache_key, matrix.write_tmx)
+        self.build_matrix_store(job, output_filename)
+
+    def run_tile(self, tile):
+        """
+        Compute the rows of the matrix a tile covers, from its sources
+        to every destination (every source, for a matrix job with one
+        resource), into <tile folder>/output.csv.
+        """
+        init_kwargs = tile.orders['init_kwargs']
+        if tile.job_type == 'matrix':
+            if 'primary_hints' not in init_kwargs:
+                raise MissingHintsException('primary_hints')
+            if tile.secondary_resource is not None and 'secondary_hints' not in init_kwargs:
+                raise MissingHintsException('secondary_hints')
+            matrix_kwargs = dict(init_kwargs)
+            matrix_kwargs.setdefault('secondary_hints', init_kwargs['primary_hints'])
+        else:
+            # as models build their matrix
+            if 'source_column_names' not in init_kwargs:
+                raise MissingColumnNamesException('source_column_names')
+            if 'dest_column_names' not in init_kwargs:
+                raise MissingColumnNamesException('dest_column_names')
+            matrix_kwargs = {'network_type': init_kwargs.get('network_type'),
+                             'primary_hints': init_kwargs['source_column_names'],
+                             'secondary_hints': init_kwargs['dest_column_names'],
+                             'configs': init_kwargs.get('configs')}
+        input_filename = tile.job_folder + 'input.csv'
+        self.progress.start_stage('reading_inputs')
+        start, end = tile.tile_range
+        ResourceStore.write_rows(tile.primary_resource_id, start, end, input_filename)
+        matrix_kwargs['primary_input'] = input_filename
+        matrix_kwargs['secondary_input'] = tile.secondary_resource or tile.primary_resource
+        try:
+            matrix = TransitMatrix(**matrix_kwargs)
+            matrix.process()
+            self.progress.start_stage('writing_output')
+            matrix.write_csv(tile.job_folder + 'output.csv')
+        finally:
+            os.remove(input_filename)
+
+    def merge_tiles(self, job, filename, stage_prefix=''):
+        """
+        Concatenate the rows the job's tiles computed, in order, into
+        filename. Each tile's output is removed once it is copied.
+        Raises:
+            TileMismatchException: the tiles' destinations differ.
+        """
+        self.progress.start_stage(stage_prefix + 'merging_tiles')
+        header = None
+        with open(filename, 'wb') as output:
+            for tile_index in range(job.num_tiles):
+                tile_filename = job.get_tile_folder(tile_index) + 'output.csv'
+                with open(tile_filename, 'rb') as tile:
+                    tile_header = tile.readline()
+                    if header is None:
+                        header = tile_header
+                        output.write(header)
+                    elif tile_header != header:
+                        raise TileMismatchException('destinations of tile {} differ'.format(tile_index))
+                    shutil.copyfileobj(tile, output)
+                    if tile.tell() > len(tile_header):
+                        tile.seek(-1, os.SEEK_END)
+                        if tile.read(1) != b'\n':
+                            output.write(b'\n')
+                os.remove(tile_filename)
+                self.progress.set_percent(100.0 * (tile_index + 1) / job.num_tiles)
+
+    def build_matrix_store(self, job, output_filename):
+        self.progress.start_stage('indexing_matrix')
+        MatrixStore.build(output_filename, job.job_folder)
+
+    @staticmethod
+    def get_model(model_type, init_kwargs):
+        if model_type == 'TSFCA':
+            return TSFCA(**init_kwargs)
+        elif model_type == 'Coverage':
+            return Coverage(**init_kwargs)
+        elif model_type == 'DestSum':
+            return DestSum(**init_kwargs)
+        elif model_type == 'AccessTime':
+            return AccessTime(**init_kwargs)
+        elif model_type == 'AccessCount':
+            return AccessCount(**init_kwargs)
+        elif model_type == 'AccessModel':
+            return AccessModel(**init_kwargs)
+        raise UnrecognizedJobTypeException(model_type)
 
     @staticmethod
-    def run_model_job(job):
+    def get_model_on_matrix(model_type, init_kwargs, transit_matrix):
+        """
+        Build a model on a TransitMatrix already in memory, instead of
+        computing the matrix or reading it from a file.
+        """
+        load_transit_matrix = ModelData.load_transit_matrix
 
+        def use_transit_matrix(model, read_from_file=None):
+            model.transit_matrix = transit_matrix
+            if model._source_file_hints is None:
+                model._source_file_hints = transit_matrix.primary_hints
+            if model._dest_file_hints is None:
+                model._dest_file_hints = transit_matrix.secondary_hints
+            model.reload_sources()
+            model.reload_dests()
+
+        ModelData.load_transit_matrix = use_transit_matrix
+        try:
+            return Consumer.get_model(model_type, init_kwargs)
+        finally:
+            ModelData.load_transit_matrix = load_transit_matrix
+
+    @staticmethod
+    def get_model_init_kwargs(job):
         job.orders['init_kwargs']['sources_filename'] = job.primary_resource
         job.orders['init_kwargs']['destinations_filename'] = job.secondary_resource
         print('model job init_kwargs:', job.orders['init_kwargs'])
@@ -54,48 +300,260 @@ class Consumer(Process):
             raise MissingColumnNamesException('source_column_names')
         if 'dest_column_names' not in job.orders['init_kwargs']:
             raise MissingColumnNamesException('dest_column_names')
-        if job.model_type == 'TSFCA':
-            model = TSFCA(**job.orders['init_kwargs'])
-        elif job.model_type == 'Coverage':
-            model = Coverage(**job.orders['init_kwargs'])
-        elif job.model_type == 'DestSum':
-            model = DestSum(**job.orders['init_kwargs'])
-        elif job.model_type == 'AccessTime':
-            model = AccessTime(**job.orders['init_kwargs'])
-        elif job.model_type == 'AccessCount':
-            model = AccessCount(**job.orders['init_kwargs'])
-        elif job.model_type == 'AccessModel':
-            model = AccessModel(**job.orders['init_kwargs'])
-        else:
-            raise UnrecognizedJobTypeException(job.orders['model_type'])
-        print('calculate_kwargs:', job.orders['calculate_kwargs'])
-        model.calculate(**job.orders['calculate_kwargs'])
+        return job.orders['init_kwargs']
+
+    def load_model(self, job, model_type, init_kwargs, stage_prefix=''):
+        """
+        Build a model, reading its matrix from the matrix cache when
+        it is there, else computing it and storing it in the cache.
+        """
+        cache_key = None
+        model = None
+        if model_type in Job.matrix_model_types and 'transit_matrix_filename' not in init_kwargs:
+            cache_key = self.get_matrix_cache_key(job, self.manifest, self.matrix_cache, init_kwargs)
+            if job.num_tiles is not None:
+                model = self.load_tiled_model(job, model_type, init_kwargs, stage_prefix)
+        if model is None and cache_key is not None:
+            cached_filename = self.matrix_cache.lookup(cache_key)
+            if cached_filename is not None:
+                self.progress.start_stage(stage_prefix + 'reading_cached_matrix')
+                init_kwargs['transit_matrix_filename'] = cached_filename
+                try:
+                    model = self.get_model(model_type, init_kwargs)
+                    cache_key = None
+                except Exception as exception:
+                    # evicted or unreadable entry, fall through and recompute
+                    print('matrix cache read failed:', str(exception))
+                    del init_kwargs['transit_matrix_filename']
+        if model is None:
+            self.progress.start_stage(stage_prefix + 'reading_inputs')
+            model = self.get_model(model_type, init_kwargs)
+        if cache_key is not None:
+            self.progress.start_stage(stage_prefix + 'caching_matrix')
+            self.matrix_cache.store(cache_key, model.write_transit_matrix_to_tmx)
+        return model
+
+    def load_tiled_model(self, job, model_type, init_kwargs, stage_prefix=''):
+        """
+        Build a model on the matrix the job's tiles computed.
+        """
+        matrix_filename = job.job_folder + self.tiled_matrix_filename
+        init_kwargs['transit_matrix_filename'] = matrix_filename
+        try:
+            self.merge_tiles(job, matrix_filename, stage_prefix)
+            self.progress.start_stage(stage_prefix + 'reading_merged_matrix')
+            return self.get_model(model_type, init_kwargs)
+        finally:
+            del init_kwargs['transit_matrix_filename']
+            if os.path.exists(matrix_filename):
+                os.remove(matrix_filename)
+
+    def write_model_results(self, model, calculate_kwargs, aggregate_kwargs, folder, stage_prefix=''):
+        print('calculate_kwargs:', calculate_kwargs)
+        self.progress.start_stage(stage_prefix + 'calculating_model')
+        model.calculate(**calculate_kwargs)
         if model.model_results is not None:
-            model.write_results(job.job_folder + '/results.csv')
+            self.progress.start_stage(stage_prefix + 'writing_results')
+            model.write_results(folder + '/results.csv')
+            if self.results_format is not None:
+                self.progress.start_stage(stage_prefix + 'writing_columnar_results')
+                ResultsStore.write_columnar(model.model_results, folder, self.results_format)
         print('wrote results')
-        if 'aggregate_kwargs' in job.orders:
-            print('aggregate_kwargs:', job.orders['aggregate_kwargs'])
-            model.aggregate(**job.orders['aggregate_kwargs'])
-            model.write_aggregated_results(job.job_folder + '/aggregate.json')
+        if aggregate_kwargs is not None:
+            print('aggregate_kwargs:', aggregate_kwargs)
+            self.progress.start_stage(stage_prefix + 'aggregating')
+            model.aggregate(**aggregate_kwargs)
+            model.write_aggregated_results(folder + '/aggregate.json')
+
+    def run_model_job(self, job):
+        init_kwargs = self.get_model_init_kwargs(job)
+        model = self.load_model(job, job.model_type, init_kwargs)
+        self.write_model_results(model, job.orders['calculate_kwargs'], job.orders.get('aggregate_kwargs'),
+                                 job.job_folder)
+
+    def run_pipeline_job(self, job):
+        """
+        Run each of the job's models in turn over one travel-time
+        matrix. The first model that needs a matrix computes it, or
+        reads it from the matrix cache, and later ones are built on the
+        same TransitMatrix in memory. Each model writes its results to
+        <job_folder>/<name>/ and has its own progress stages.
+        """
+        shared_kwargs = self.get_model_init_kwargs(job)
+        transit_matrix = None
+        categories_mapped = False
+        matrix_filename = job.job_folder + self.pipeline_matrix_filename
+        try:
+            for model_orders in job.orders['models']:
+                model_type = model_orders['model_type']
+                stage_prefix = model_orders['name'] + ':'
+                init_kwargs = dict(shared_kwargs, **model_orders.get('init_kwargs', {}))
+                if model_type not in Job.matrix_model_types or transit_matrix is None:
+                    model = self.load_model(job, model_type, init_kwargs, stage_prefix)
+                elif model_type in self.category_model_types and categories_mapped:
+                    # the shared matrix holds another model's categories,
+                    # which are not written to the tmx
+                    if not os.path.exists(matrix_filename):
+                        self.progress.start_stage('writing_shared_matrix')
+                        transit_matrix.write_tmx(matrix_filename)
+                    self.progress.start_stage(stage_prefix + 'reading_shared_matrix')
+                    init_kwargs['transit_matrix_filename'] = matrix_filename
+                    model = self.get_model(model_type, init_kwargs)
+                else:
+                    self.progress.start_stage(stage_prefix + 'reading_inputs')
+                    model = self.get_model_on_matrix(model_type, init_kwargs, transit_matrix)
+                if model_type in Job.matrix_model_types:
+                    if transit_matrix is None:
+                        transit_matrix = model.transit_matrix
+                    if model.transit_matrix is transit_matrix and model_type in self.category_model_types:
+                        categories_mapped = True
+                folder = job.job_folder + model_orders['name'] + '/'
+                os.mkdir(folder)
+                self.write_model_results(model, model_orders.get('calculate_kwargs', {}),
+                                         model_orders.get('aggregate_kwargs'), folder, stage_prefix)
+                # results are on disk, so only the matrix stays in memory
+                del model
+        finally:
+            if os.path.exists(matrix_filename):
+                os.remove(matrix_filename)
+
+    @staticmethod
+    def build_archive(job_folder, job_id, compression=zipfile.ZIP_DEFLATED, compresslevel=None):
+        """
+        Zip the job's results, with those of each model of a pipeline,
+        into <job_folder>/<job_id>.zip. The archive is written under a
+        temporary name and renamed into place, so readers
+        never see a partial file.
+        """
+        zip_filename = job_folder + job_id + '.zip'
+        tmp_filename = zip_filename + '.tmp'
+        with zipfile.ZipFile(tmp_filename, 'w', compression=compression,
+                             compresslevel=compresslevel) as archive:
+            for file in sorted(os.listdir(job_folder)):
+                if file + '/' in Consumer.unarchived_folders:
+                    continue
+                if os.path.isdir(job_folder + file):
+                    # results of one model of a pipeline
+                    for model_file in sorted(os.listdir(job_folder + file)):
+                        archive.write(job_folder + file + '/' + model_file)
+                elif not file.startswith(job_id + '.zip') and not file.startswith(Consumer.unarchived_files):
+                    archive.write(job_folder + file)
+        os.replace(tmp_filename, zip_filename)
+        return zip_filename
+
+    def publish(self, job_id, status):
+        if self.event_queue is not None:
+            self.event_queue.put((job_id, status))
+
+    def set_job_status(self, job, status, from_statuses):
+        # status changes are conditional so a job cancelled or timed
+        # out by the ResourceManager is never overwritten; handles
+        # coalesced onto the job follow it, and tiles report on the
+        # job they belong to
+        updated = self.manifest.update_job_status(job.parent_id or job.job_id, status, from_statuses=from_statuses)
+        for job_id in updated:
+            self.publish(job_id, status)
+        return bool(updated)
+
+    def set_job_exception(self, job, exception_message):
+        for job_id in self.manifest.add_job_exception(job.parent_id or job.job_id, exception_message,
+                                                      from_statuses=('running',)):
+            self.publish(job_id, 'exception')
 
     def execute_job(self, job):
         print('executing job:', job.job_id)
-        os.mkdir(job.job_folder)
+        if job.tile_index is not None:
+            self.execute_tile(job)
+            return
+        if job.num_tiles is None:
+            if not self.set_job_status(job, 'running', ('enqueued',)):
+                return
+            # a folder left by an earlier run of the job that was cut short
+            shutil.rmtree(job.job_folder, ignore_errors=True)
+            os.makedirs(job.job_folder, exist_ok=True)
+        elif self.manifest.get_job_status(job.job_id) != 'running':
+            # its tiles are computed, but the job was cancelled or failed
+            return
+        self.progress = JobProgress(job.job_folder)
+        profiler = self.start_profiler(job)
+        start_time = time.time()
+        try:
+            exception_message = self.run_job(job)
+        finally:
+            if profiler is not None:
+                profiler.stop()
+            self.progress.finish()
+            self.progress = None
+        Metrics.JOB_DURATION.labels(job.job_type, job.model_type or '',
+                                    'finished' if exception_message is None else 'exception'
+                                    ).observe(time.time() - start_time)
+        if exception_message is not None:
+            self.set_job_exception(job, exception_message)
+            return
+        self.set_job_status(job, 'finished', ('running',))
+
+    def start_profiler(self, job):
+        """
+        Returns: a started JobProfiler if the job is profiled, else None.
+        """
+        if not job.profile:
+            return None
+        profiler = JobProfiler(job.job_folder, self.progress)
+        profiler.start()
+        return profiler
+
+    def execute_tile(self, tile):
+        """
+        Compute one tile of a job split by source rows. The job is
+        running from its first tile on, and a tile of a job that was
+        cancelled or failed since it was queued is skipped.
+        """
+        if not self.set_job_status(tile, 'running', ('enqueued',)) and \
+                self.manifest.get_job_status(tile.parent_id) != 'running':
+            return
+        os.makedirs(tile.job_folder, exist_ok=True)
+        self.progress = JobProgress(tile.job_folder, tile.tile_index, tile.num_tiles)
+        profiler = self.start_profiler(tile)
+        exception_message = None
+        try:
+            self.run_tile(tile)
+        except (Exception, ResourceManagerBaseException) as exception:
+            exception_message = 'tile {}: {}'.format(tile.tile_index, str(exception))
+        finally:
+            if profiler is not None:
+                profiler.stop()
+            self.progress.finish()
+            self.progress = None
+        if exception_message is not None:
+            self.set_job_exception(tile, exception_message)
 
+    def run_job(self, job):
+        """
+        Returns: None if the job succeeded, else the exception message.
+        """
         if job.job_type == 'matrix':
             try:
                 self.run_matrix_job(job)
-            except Exception as exception:
+            except (Exception, ResourceManagerBaseException) as exception:
                 print('exception:',str(exception))
-                self.manifest.add_job_exception(job.job_id, str(exception))
-                return
+                return str(exception)
         elif job.job_type == 'model':
             try:
                 self.run_model_job(job)
-            except Exception as exception:
-                self.manifest.add_job_exception(job.job_id, str(exception))
-                return
+            except (Exception, ResourceManagerBaseException) as exception:
+                return str(exception)
+        elif job.job_type == 'pipeline':
+            try:
+                self.run_pipeline_job(job)
+            except (Exception, ResourceManagerBaseException) as exception:
+                return str(exception)
         else:
-            self.manifest.add_job_exception(job.job_id, 'unknown_job_type')
-            return
-        self.manifest.update_job_status(job.job_id, 'finished')
+            return 'unknown_job_type'
+        self.progress.start_stage('building_archive')
+        try:
+            with Metrics.ARCHIVE_BUILD_DURATION.time():
+                self.build_archive(job.job_folder, job.job_id, self.archive_compression,
+                                   self.archive_compresslevel)
+        except Exception as exception:
+            return str(exception)
+        return None
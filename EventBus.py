@@ -0,0 +1,103 @@
+from collections import OrderedDict
+from multiprocessing import Queue
+import threading
+import queue
+
+
+TERMINAL_STATUSES = {'finished', 'exception', 'cancelled', 'timed_out', 'failed'}
+
+
+class Subscription:
+    def __init__(self, job_ids):
+        self.job_ids = set(job_ids)
+        self.events = queue.Queue()
+
+
+class EventBus:
+    """
+    In-memory feed of job status transitions for long-polling and
+    Server-Sent Events clients, so waiting on a job never re-reads the
+    manifest. Consumers publish from their own processes through
+    self.queue; a listener thread in the API process relays those
+    events to waiters and subscribers. The latest status of the most
+    recent max_jobs jobs is kept.
+
+    Consumers on other hosts publish to their own process, so an API
+    process without workers polls the manifest for the jobs clients
+    are waiting on (get_watched_job_ids) and publishes what changed.
+    """
+    def __init__(self, max_jobs=100000):
+        self.max_jobs = max_jobs
+        self.queue = Queue()
+        self.condition = threading.Condition()
+        self.statuses = OrderedDict()
+        self.subscriptions = set()
+        # job_id -> number of clients blocked in wait_for_change
+        self.waiting = {}
+        self.listener = None
+
+    def start(self):
+        self.listener = threading.Thread(target=self._listen, daemon=True)
+        self.listener.start()
+
+    def stop(self):
+        self.queue.put(None)
+
+    def _listen(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                return
+            self.publish(*event)
+
+    def publish(self, job_id, status):
+        with self.condition:
+            self.statuses[job_id] = status
+            self.statuses.move_to_end(job_id)
+            while len(self.statuses) > self.max_jobs:
+                self.statuses.popitem(last=False)
+            for subscription in self.subscriptions:
+                if job_id in subscription.job_ids:
+                    subscription.events.put((job_id, status))
+            self.condition.notify_all()
+
+    def get_status(self, job_id):
+        with self.condition:
+            return self.statuses.get(job_id)
+
+    def wait_for_change(self, job_id, status, timeout):
+        """
+        Block until the job's status differs from status, or until
+        timeout seconds have passed.
+        Returns: the latest known status of the job.
+        """
+        with self.condition:
+            self.waiting[job_id] = self.waiting.get(job_id, 0) + 1
+            try:
+                self.condition.wait_for(lambda: self.statuses.get(job_id, status) != status, timeout)
+                return self.statuses.get(job_id, status)
+            finally:
+                self.waiting[job_id] -= 1
+                if not self.waiting[job_id]:
+                    del self.waiting[job_id]
+
+    def get_watched_job_ids(self):
+        """
+        Returns: job_ids clients are waiting on or subscribed to that
+            have not reached a terminal status.
+        """
+        with self.condition:
+            job_ids = set(self.waiting)
+            for subscription in self.subscriptions:
+                job_ids.update(subscription.job_ids)
+            return [job_id for job_id in job_ids if self.statuses.get(job_id) not in TERMINAL_STATUSES]
+
+    def subscribe(self, job_ids):
+        subscription = Subscription(job_ids)
+        with self.condition:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.condition:
+            self.subscriptions.discard(subscription)
@@ -1,10 +1,31 @@
+import hashlib
 import uuid
+import copy
+import math
 import os
 import json
 
+from ResourceStore import ResourceStore
+
 
 class Job:
-    def __init__(self, request):
+    # travel times are stored as unsigned shorts in the dense matrix
+    matrix_cell_bytes = 2
+    # peak memory relative to the matrix itself (ids, dataframes, output)
+    peak_memory_factor = 3
+    # street network graph and interpreter, independent of the inputs
+    base_memory_bytes = 268435456
+    # models that are built on a transit matrix (DestSum is not)
+    matrix_model_types = {'TSFCA', 'Coverage', 'AccessTime', 'AccessCount', 'AccessModel'}
+    model_types = matrix_model_types | {'DestSum'}
+    # init_kwargs that define a pipeline's shared matrix, so its models
+    # may not set their own
+    matrix_init_kwargs = {'network_type', 'source_column_names', 'dest_column_names', 'configs',
+                          'sources_filename', 'destinations_filename', 'transit_matrix_filename'}
+    # folders of the job folder a pipeline model may not be named after
+    reserved_model_names = {'tiles', 'profile'}
+
+    def __init__(self, request, client_id=None):
         self.error_status = None
 
         # try parse request
@@ -19,7 +40,7 @@ class Job:
             self.error_status = "missing job_type"
             return
         self.job_type = job_request['job_type']
-        if job_request['job_type'] not in ['matrix', 'model']:
+        if job_request['job_type'] not in ['matrix', 'model', 'pipeline']:
             self.error_status = "invalid job type: {}".format(job_request['job_type'])
             return
         # expect orders
@@ -31,23 +52,40 @@ class Job:
         except:
             self.error_status = "orders not parsable"
             return
+        if not isinstance(self.orders, dict) or not isinstance(self.orders.get('init_kwargs'), dict):
+            self.error_status = 'orders missing init_kwargs'
+            return
         print('init+kwargs:', self.orders['init_kwargs'])
+        # profile the job's CPU time and memory (see JobProfiler)
+        self.profile = self.orders.get('profile', False)
+        if not isinstance(self.profile, bool):
+            self.error_status = 'profile not parsable'
+            return
         # expect primary_resource to be present
         if 'primary_resource' not in job_request.keys():
             self.error_status = "primary_resource not specified"
             return
-        self.primary_resource = 'resources/' + job_request['primary_resource']
+        self.primary_resource_id = job_request['primary_resource']
+        if not self.resource_id_is_safe(self.primary_resource_id):
+            self.error_status = "primary_resource not parsable"
+            return
+        self.primary_resource = 'resources/' + self.primary_resource_id
         if not os.path.exists(self.primary_resource):
             self.error_status = "missing primary_resource"
             return
 
         # if secondary_resource specified, check that it is present
         if 'secondary_resource' in job_request.keys():
-            self.secondary_resource = 'resources/' + job_request['secondary_resource']
+            self.secondary_resource_id = job_request['secondary_resource']
+            if not self.resource_id_is_safe(self.secondary_resource_id):
+                self.error_status = "secondary_resource not parsable"
+                return
+            self.secondary_resource = 'resources/' + self.secondary_resource_id
             if not os.path.exists(self.secondary_resource):
                 self.error_status = "missing secondary_resource"
                 return
         else:
+            self.secondary_resource_id = None
             self.secondary_resource = None
 
         # if job_type is model, both primary and secondary_resource are required
@@ -61,6 +99,61 @@ class Job:
             if not self.primary_resource or not self.secondary_resource:
                 self.error_status = 'two resources required for model job'
                 return
+        # a pipeline runs several models, listed in orders, over one matrix
+        if self.job_type == 'pipeline':
+            if not self.primary_resource or not self.secondary_resource:
+                self.error_status = 'two resources required for pipeline job'
+                return
+            self.error_status = self.validate_pipeline()
+            if self.error_status is not None:
+                return
+
+        # check the orders against the resources' schemas now rather
+        # than after the job has waited in the queue
+        self.primary_schema = ResourceStore.load_schema(self.primary_resource_id)
+        self.secondary_schema = None
+        if self.secondary_resource is not None:
+            self.secondary_schema = ResourceStore.load_schema(self.secondary_resource_id)
+        self.error_status = self.validate_orders()
+        if self.error_status is not None:
+            return
+
+        # scheduling: higher priority runs first, clients share workers fairly
+        # /submitJobs passes JSON values as they are, not only strings
+        try:
+            self.priority = int(job_request.get('priority', 0))
+        except (TypeError, ValueError, OverflowError):
+            self.error_status = 'priority not parsable'
+            return
+        self.client_id = job_request.get('client_id', client_id)
+        if not isinstance(self.client_id, str) and self.client_id is not None:
+            self.error_status = 'client_id not parsable'
+            return
+
+        # optional wall-clock limit in seconds, capped by the server's --job_timeout
+        self.timeout = None
+        if 'timeout' in job_request.keys():
+            try:
+                self.timeout = float(job_request['timeout'])
+            except (TypeError, ValueError):
+                self.error_status = 'timeout not parsable'
+                return
+            if not 0 < self.timeout < math.inf:
+                self.error_status = 'timeout must be a positive number of seconds'
+                return
+        self.primary_rows = self.get_rows(self.primary_resource, self.primary_schema)
+        self.secondary_rows = None
+        if self.secondary_resource is not None:
+            self.secondary_rows = self.get_rows(self.secondary_resource, self.secondary_schema)
+        self.matrix_cells = self.estimate_matrix_cells()
+        self.peak_memory_bytes = self.estimate_peak_memory()
+        self.cost = self.estimate_cost()
+        self.enqueued_at = None
+        # set when the job is split into tiles by source rows (see split)
+        self.num_tiles = None
+        self.parent_id = None
+        self.tile_index = None
+        self.tile_range = None
 
         # generate a new uuid
         self.job_id = self.get_new_job_id()
@@ -69,3 +162,174 @@ class Job:
     @staticmethod
     def get_new_job_id():
         return uuid.uuid4().hex
+
+    def get_tile_folder(self, tile_index):
+        return self.job_folder + 'tiles/{}/'.format(tile_index)
+
+    def split(self, tile_rows):
+        """
+        Split the job by source rows into tiles of at most tile_rows
+        rows. Each tile computes its rows of the matrix into its own
+        folder under <job_folder>/tiles/, and the job itself is then
+        run to merge them.
+        Returns: the tiles, copies of the job that share its status.
+        """
+        starts = range(0, self.primary_rows, tile_rows)
+        self.num_tiles = len(starts)
+        tiles = []
+        for tile_index, start in enumerate(starts):
+            end = min(start + tile_rows, self.primary_rows)
+            tile = copy.copy(self)
+            tile.orders = copy.deepcopy(self.orders)
+            tile.job_id = '{}-tile{}'.format(self.job_id, tile_index)
+            tile.job_folder = self.get_tile_folder(tile_index)
+            tile.parent_id = self.job_id
+            tile.tile_index = tile_index
+            tile.tile_range = (start, end)
+            tile.matrix_cells = self.matrix_cells * (end - start) // self.primary_rows
+            tile.peak_memory_bytes = tile.estimate_peak_memory()
+            tile.cost = self.cost * (end - start) / self.primary_rows
+            tiles.append(tile)
+        return tiles
+
+    def get_fingerprint(self, primary_hash, secondary_hash):
+        """
+        Returns: digest of what the job computes: its type, the hashes
+            of its resources and its orders, with keys sorted so their
+            order does not matter. Scheduling fields (priority, timeout,
+            client_id) are left out.
+        """
+        description = {'job_type': self.job_type,
+                       'model_type': self.model_type,
+                       'primary_hash': primary_hash,
+                       'secondary_hash': secondary_hash,
+                       'orders': self.orders}
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def validate_pipeline(self):
+        """
+        Check orders['models'] and name each model: its results go to
+        <job_folder>/<name>/, name defaulting to the model_type, with
+        a suffix if the same model_type is run more than once.
+        Returns: why the models cannot run, or None.
+        """
+        models = self.orders.get('models')
+        if not isinstance(models, list) or not models:
+            return 'orders missing models'
+        names = set()
+        for index, model_orders in enumerate(models):
+            if not isinstance(model_orders, dict):
+                return 'model {} not parsable'.format(index)
+            if model_orders.get('model_type') not in self.model_types:
+                return 'invalid model_type for model {}: {}'.format(index, model_orders.get('model_type'))
+            for key in ['init_kwargs', 'calculate_kwargs', 'aggregate_kwargs']:
+                if key in model_orders and not isinstance(model_orders[key], dict):
+                    return '{} of model {} not parsable'.format(key, index)
+            shared_keys = self.matrix_init_kwargs.intersection(model_orders.get('init_kwargs', {}))
+            if shared_keys:
+                return 'init_kwargs of model {} may not set {}'.format(index, ', '.join(sorted(shared_keys)))
+            name = model_orders.get('name')
+            if name is None:
+                name = model_orders['model_type']
+                suffix = 1
+                while name in names:
+                    suffix += 1
+                    name = '{}_{}'.format(model_orders['model_type'], suffix)
+            if not isinstance(name, str) or not name or '/' in name or '.' in name or \
+                    name in self.reserved_model_names:
+                return 'invalid name for model {}'.format(index)
+            if name in names:
+                return 'duplicate model name: {}'.format(name)
+            names.add(name)
+            model_orders['name'] = name
+        return None
+
+    def validate_orders(self):
+        """
+        Returns: why the orders cannot run over the resources, or None.
+        """
+        init_kwargs = self.orders['init_kwargs']
+        if self.job_type == 'matrix':
+            required = [('primary_hints', self.primary_schema, 'primary_resource')]
+            if self.secondary_resource is not None:
+                required.append(('secondary_hints', self.secondary_schema, 'secondary_resource'))
+        else:
+            required = [('source_column_names', self.primary_schema, 'primary_resource'),
+                        ('dest_column_names', self.secondary_schema, 'secondary_resource')]
+        for key, schema, resource_name in required:
+            if key not in init_kwargs:
+                return 'missing {}'.format(key)
+            error = ResourceStore.validate_columns(schema, init_kwargs[key], resource_name)
+            if error is not None:
+                return error
+        return None
+
+    @staticmethod
+    def resource_id_is_safe(resource_id):
+        """
+        Returns: whether resource_id can name a file in resources/,
+            as resource ids are checked everywhere else.
+        """
+        return isinstance(resource_id, str) and resource_id != '' and \
+            '/' not in resource_id and '.' not in resource_id
+
+    @classmethod
+    def get_rows(cls, filename, schema):
+        """
+        Returns: number of data rows of a resource, from its schema,
+            or counted for resources uploaded before schemas were kept.
+        """
+        if schema is not None and 'rows' in schema:
+            return schema['rows']
+        return cls.count_rows(filename)
+
+    @staticmethod
+    def count_rows(filename):
+        """
+        Returns: number of data rows in a csv, not counting the header.
+        """
+        lines = 0
+        last_block = b''
+        with open(filename, 'rb') as file:
+            block = file.read(1 << 20)
+            while block != b'':
+                lines += block.count(b'\n')
+                last_block = block
+                block = file.read(1 << 20)
+        if last_block and not last_block.endswith(b'\n'):
+            lines += 1
+        return max(lines - 1, 0)
+
+    def estimate_matrix_cells(self):
+        """
+        Returns: number of cells in the transit matrix the job
+            computes, 0 for models that do not build one.
+        """
+        if self.job_type == 'model' and self.model_type not in self.matrix_model_types:
+            return 0
+        if self.job_type == 'pipeline' and not any(model_orders['model_type'] in self.matrix_model_types
+                                                   for model_orders in self.orders['models']):
+            return 0
+        if self.secondary_rows is None:
+            return self.primary_rows * self.primary_rows
+        return self.primary_rows * self.secondary_rows
+
+    def estimate_peak_memory(self):
+        """
+        Returns: estimated peak memory in bytes of the Consumer
+            running this job.
+        """
+        return self.base_memory_bytes + self.matrix_cells * self.matrix_cell_bytes * self.peak_memory_factor
+
+    def estimate_cost(self):
+        """
+        Returns: relative cost of the job, proportional to the size of
+            the matrix it computes (millions of cells).
+        """
+        return max(self.matrix_cells, self.primary_rows + (self.secondary_rows or 0)) / 1e6
+
+    def get_estimate(self):
+        return {'primary_rows': self.primary_rows,
+                'secondary_rows': self.secondary_rows,
+                'matrix_cells': self.matrix_cells,
+                'peak_memory_bytes': self.peak_memory_bytes}
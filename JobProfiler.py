@@ -0,0 +1,152 @@
+import tracemalloc
+import threading
+import cProfile
+import zipfile
+import pstats
+import json
+import time
+import os
+
+from JobProgress import JobProgress
+
+
+class JobProfiler:
+    """
+    Opt-in profile of a job run by a Consumer: CPU time per function
+    (cProfile), the top Python allocation sites (tracemalloc) and a
+    timeline of the process's resident memory, each sample tagged with
+    the job's progress stage. Written to <job_folder>/profile/ when the
+    job ends:
+        cpu.pstats       cProfile stats, for pstats or snakeviz
+        cpu.txt          functions by cumulative time
+        allocations.txt  allocation sites by size still held at the end
+        memory.json      resident memory samples, and peaks per stage
+    Memory allocated by the C++ extension is only seen in the resident
+    memory, not by tracemalloc.
+    """
+    folder = 'profile/'
+    archive_filename = 'profile.zip'
+    # resident memory is sampled this often, in seconds
+    sample_interval = 0.5
+    # frames kept per allocation; one keeps tracing cheap
+    traceback_frames = 1
+    top_functions = 50
+    top_allocations = 25
+
+    def __init__(self, job_folder, progress=None):
+        self.path = job_folder + self.folder
+        self.progress = progress
+        self.profile = cProfile.Profile()
+        self.samples = []
+        self.started_at = None
+        self.stopped = threading.Event()
+        self.sampler = None
+
+    @staticmethod
+    def get_rss():
+        """
+        Returns: resident memory of this process in bytes, or None where
+            /proc is not available.
+        """
+        try:
+            with open('/proc/self/statm') as file:
+                return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def _get_stage(self):
+        if self.progress is None or not self.progress.stages:
+            return None
+        return self.progress.stages[-1]['stage']
+
+    def _sample(self):
+        rss = self.get_rss()
+        if rss is not None:
+            self.samples.append({'time': time.time() - self.started_at, 'rss': rss, 'stage': self._get_stage()})
+
+    def _sample_loop(self):
+        while not self.stopped.wait(self.sample_interval):
+            self._sample()
+
+    def start(self):
+        self.started_at = time.time()
+        tracemalloc.start(self.traceback_frames)
+        self._sample()
+        self.sampler = threading.Thread(target=self._sample_loop, daemon=True)
+        self.sampler.start()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.stopped.set()
+        self.sampler.join()
+        self._sample()
+        snapshot = tracemalloc.take_snapshot()
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self._write(snapshot, traced_peak)
+
+    def _write(self, snapshot, traced_peak):
+        os.makedirs(self.path, exist_ok=True)
+        self.profile.dump_stats(self.path + 'cpu.pstats')
+        with open(self.path + 'cpu.txt', 'w') as file:
+            stats = pstats.Stats(self.profile, stream=file)
+            stats.sort_stats('cumulative').print_stats(self.top_functions)
+
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                           tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+                                           tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>')])
+        with open(self.path + 'allocations.txt', 'w') as file:
+            file.write('peak traced memory: {} bytes\n\n'.format(traced_peak))
+            for statistic in snapshot.statistics('lineno')[:self.top_allocations]:
+                file.write('{}\n'.format(statistic))
+
+        stage_peaks = {}
+        for sample in self.samples:
+            stage_peaks[sample['stage']] = max(stage_peaks.get(sample['stage'], 0), sample['rss'])
+        peak = max(self.samples, key=lambda sample: sample['rss'], default=None)
+        memory = {'sample_interval': self.sample_interval,
+                  'peak_rss': peak['rss'] if peak else None,
+                  'peak_rss_stage': peak['stage'] if peak else None,
+                  'peak_traced': traced_peak,
+                  'stage_peak_rss': stage_peaks,
+                  'samples': self.samples}
+        with open(self.path + 'memory.json', 'w') as file:
+            json.dump(memory, file)
+
+    @classmethod
+    def get_files(cls, job_folder):
+        """
+        Returns: the profile files of the job and of each of its tiles,
+            relative to job_folder.
+        """
+        folders = [cls.folder]
+        tiles_folder = job_folder + JobProgress.tiles_folder
+        if os.path.isdir(tiles_folder):
+            folders += [JobProgress.tiles_folder + tile + '/' + cls.folder for tile in sorted(os.listdir(tiles_folder))]
+        files = []
+        for folder in folders:
+            if os.path.isdir(job_folder + folder):
+                files += [folder + file for file in sorted(os.listdir(job_folder + folder))]
+        return files
+
+    @classmethod
+    def build_archive(cls, job_folder):
+        """
+        Zip the job's profile files into <job_folder>/profile.zip,
+        rebuilt when a profile was written since.
+        Returns: the archive's filename, or None if the job has no profile.
+        """
+        files = cls.get_files(job_folder)
+        if not files:
+            return None
+        zip_filename = job_folder + cls.archive_filename
+        if os.path.exists(zip_filename) and \
+                os.path.getmtime(zip_filename) >= max(os.path.getmtime(job_folder + file) for file in files):
+            return zip_filename
+        tmp_filename = '{}.{}.{}.tmp'.format(zip_filename, os.getpid(), threading.get_ident())
+        with zipfile.ZipFile(tmp_filename, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for file in files:
+                archive.write(job_folder + file, file)
+        os.replace(tmp_filename, zip_filename)
+        return zip_filename
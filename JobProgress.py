@@ -0,0 +1,110 @@
+import json
+import time
+import os
+
+
+class JobProgress:
+    """
+    Stage timeline of a running job. Every stage transition is written
+    to <job_folder>/progress.json, so the timeline is kept with the
+    job's results and can be read by the API process at any time.
+    A job split into tiles has one timeline per tile, in
+    <job_folder>/tiles/<tile_index>/, and its own once they are merged.
+    """
+    filename = 'progress.json'
+    tiles_folder = 'tiles/'
+    # percent updates within a stage are written at most this often
+    write_interval = 1.0
+
+    def __init__(self, job_folder, tile_index=None, num_tiles=None):
+        self.path = job_folder + self.filename
+        self.tile_index = tile_index
+        self.num_tiles = num_tiles
+        self.started_at = time.time()
+        self.finished_at = None
+        self.stages = []
+        self.last_write = 0
+        self._write()
+
+    def start_stage(self, name):
+        now = time.time()
+        self._finish_stage(now)
+        self.stages.append({'stage': name,
+                            'started_at': now,
+                            'finished_at': None,
+                            'duration': None,
+                            'percent': None})
+        self._write()
+
+    def set_percent(self, percent):
+        if not self.stages:
+            return
+        self.stages[-1]['percent'] = percent
+        if time.time() - self.last_write >= self.write_interval:
+            self._write()
+
+    def _finish_stage(self, now):
+        if self.stages and self.stages[-1]['finished_at'] is None:
+            stage = self.stages[-1]
+            stage['finished_at'] = now
+            stage['duration'] = now - stage['started_at']
+
+    def finish(self):
+        self.finished_at = time.time()
+        self._finish_stage(self.finished_at)
+        self._write()
+
+    def to_dict(self):
+        current = self.stages[-1] if self.stages and self.finished_at is None else None
+        progress = {'stage': current['stage'] if current else None,
+                    'percent': current['percent'] if current else None,
+                    'started_at': self.started_at,
+                    'finished_at': self.finished_at,
+                    'stages': self.stages}
+        if self.tile_index is not None:
+            progress['tile'] = self.tile_index
+            progress['num_tiles'] = self.num_tiles
+        return progress
+
+    def _write(self):
+        self.last_write = time.time()
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as file:
+            json.dump(self.to_dict(), file)
+        os.replace(tmp_path, self.path)
+
+    @classmethod
+    def _load_file(cls, folder):
+        try:
+            with open(folder + cls.filename) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    @classmethod
+    def load(cls, job_folder):
+        """
+        Returns: the progress recorded for the job, or None if it has
+            not started. A job split into tiles lists the progress of
+            each tile started so far under 'tiles'; until they are
+            merged its stage is 'computing_tiles', percent being the
+            share of tiles finished.
+        """
+        progress = cls._load_file(job_folder)
+        try:
+            tile_folders = sorted(os.listdir(job_folder + cls.tiles_folder), key=int)
+        except (OSError, ValueError):
+            return progress
+        tiles = [tile for tile in (cls._load_file(job_folder + cls.tiles_folder + tile_folder + '/')
+                                   for tile_folder in tile_folders) if tile is not None]
+        if not tiles:
+            return progress
+        if progress is None:
+            finished = sum(1 for tile in tiles if tile['finished_at'] is not None)
+            progress = {'stage': 'computing_tiles',
+                        'percent': 100.0 * finished / tiles[0]['num_tiles'],
+                        'started_at': min(tile['started_at'] for tile in tiles),
+                        'finished_at': None,
+                        'stages': []}
+        progress['tiles'] = tiles
+        return progress
@@ -0,0 +1,121 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class JobQueue:
+    """
+    Submitted jobs waiting to be claimed by a worker node's dispatcher,
+    kept in memory, so API and workers must share this process and the
+    queue does not outlive it.
+    SqliteJobQueue has the same interface and is shared by API and
+    worker processes on any number of hosts.
+
+    A job stays in the queue from submission until its worker is done
+    with it: unclaimed until a node claims it, then claimed by that
+    node until finish() is called.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # job_id -> job, unclaimed ones only
+        self.jobs = OrderedDict()
+        # job_id -> (node_id, job)
+        self.claimed = {}
+        self.cancel_requests = set()
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def push(self, jobs):
+        with self.lock:
+            for job in jobs:
+                job.enqueued_at = time.time()
+                self.jobs[job.job_id] = job
+
+    def claim(self, node_id, limit=None):
+        """
+        Returns: up to limit unclaimed jobs, highest priority and then
+            longest waiting first, now claimed by node_id.
+        """
+        with self.lock:
+            jobs = sorted(self.jobs.values(), key=lambda job: (-job.priority, job.enqueued_at))[:limit]
+            for job in jobs:
+                del self.jobs[job.job_id]
+                self.claimed[job.job_id] = (node_id, job)
+            return jobs
+
+    def release(self, job_ids):
+        """
+        Return claimed jobs that never started to the queue.
+        """
+        with self.lock:
+            for job_id in job_ids:
+                if job_id in self.claimed:
+                    self.jobs[job_id] = self.claimed.pop(job_id)[1]
+
+    def remove(self, job_id):
+        """
+        Returns: whether the job was unclaimed and is now removed.
+        """
+        with self.lock:
+            return self.jobs.pop(job_id, None) is not None
+
+    def finish(self, job_id):
+        with self.lock:
+            self.claimed.pop(job_id, None)
+            self.cancel_requests.discard(job_id)
+
+    def request_cancel(self, job_id):
+        with self.lock:
+            if job_id in self.claimed:
+                self.cancel_requests.add(job_id)
+
+    def get_cancel_requests(self, node_id):
+        """
+        Returns: job_ids claimed by node_id that should be cancelled.
+        """
+        with self.lock:
+            return {job_id for job_id in self.cancel_requests
+                    if job_id in self.claimed and self.claimed[job_id][0] == node_id}
+
+    def get_position(self, job_id):
+        """
+        Returns: number of unclaimed jobs that will be claimed before
+            this one, or None if it is not waiting to be claimed.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            return sum(1 for other in self.jobs.values()
+                       if (-other.priority, other.enqueued_at) < (-job.priority, job.enqueued_at))
+
+    def heartbeat(self, node_id):
+        # the only node is this process
+        pass
+
+    def remove_node(self, node_id):
+        pass
+
+    def recover(self, node_id, node_timeout):
+        """
+        Returns: [], no other node can have claimed a job.
+        """
+        return []
+
+    def get_jobs(self):
+        """
+        Returns: every queued or claimed job.
+        """
+        with self.lock:
+            return list(self.jobs.values()) + [job for _, job in self.claimed.values()]
+
+    def get_references(self):
+        """
+        Returns: (job_ids, resource_ids) of every queued or claimed job.
+        """
+        with self.lock:
+            jobs = list(self.jobs.values()) + [job for _, job in self.claimed.values()]
+        return ({job.job_id for job in jobs},
+                {resource_id for job in jobs for resource_id in [job.primary_resource_id, job.secondary_resource_id]
+                 if resource_id is not None})
@@ -1,118 +1,280 @@
-from multiprocessing import Lock
+from contextlib import contextmanager
+import fcntl
+import Metrics
 import json
 import time
 import os
 
+
 class Manifest:
-    def __init__(self):
-        self.lock = Lock()
+    def __init__(self, filename='manifest.json'):
+        self.filename = filename
+
+    @contextmanager
+    def _locked(self):
+        # a file lock on a fresh descriptor serializes threads and
+        # processes alike, and is released by the kernel if a Consumer
+        # is killed while holding it
+        with open(self.filename + '.lock', 'a') as lock_file:
+            with Metrics.MANIFEST_LATENCY.labels('json', 'lock').time():
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
 
     def _load(self):
-        if os.path.exists('manifest.json'):
-            with open('manifest.json', 'r') as file:
-                self.lock.acquire()
-                try:
-                    manifest = json.load(file)
-                except:
-                    manifest = {'resources':{},
-                    'jobs':{}}
-                self.lock.release()
-                return manifest
-        else:
-            return {'resources':{},
-                    'jobs':{}}
+        manifest = {'resources': {},
+                    'jobs': {}}
+        if os.path.exists(self.filename):
+            with Metrics.MANIFEST_LATENCY.labels('json', 'read').time():
+                with open(self.filename, 'r') as file:
+                    try:
+                        manifest = json.load(file)
+                    except ValueError:
+                        pass
+        if 'hashes' not in manifest:
+            # hash -> resource_id index, rebuilt for manifests written before it existed
+            manifest['hashes'] = {values['hash']: resource_id
+                                  for resource_id, values in manifest['resources'].items()}
+        return manifest
 
     def _write(self, manifest):
-        with open('manifest.json', 'w') as file:
-            self.lock.acquire()
-            try:
+        tmp_filename = self.filename + '.tmp'
+        with Metrics.MANIFEST_LATENCY.labels('json', 'write').time():
+            with open(tmp_filename, 'w') as file:
                 json.dump(manifest, file)
-            except:
-                pass
-            self.lock.release()
+            os.replace(tmp_filename, self.filename)
+
+    def get_size(self):
+        if not os.path.exists(self.filename):
+            return 0
+        return os.path.getsize(self.filename)
 
     def clear(self):
-        if os.path.exists('manifest.json'):
-            os.remove('manifest.json')
+        for filename in [self.filename, self.filename + '.lock']:
+            if os.path.exists(filename):
+                os.remove(filename)
 
     def add_resource(self, resource_id, resource_hash):
-        manifest = self._load()
-
-        manifest['resources'][resource_id] = {'hash':resource_hash,
-                                              'timestamp':time.time()}
-        self._write(manifest)
+        with self._locked():
+            manifest = self._load()
+            existing_id = manifest['hashes'].get(resource_hash)
+            if existing_id in manifest['resources']:
+                resource = manifest['resources'][existing_id]
+                resource['ref_count'] = resource.get('ref_count', 1) + 1
+                resource['timestamp'] = time.time()
+                self._write(manifest)
+                return existing_id
+            manifest['resources'][resource_id] = {'hash': resource_hash,
+                                                  'timestamp': time.time(),
+                                                  'ref_count': 1}
+            manifest['hashes'][resource_hash] = resource_id
+            self._write(manifest)
+            return resource_id
 
     def delete_resource(self, resource_id):
-        manifest = self._load()
-        if resource_id not in manifest['resources'].keys():
-            return False
-        del manifest['resources'][resource_id]
-        self._write(manifest)
-        return True
+        with self._locked():
+            manifest = self._load()
+            if resource_id not in manifest['resources'].keys():
+                return None
+            resource = manifest['resources'][resource_id]
+            ref_count = resource.get('ref_count', 1) - 1
+            if ref_count > 0:
+                resource['ref_count'] = ref_count
+            else:
+                self._remove_resource(manifest, resource_id)
+            self._write(manifest)
+            return ref_count
 
-    def add_job(self, job_id):
-        manifest = self._load()
+    @staticmethod
+    def _remove_resource(manifest, resource_id):
+        resource_hash = manifest['resources'].pop(resource_id)['hash']
+        if manifest['hashes'].get(resource_hash) == resource_id:
+            del manifest['hashes'][resource_hash]
 
-        manifest['jobs'][job_id] = {'status': 'enqueued',
-                                    'timestamp': time.time()}
-        self._write(manifest)
+    def add_job(self, job_id, fingerprint=None):
+        with self._locked():
+            manifest = self._load()
+            manifest['jobs'][job_id] = {'status': 'enqueued',
+                                        'timestamp': time.time(),
+                                        'fingerprint': fingerprint}
+            self._write(manifest)
 
-    def delete_job(self, job_id):
-        manifest = self._load()
+    def add_jobs(self, job_ids, fingerprints=None):
+        if fingerprints is None:
+            fingerprints = [None] * len(job_ids)
+        with self._locked():
+            manifest = self._load()
+            for job_id, fingerprint in zip(job_ids, fingerprints):
+                manifest['jobs'][job_id] = {'status': 'enqueued',
+                                            'timestamp': time.time(),
+                                            'fingerprint': fingerprint}
+            self._write(manifest)
+
+    def add_job_alias(self, job_id, existing_id):
+        """
+        Register job_id as another handle on the job existing_id is a
+        handle on, starting from existing_id's status.
+        Returns: that status, or None if existing_id no longer exists.
+        """
+        with self._locked():
+            manifest = self._load()
+            job = manifest['jobs'].get(existing_id)
+            if job is None:
+                return None
+            manifest['jobs'][job_id] = {'status': job['status'],
+                                        'timestamp': time.time(),
+                                        'fingerprint': job.get('fingerprint'),
+                                        'alias_of': job.get('alias_of') or existing_id}
+            if 'exception_message' in job:
+                manifest['jobs'][job_id]['exception_message'] = job['exception_message']
+            self._write(manifest)
+            return job['status']
+
+    def find_job(self, fingerprint, statuses):
+        """
+        Returns: the most recent job or alias with fingerprint and one
+            of statuses, or None.
+        """
+        with self._locked():
+            manifest = self._load()
+        matches = [(values['timestamp'], job_id) for job_id, values in manifest['jobs'].items()
+                   if values.get('fingerprint') == fingerprint and values['status'] in statuses]
+        if not matches:
+            return None
+        return max(matches)[1]
+
+    def get_job_folder_id(self, job_id):
+        """
+        Returns: the job_id whose folder holds job_id's results, or
+            None if job_id does not exist.
+        """
+        with self._locked():
+            manifest = self._load()
         if job_id not in manifest['jobs'].keys():
-            return False
-        del manifest['jobs'][job_id]
-        self._write(manifest)
-        return True
+            return None
+        return manifest['jobs'][job_id].get('alias_of') or job_id
+
+    def get_job_aliases(self, job_id):
+        with self._locked():
+            manifest = self._load()
+        return [alias_id for alias_id, values in manifest['jobs'].items() if values.get('alias_of') == job_id]
+
+    def count_job_references(self, folder_id):
+        """
+        Returns: number of jobs, the job itself or its aliases, whose
+            results live in folder_id.
+        """
+        with self._locked():
+            manifest = self._load()
+        return sum(1 for job_id, values in manifest['jobs'].items()
+                   if job_id == folder_id or values.get('alias_of') == folder_id)
+
+    def delete_job(self, job_id):
+        with self._locked():
+            manifest = self._load()
+            if job_id not in manifest['jobs'].keys():
+                return False
+            del manifest['jobs'][job_id]
+            self._write(manifest)
+            return True
 
     def resource_exists(self, resource_id):
-        manifest = self._load()
+        with self._locked():
+            manifest = self._load()
         return resource_id in manifest['resources'].keys()
 
     def resource_hash_exists(self, resource_hash):
-        manifest = self._load()
-        for resource_id, values in manifest['resources'].items():
-            if values['hash'] == resource_hash:
-                return resource_id
-        return False
+        with self._locked():
+            manifest = self._load()
+        resource_id = manifest['hashes'].get(resource_hash)
+        if resource_id not in manifest['resources']:
+            return False
+        return resource_id
+
+    def get_resource_hash(self, resource_id):
+        with self._locked():
+            manifest = self._load()
+        if resource_id not in manifest['resources'].keys():
+            return None
+        return manifest['resources'][resource_id]['hash']
 
     def job_exists(self, job_id):
-        manifest = self._load()
+        with self._locked():
+            manifest = self._load()
         return job_id in manifest['jobs'].keys()
 
     def get_job_status(self, job_id):
-        manifest = self._load()
+        with self._locked():
+            manifest = self._load()
         if job_id not in manifest['jobs'].keys():
             return None
         return manifest['jobs'][job_id]['status']
 
+    def get_job_statuses(self, job_ids):
+        """
+        Returns: job_id -> (status, exception_message) for each of
+            job_ids that exists, from a single read of the manifest.
+        """
+        with self._locked():
+            manifest = self._load()
+        statuses = {}
+        for job_id in job_ids:
+            if job_id in manifest['jobs'].keys():
+                values = manifest['jobs'][job_id]
+                statuses[job_id] = (values['status'], values.get('exception_message'))
+        return statuses
+
     def get_job_exception_message(self, job_id):
-        manifest = self._load()
+        with self._locked():
+            manifest = self._load()
         if job_id not in manifest['jobs'].keys():
             return None
         if 'exception_message' not in manifest['jobs'][job_id].keys():
             return None
         return manifest['jobs'][job_id]['exception_message']
 
-    def update_job_status(self, job_id, status):
-        manifest = self._load()
-        if job_id not in manifest['jobs'].keys():
-            return False
-        manifest['jobs'][job_id]['status'] = status
-        self._write(manifest)
-        return True
+    @staticmethod
+    def _get_job_targets(manifest, job_id, from_statuses, with_aliases):
+        targets = [job_id] if job_id in manifest['jobs'].keys() else []
+        if with_aliases:
+            targets += [alias_id for alias_id, values in manifest['jobs'].items()
+                        if values.get('alias_of') == job_id]
+        return [target for target in targets
+                if from_statuses is None or manifest['jobs'][target]['status'] in from_statuses]
 
-    def add_job_exception(self, job_id, exception_message):
-        manifest = self._load()
-        if job_id not in manifest['jobs'].keys():
-            return False
-        manifest['jobs'][job_id]['status'] = 'exception'
-        manifest['jobs'][job_id]['exception_message'] = exception_message
-        self._write(manifest)
-        return True
+    def update_job_status(self, job_id, status, from_statuses=None, with_aliases=True):
+        """
+        Set the status of a job and, with_aliases, of every alias of it.
+        If from_statuses is given, only jobs currently in one of them
+        are updated.
+        Returns: the job_ids updated.
+        """
+        with self._locked():
+            manifest = self._load()
+            updated = self._get_job_targets(manifest, job_id, from_statuses, with_aliases)
+            for target in updated:
+                manifest['jobs'][target]['status'] = status
+            if updated:
+                self._write(manifest)
+            return updated
+
+    def add_job_exception(self, job_id, exception_message, status='exception', from_statuses=None,
+                          with_aliases=True):
+        with self._locked():
+            manifest = self._load()
+            updated = self._get_job_targets(manifest, job_id, from_statuses, with_aliases)
+            for target in updated:
+                manifest['jobs'][target]['status'] = status
+                manifest['jobs'][target]['exception_message'] = exception_message
+            if updated:
+                self._write(manifest)
+            return updated
 
     def get_expired_jobs(self, lifespan):
-        manifest = self._load()
+        with self._locked():
+            manifest = self._load()
         jobs_to_delete = []
         for job_id, values in manifest['jobs'].items():
             if time.time() - values['timestamp'] > lifespan:
@@ -121,7 +283,8 @@ class Manifest:
         return jobs_to_delete
 
     def get_expired_resources(self, lifespan):
-        manifest = self._load()
+        with self._locked():
+            manifest = self._load()
         resources_to_delete = []
         for resource_id, values in manifest['resources'].items():
             if time.time() - values['timestamp'] > lifespan:
@@ -129,18 +292,48 @@ class Manifest:
 
         return resources_to_delete
 
-    def delete_expired_jobs(self, lifespan):
-        expired_jobs = self.get_expired_jobs(lifespan)
-        manifest = self._load()
-        for job_id in expired_jobs:
-            del manifest['jobs'][job_id]
-        self._write(manifest)
-        return expired_jobs
-
-    def delete_expired_resources(self, lifespan):
-        expired_resources = self.get_expired_resources(lifespan)
-        manifest = self._load()
-        for resource_id in expired_resources:
-            del manifest['resources'][resource_id]
-        self._write(manifest)
-        return expired_resources
\ No newline at end of file
+    @staticmethod
+    def _get_expired(entries, lifespan, exclude, limit):
+        cutoff = time.time() - lifespan
+        expired = sorted((values['timestamp'], entry_id) for entry_id, values in entries.items()
+                         if values['timestamp'] < cutoff and entry_id not in exclude)
+        return [entry_id for _, entry_id in expired[:limit]]
+
+    def delete_expired_jobs(self, lifespan, exclude=(), limit=None):
+        """
+        Delete up to limit jobs older than lifespan, oldest first,
+        skipping the job_ids in exclude.
+        Returns: (job_id, folder_id) of each deleted job, folder_id
+            being the job_id whose folder holds its results.
+        """
+        with self._locked():
+            manifest = self._load()
+            expired_jobs = self._get_expired(manifest['jobs'], lifespan, exclude, limit)
+            deleted = []
+            for job_id in expired_jobs:
+                deleted.append((job_id, manifest['jobs'].pop(job_id).get('alias_of') or job_id))
+            if expired_jobs:
+                self._write(manifest)
+            return deleted
+
+    def delete_expired_resources(self, lifespan, exclude=(), limit=None):
+        with self._locked():
+            manifest = self._load()
+            expired_resources = self._get_expired(manifest['resources'], lifespan, exclude, limit)
+            for resource_id in expired_resources:
+                self._remove_resource(manifest, resource_id)
+            if expired_resources:
+                self._write(manifest)
+            return expired_resources
+
+    def remove_resource(self, resource_id):
+        """
+        Remove a resource whatever its reference count.
+        """
+        with self._locked():
+            manifest = self._load()
+            if resource_id not in manifest['resources'].keys():
+                return False
+            self._remove_resource(manifest, resource_id)
+            self._write(manifest)
+            return True
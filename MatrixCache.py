@@ -0,0 +1,116 @@
+from multiprocessing import Value
+import hashlib
+import json
+import os
+
+import Metrics
+
+
+class MatrixCache:
+    """
+    Content-addressed on-disk cache of transit matrices (tmx), shared by
+    every Consumer. Entries are keyed on the hashes of the input
+    resources plus the settings that determine the matrix, and evicted
+    least recently used first once the cache grows past max_bytes.
+    """
+    def __init__(self, cache_dir='data/matrix_cache/', max_bytes=10737418240):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = Value('l', 0)
+        self.misses = Value('l', 0)
+        self.evictions = Value('l', 0)
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    @staticmethod
+    def get_key(primary_hash, secondary_hash, matrix_kwargs):
+        """
+        Returns: cache key for a matrix over the given resources.
+            matrix_kwargs should only hold settings that change
+            the matrix itself.
+        """
+        key_source = json.dumps([primary_hash, secondary_hash, matrix_kwargs], sort_keys=True)
+        return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+    def _get_filename(self, key):
+        return self.cache_dir + key + '.tmx'
+
+    @staticmethod
+    def _increment(counter):
+        with counter.get_lock():
+            counter.value += 1
+
+    def lookup(self, key):
+        """
+        Returns: filename of the cached tmx, or None on a miss.
+        """
+        filename = self._get_filename(key)
+        try:
+            # mtime doubles as the last-used time for eviction
+            os.utime(filename, None)
+        except FileNotFoundError:
+            self._increment(self.misses)
+            Metrics.CACHE_LOOKUPS.labels('matrix', 'miss').inc()
+            return None
+        self._increment(self.hits)
+        Metrics.CACHE_LOOKUPS.labels('matrix', 'hit').inc()
+        return filename
+
+    def contains(self, key):
+        """
+        Returns: whether the entry exists, without counting a lookup.
+        """
+        return os.path.exists(self._get_filename(key))
+
+    def store(self, key, write_tmx):
+        """
+        Add an entry by calling write_tmx(filename), then evict down
+        to max_bytes.
+        """
+        filename = self._get_filename(key)
+        tmp_filename = '{}{}.{}.tmp.tmx'.format(self.cache_dir, key, os.getpid())
+        try:
+            write_tmx(tmp_filename)
+            os.replace(tmp_filename, filename)
+        finally:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+        self.evict()
+        return filename
+
+    def _get_entries(self):
+        entries = []
+        for file in os.listdir(self.cache_dir):
+            if not file.endswith('.tmx') or file.endswith('.tmp.tmx'):
+                continue
+            try:
+                stat = os.stat(self.cache_dir + file)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, self.cache_dir + file))
+        return entries
+
+    def evict(self):
+        entries = sorted(self._get_entries())
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+                self._increment(self.evictions)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    def get_stats(self):
+        entries = self._get_entries()
+        hits = self.hits.value
+        misses = self.misses.value
+        return {'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else None,
+                'evictions': self.evictions.value,
+                'entries': len(entries),
+                'bytes': sum(size for _, size, _ in entries),
+                'max_bytes': self.max_bytes}
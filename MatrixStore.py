@@ -0,0 +1,103 @@
+from numpy.lib.format import open_memmap
+import numpy as np
+import threading
+import json
+import csv
+import os
+
+
+class MatrixStore:
+    """
+    A finished transit matrix as a memory-mapped float32 .npy file with
+    origin and destination id indexes, so single travel times and rows
+    are read straight from the page cache instead of parsing the whole
+    output.csv.
+    """
+    matrix_filename = 'matrix.npy'
+    index_filename = 'matrix_index.json'
+
+    def __init__(self, job_folder):
+        with open(job_folder + self.index_filename) as file:
+            index = json.load(file)
+        self.origin_ids = index['origins']
+        self.dest_ids = index['destinations']
+        self.origins = {origin_id: row for row, origin_id in enumerate(self.origin_ids)}
+        self.dests = {dest_id: column for column, dest_id in enumerate(self.dest_ids)}
+        self.matrix = np.load(job_folder + self.matrix_filename, mmap_mode='r')
+
+    @classmethod
+    def exists(cls, job_folder):
+        return os.path.exists(job_folder + cls.matrix_filename)
+
+    @staticmethod
+    def _read_rows(csv_filename):
+        with open(csv_filename, newline='') as file:
+            reader = csv.reader(file)
+            header = next(reader)
+            # write_csv may end each line with a separator
+            trailing = len(header) > 1 and header[-1] == ''
+            dest_ids = header[1:-1] if trailing else header[1:]
+            yield dest_ids
+            for row in reader:
+                if not row:
+                    continue
+                yield row[:len(dest_ids) + 1]
+
+    @classmethod
+    def build(cls, csv_filename, job_folder):
+        """
+        Convert a matrix written by TransitMatrix.write_csv. The index
+        is written first and the matrix renamed into place last, so a
+        store is only visible once it is complete.
+        """
+        with open(csv_filename, 'rb') as file:
+            num_rows = max(sum(1 for line in file if line.strip()) - 1, 0)
+        rows = cls._read_rows(csv_filename)
+        dest_ids = next(rows)
+        tmp_matrix_filename = '{}{}.{}.{}.tmp.npy'.format(job_folder, cls.matrix_filename, os.getpid(),
+                                                          threading.get_ident())
+        matrix = open_memmap(tmp_matrix_filename, mode='w+', dtype=np.float32,
+                             shape=(num_rows, len(dest_ids)))
+        origin_ids = []
+        for row_number, row in enumerate(rows):
+            origin_ids.append(row[0])
+            matrix[row_number] = [float(value) if value else np.nan for value in row[1:]]
+        matrix.flush()
+        del matrix
+        tmp_index_filename = '{}{}.{}.{}.tmp'.format(job_folder, cls.index_filename, os.getpid(),
+                                                     threading.get_ident())
+        with open(tmp_index_filename, 'w') as file:
+            json.dump({'origins': origin_ids, 'destinations': dest_ids}, file)
+        os.replace(tmp_index_filename, job_folder + cls.index_filename)
+        os.replace(tmp_matrix_filename, job_folder + cls.matrix_filename)
+
+    @staticmethod
+    def _to_json(value):
+        value = float(value)
+        return None if np.isnan(value) else value
+
+    def get_travel_time(self, origin_id, dest_id):
+        """
+        Returns: travel time from origin to destination (None if
+            unreachable).
+        Raises:
+            KeyError: unknown origin or destination id.
+        """
+        return self._to_json(self.matrix[self.origins[origin_id], self.dests[dest_id]])
+
+    def get_row(self, origin_id, dest_ids=None, offset=0, limit=None):
+        """
+        Returns: dest_id -> travel time for one origin, over dest_ids
+            if given, else over the destinations in [offset, offset + limit).
+        Raises:
+            KeyError: unknown origin or destination id.
+        """
+        row = self.matrix[self.origins[origin_id]]
+        if dest_ids is None:
+            end = len(self.dest_ids) if limit is None else offset + limit
+            columns = range(offset, min(end, len(self.dest_ids)))
+            dest_ids = [self.dest_ids[column] for column in columns]
+        else:
+            columns = [self.dests[dest_id] for dest_id in dest_ids]
+        values = row[list(columns)]
+        return {dest_id: self._to_json(value) for dest_id, value in zip(dest_ids, values)}
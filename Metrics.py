@@ -0,0 +1,156 @@
+import os
+import re
+import contextlib
+
+# prometheus_client, imported by setup() once the metrics directory is
+# set, None while metrics are off
+prometheus_client = None
+
+DEFAULT_DIRECTORY = 'data/metrics/'
+# samples of one process are in files named <kind>_<pid>.db
+PID_PATTERN = re.compile(r'_(\d+)\.db$')
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# jobs run from seconds to hours
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400, 28800, float('inf'))
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float('inf'))
+TRANSFER_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, float('inf'))
+
+
+class NullMetric:
+    """
+    Stands in for every metric while metrics are off, e.g. in tools
+    importing the core modules, and records nothing.
+    """
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def time(self):
+        return contextlib.nullcontext()
+
+
+QUEUE_DEPTH = NullMetric()
+QUEUE_WAIT = NullMetric()
+JOB_DURATION = NullMetric()
+WORKERS = NullMetric()
+MANIFEST_LATENCY = NullMetric()
+MANIFEST_BYTES = NullMetric()
+UPLOAD_BYTES = NullMetric()
+UPLOAD_DURATION = NullMetric()
+INGEST_DURATION = NullMetric()
+ARCHIVE_BUILD_DURATION = NullMetric()
+SWEPT = NullMetric()
+DISK_BYTES = NullMetric()
+JOBS_COALESCED = NullMetric()
+JOBS_RECOVERED = NullMetric()
+CACHE_LOOKUPS = NullMetric()
+
+
+def remove_stale_files(directory):
+    """
+    Delete the samples of processes no longer running, left by a
+    previous run, which would be counted again.
+    """
+    for filename in os.listdir(directory):
+        match = PID_PATTERN.search(filename)
+        if match is None:
+            continue
+        try:
+            os.kill(int(match.group(1)), 0)
+        except ProcessLookupError:
+            os.remove(directory + '/' + filename)
+        except PermissionError:
+            pass
+
+
+def setup(clear=False):
+    """
+    Record metrics in this process and in the processes it starts from
+    now on. prometheus_client reads $PROMETHEUS_MULTIPROC_DIR when it is
+    imported: every API and Consumer process then writes its samples to
+    files in the directory, and /metrics aggregates them. Call it before
+    starting any Consumer; importing this module has no side effects.
+    clear: first delete the samples left by processes of a previous run.
+    Returns: whether metrics are recorded, False if prometheus_client
+        is not installed.
+    """
+    global prometheus_client
+    global QUEUE_DEPTH, QUEUE_WAIT, JOB_DURATION, WORKERS, MANIFEST_LATENCY, MANIFEST_BYTES, \
+        UPLOAD_BYTES, UPLOAD_DURATION, INGEST_DURATION, ARCHIVE_BUILD_DURATION, SWEPT, DISK_BYTES, \
+        JOBS_COALESCED, JOBS_RECOVERED, CACHE_LOOKUPS
+    if prometheus_client is not None:
+        return True
+    directory = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', DEFAULT_DIRECTORY)
+    os.makedirs(directory, exist_ok=True)
+    if clear:
+        remove_stale_files(directory)
+    try:
+        import prometheus_client
+        import prometheus_client.multiprocess
+        from prometheus_client import Counter, Gauge, Histogram
+    except ImportError:
+        print('prometheus_client is not installed, metrics are off')
+        return False
+    QUEUE_DEPTH = Gauge('spatial_access_queue_depth', 'Jobs waiting to be dispatched',
+                        multiprocess_mode='livesum')
+    QUEUE_WAIT = Histogram('spatial_access_queue_wait_seconds', 'Time jobs waited in the queue',
+                           buckets=DURATION_BUCKETS)
+    JOB_DURATION = Histogram('spatial_access_job_duration_seconds', 'Run time of jobs',
+                             ['job_type', 'model_type', 'outcome'], buckets=DURATION_BUCKETS)
+    WORKERS = Gauge('spatial_access_workers', 'Consumer processes', ['state'],
+                    multiprocess_mode='livesum')
+    MANIFEST_LATENCY = Histogram('spatial_access_manifest_seconds', 'Manifest read and write latency',
+                                 ['backend', 'operation'], buckets=FAST_BUCKETS)
+    MANIFEST_BYTES = Gauge('spatial_access_manifest_bytes', 'Size of the manifest on disk',
+                           ['backend'], multiprocess_mode='livemax')
+    UPLOAD_BYTES = Counter('spatial_access_upload_bytes', 'Bytes received in uploads')
+    UPLOAD_DURATION = Histogram('spatial_access_upload_seconds', 'Time spent receiving uploads and chunks',
+                                buckets=TRANSFER_BUCKETS)
+    INGEST_DURATION = Histogram('spatial_access_ingest_seconds', 'Time to parse uploads into their columnar form',
+                                buckets=TRANSFER_BUCKETS)
+    ARCHIVE_BUILD_DURATION = Histogram('spatial_access_archive_build_seconds', 'Time to zip job results',
+                                       buckets=TRANSFER_BUCKETS)
+    SWEPT = Counter('spatial_access_swept', 'Entries deleted by the sweeper by kind and reason',
+                    ['kind', 'reason'])
+    DISK_BYTES = Gauge('spatial_access_disk_bytes', 'Size of resources/ and jobs/ on disk',
+                       ['directory'], multiprocess_mode='livemax')
+    JOBS_COALESCED = Counter('spatial_access_jobs_coalesced', 'Submissions attached to an identical job, by its status',
+                             ['job_status'])
+    JOBS_RECOVERED = Counter('spatial_access_jobs_recovered', 'Jobs of lost worker nodes taken over, by outcome',
+                             ['outcome'])
+    CACHE_LOOKUPS = Counter('spatial_access_cache_lookups', 'Cache lookups by cache and result',
+                            ['cache', 'result'])
+    return True
+
+
+def mark_process_dead(pid):
+    """
+    Drop the live gauges of a Consumer or web worker that exited.
+    """
+    if prometheus_client is not None:
+        prometheus_client.multiprocess.mark_process_dead(pid)
+
+
+def generate_metrics():
+    """
+    Returns: (exposition text, content type) aggregated over every
+        process writing to the metrics directory, empty while metrics
+        are off.
+    """
+    if prometheus_client is None:
+        return b'', CONTENT_TYPE
+    registry = prometheus_client.CollectorRegistry()
+    prometheus_client.multiprocess.MultiProcessCollector(registry)
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
@@ -0,0 +1,186 @@
+from collections import OrderedDict
+from multiprocessing import Value
+import pickle
+import os
+
+from spatial_access.NetworkInterface import NetworkInterface
+
+import Metrics
+
+
+class NetworkCache:
+    """
+    Street network cache for spatial_access.NetworkInterface, in two tiers:
+    an in-memory LRU private to each Consumer process, capped at
+    max_memory_bytes, and an on-disk store in cache_dir that survives
+    restarts and can be shared between hosts.
+
+    Networks are keyed by network type and bounding box, rounded to
+    bbox_digits decimals. Only a network with the very bounding box
+    requested is served: node snapping and routes near the edge of a
+    larger network differ, so results would depend on what was cached
+    before, and matrices computed from them are cached under their
+    inputs. Travel speeds are applied to the edges after loading, so
+    they are not part of the key.
+    """
+    # about 10cm, far below what moves the bounding box of a job
+    bbox_digits = 6
+
+    def __init__(self, cache_dir='data/network_cache/', max_memory_bytes=1073741824,
+                 max_disk_bytes=10737418240):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.graphs = OrderedDict()
+        self.memory_bytes = 0
+        self.memory_hits = Value('l', 0)
+        self.disk_hits = Value('l', 0)
+        self.misses = Value('l', 0)
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    @staticmethod
+    def _increment(counter):
+        with counter.get_lock():
+            counter.value += 1
+
+    @classmethod
+    def _normalize(cls, bbox):
+        return tuple(round(float(coord), cls.bbox_digits) for coord in bbox)
+
+    def _get_filename(self, network_type, bbox):
+        return '{}{}_{}.pkl'.format(self.cache_dir, network_type,
+                                    '_'.join(repr(coord) for coord in self._normalize(bbox)))
+
+    def _parse_filename(self, file):
+        if not file.endswith('.pkl'):
+            return None
+        parts = file[:-len('.pkl')].split('_')
+        if len(parts) != 5:
+            return None
+        try:
+            return parts[0], tuple(float(coord) for coord in parts[1:])
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _get_size(nodes, edges):
+        return int(nodes.memory_usage(deep=True).sum() + edges.memory_usage(deep=True).sum())
+
+    def _remember(self, network_type, bbox, nodes, edges):
+        size = self._get_size(nodes, edges)
+        if size > self.max_memory_bytes:
+            return
+        key = (network_type, self._normalize(bbox))
+        if key in self.graphs:
+            self.memory_bytes -= self.graphs.pop(key)[2]
+        self.graphs[key] = (nodes, edges, size)
+        self.memory_bytes += size
+        while self.memory_bytes > self.max_memory_bytes:
+            _, (_, _, evicted_size) = self.graphs.popitem(last=False)
+            self.memory_bytes -= evicted_size
+
+    def _lookup_memory(self, network_type, bbox):
+        key = (network_type, self._normalize(bbox))
+        if key not in self.graphs:
+            return None
+        self.graphs.move_to_end(key)
+        nodes, edges, _ = self.graphs[key]
+        return nodes, edges
+
+    def _lookup_disk(self, network_type, bbox):
+        filename = self._get_filename(network_type, bbox)
+        try:
+            with open(filename, 'rb') as file:
+                nodes, edges = pickle.load(file)
+            os.utime(filename, None)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        self._remember(network_type, bbox, nodes, edges)
+        return nodes, edges
+
+    def get(self, network_type, bbox):
+        """
+        Returns: (nodes, edges) of the cached network of bbox, or None.
+        """
+        graph = self._lookup_memory(network_type, bbox)
+        if graph is not None:
+            self._increment(self.memory_hits)
+            Metrics.CACHE_LOOKUPS.labels('network', 'memory_hit').inc()
+            return graph
+        graph = self._lookup_disk(network_type, bbox)
+        if graph is not None:
+            self._increment(self.disk_hits)
+            Metrics.CACHE_LOOKUPS.labels('network', 'disk_hit').inc()
+            return graph
+        self._increment(self.misses)
+        Metrics.CACHE_LOOKUPS.labels('network', 'miss').inc()
+        return None
+
+    def put(self, network_type, bbox, nodes, edges):
+        self._remember(network_type, bbox, nodes, edges)
+        filename = self._get_filename(network_type, bbox)
+        tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        try:
+            with open(tmp_filename, 'wb') as file:
+                pickle.dump((nodes, edges), file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_filename, filename)
+        finally:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+        self.evict_disk()
+
+    def evict_disk(self):
+        entries = []
+        for file in os.listdir(self.cache_dir):
+            if self._parse_filename(file) is None:
+                continue
+            try:
+                stat = os.stat(self.cache_dir + file)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, self.cache_dir + file))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total_bytes <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    def install(self):
+        """
+        Route NetworkInterface.load_network through this cache. Called
+        in each Consumer process, so the patch never leaves the worker.
+        """
+        cache = self
+        load_network = NetworkInterface.load_network
+
+        def cached_load_network(interface, primary_data, secondary_data, secondary_input, epsilon):
+            interface._try_create_cache()
+            interface._get_bbox(primary_data, secondary_data, secondary_input, epsilon)
+            graph = cache.get(interface.network_type, interface.bbox)
+            if graph is None:
+                load_network(interface, primary_data, secondary_data, secondary_input, epsilon)
+                cache.put(interface.network_type, interface.bbox, interface.nodes, interface.edges)
+                interface.edges = interface.edges.copy(deep=False)
+            else:
+                # shallow copies: TransitMatrix adds weight columns to the edges
+                interface.nodes = graph[0].copy(deep=False)
+                interface.edges = graph[1].copy(deep=False)
+
+        NetworkInterface.load_network = cached_load_network
+
+    def get_stats(self):
+        memory_hits = self.memory_hits.value
+        disk_hits = self.disk_hits.value
+        misses = self.misses.value
+        lookups = memory_hits + disk_hits + misses
+        return {'memory_hits': memory_hits,
+                'disk_hits': disk_hits,
+                'misses': misses,
+                'hit_rate': (memory_hits + disk_hits) / lookups if lookups else None,
+                'max_memory_bytes': self.max_memory_bytes,
+                'max_disk_bytes': self.max_disk_bytes}
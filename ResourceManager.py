@@ -1,50 +1,968 @@
+from collections import OrderedDict
 import uuid
 import os
+import fcntl
 import hashlib
-from multiprocessing import JoinableQueue
+from multiprocessing import Queue
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import itertools
+import threading
 import zipfile
+import queue
 import json
 import shutil
+import socket
+import random
+import time
 
 from Manifest import Manifest
+from SqliteManifest import SqliteManifest
+from JobQueue import JobQueue
+from SqliteJobQueue import SqliteJobQueue
+from MatrixCache import MatrixCache
+from NetworkCache import NetworkCache
 from Consumer import Consumer
+from Scheduler import Scheduler
+from EventBus import EventBus, TERMINAL_STATUSES
+from Job import Job
+from JobProgress import JobProgress
+from JobProfiler import JobProfiler
+from MatrixStore import MatrixStore
+from ResultsStore import ResultsStore
+from ResourceStore import ResourceStore
+import Metrics
+
+from ResourceManagerExceptions import UploadTooLargeException
+from ResourceManagerExceptions import MissingResourceException
+from ResourceManagerExceptions import MatrixStoreNotReadyException
+
+
+ARCHIVE_CODECS = {'stored': zipfile.ZIP_STORED,
+                  'deflated': zipfile.ZIP_DEFLATED,
+                  'bzip2': zipfile.ZIP_BZIP2,
+                  'lzma': zipfile.ZIP_LZMA}
 
 
 class ResourceManager:
-    def __init__(self, num_processes=2, resource_lifespan=86400, job_lifespan=86400):
+    chunk_size = 1 << 20
+    # elastic pool: grow when the oldest queued job has waited this long
+    # with every worker busy, shrink when a worker has been idle this
+    # long, and leave at least scale_interval seconds between changes
+    scale_up_wait = 30
+    scale_down_idle = 300
+    scale_interval = 10
+    # memory-mapped matrices kept open for /matrix lookups
+    max_open_matrix_stores = 32
+    # model results and aggregates kept in memory for paged reads
+    max_open_results_stores = 4
+    max_cached_aggregates = 64
+    # the sweeper deletes at most this many entries between lock
+    # releases, and access times are refreshed at most this often
+    sweep_batch_size = 100
+    touch_interval = 60
+    # how often nodes sharing a queue poll the manifest for status
+    # changes of the jobs their clients are waiting on
+    watch_interval = 1
+    # worker nodes send a heartbeat this often; the jobs of a node
+    # silent for node_timeout seconds are recovered by another node,
+    # and failed once they were lost max_attempts times
+    heartbeat_interval = 10
+    node_timeout = 60
+    max_attempts = 3
+
+    def __init__(self, num_processes=2, resource_lifespan=86400, job_lifespan=86400,
+                 manifest_backend='sqlite', max_file_size=536870912,
+                 archive_compression='deflated', archive_compresslevel=None,
+                 matrix_cache_dir='data/matrix_cache/', matrix_cache_size=10737418240,
+                 network_cache_dir='data/network_cache/', network_cache_memory=1073741824,
+                 network_cache_size=10737418240, job_timeout=None, worker_memory=None,
+                 min_processes=None, max_processes=None, results_format=None,
+                 resource_quota=None, job_quota=None, sweep_interval=60,
+                 role='all', queue_backend='sqlite', prefetch=None, tile_rows=None, drain_timeout=0,
+                 profile_rate=0):
+        if role != 'all' and queue_backend == 'memory':
+            raise ValueError('role {} needs a shared queue backend'.format(role))
         self.allowed_extensions = {'csv'}
         self.resource_lifespan = resource_lifespan
         self.job_lifespan = job_lifespan
         self.num_processes = num_processes
-        self.job_queue = None
-        self.consumers = None
-        self.manifest = Manifest()
+        self.min_processes = num_processes if min_processes is None else min_processes
+        self.max_processes = num_processes if max_processes is None else max_processes
+        self.max_file_size = max_file_size
+        self.archive_compression = ARCHIVE_CODECS[archive_compression]
+        self.archive_compresslevel = archive_compresslevel
+        self.results_format = results_format
+        # 'api' serves requests and enqueues jobs, 'worker' runs them,
+        # 'all' does both in one process
+        self.role = role
+        self.node_id = '{}-{}'.format(socket.gethostname(), uuid.uuid4().hex[:8])
+        self.queue_backend = queue_backend
+        self.job_queue = self.get_job_queue(queue_backend)
+        # jobs a worker node claims beyond the ones it can start at
+        # once, None to claim every queued job
+        self.prefetch = prefetch
+        # jobs with more source rows than this are split into tiles of
+        # this many rows, run in parallel; None to never split them
+        self.tile_rows = tile_rows
+        # job_id -> {'job', 'pending' (job_ids of its tiles not yet
+        # done), 'started_at'} of jobs this node split into tiles, kept
+        # until the job is merged
+        self.tiled_jobs = {}
+        self.scheduler = Scheduler()
+        self.event_bus = EventBus()
+        self.job_queues = {}
+        self.result_queue = None
+        self.consumers = {}
+        # slot -> (job, start time) of the job each Consumer is running,
+        # or None while it is idle
+        self.running_jobs = {}
+        self.idle_since = {}
+        self.slots = itertools.count()
+        self.last_scaled = 0
+        self.dispatcher = None
+        self.stopping = False
+        # seconds shutdown waits for running jobs to finish before
+        # returning them to the queue; no new jobs start meanwhile
+        self.drain_timeout = drain_timeout
+        self.draining = False
+        self.last_heartbeat = 0
+        # share of jobs run under the profiler, besides those whose
+        # orders ask for it
+        self.profile_rate = profile_rate
+        # wall-clock limit in seconds for every job, None for no limit
+        self.job_timeout = job_timeout
+        # memory budget in bytes of each Consumer, None to admit every job
+        self.worker_memory = worker_memory
+        if self.worker_memory is None:
+            host_memory = self.get_host_memory()
+            if host_memory is not None:
+                self.worker_memory = host_memory[0] // self.max_processes
+        # job_ids of dispatched jobs whose Consumer should be stopped
+        self.cancel_requests = set()
+        self.cancel_lock = threading.Lock()
+        self.manifest_backend = manifest_backend
+        self.manifest = self.get_manifest(manifest_backend)
+        self.matrix_cache = None
+        if matrix_cache_size > 0:
+            self.matrix_cache = MatrixCache(cache_dir=matrix_cache_dir, max_bytes=matrix_cache_size)
+        self.network_cache = None
+        if network_cache_size > 0:
+            self.network_cache = NetworkCache(cache_dir=network_cache_dir,
+                                              max_memory_bytes=network_cache_memory,
+                                              max_disk_bytes=network_cache_size)
+        # job_id -> MatrixStore, the most recently used last
+        self.matrix_stores = OrderedDict()
+        self.matrix_stores_lock = threading.Lock()
+        # job_id -> thread indexing the matrix of a job that finished
+        # before matrices were indexed at completion, and job_ids whose
+        # matrix could not be indexed
+        self.matrix_builds = {}
+        self.failed_matrix_builds = set()
+        # job_id -> ResultsStore, and job_id -> (mtime, aggregate), likewise
+        self.results_stores = OrderedDict()
+        self.aggregates = OrderedDict()
+        self.results_lock = threading.Lock()
+        # running hashes of chunked uploads handled by this process,
+        # keyed by upload_id: (hasher, bytes hashed so far)
+        self.upload_hashers = {}
+        # disk quotas in bytes of resources/ and jobs/, None for no quota
+        self.resource_quota = resource_quota
+        self.job_quota = job_quota
+        self.sweep_interval = sweep_interval
+        self.sweeper = None
+        self.watcher = None
+        self.stopped = threading.Event()
+        # held while the sweeper deletes resources and while jobs are
+        # enqueued or cancelled, so a resource cannot vanish under a new
+        # job and a coalesced job is not cancelled under a new handle
+        self.sweep_lock = threading.Lock()
+        # parses new uploads into their columnar form in a process of
+        # its own, started on the first upload, so a large upload does
+        # not hold up the request or the API's memory
+        self.ingester = None
+        self.ingester_lock = threading.Lock()
 
     def start(self):
         if not os.path.exists('resources/'):
             os.mkdir('resources/')
         if not os.path.exists('jobs/'):
             os.mkdir('jobs/')
-        self.job_queue = JoinableQueue()
-        self.consumers = [Consumer(self.job_queue, self.manifest) for _ in range(self.num_processes)]
-        for consumer in self.consumers:
-            consumer.start()
+        if not os.path.exists('uploads/'):
+            os.mkdir('uploads/')
+        # each Consumer gets its own queue so the dispatcher decides
+        # which job runs next, not whichever Consumer is first to read
+        self.result_queue = Queue()
+        self.event_bus.start()
+        if self.role in ('all', 'worker'):
+            for _ in range(min(max(self.num_processes, self.min_processes), self.max_processes)):
+                self._start_consumer(next(self.slots))
+            self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+            self.dispatcher.start()
+        if self.queue_backend != 'memory':
+            self.watcher = threading.Thread(target=self._watch, daemon=True)
+            self.watcher.start()
+        self.sweeper = threading.Thread(target=self._sweep_loop, daemon=True)
+        self.sweeper.start()
 
     def shutdown(self):
-        for consumer in self.consumers:
+        """
+        Stop without losing work: running jobs get drain_timeout seconds
+        to finish, then the ones still running are stopped and, with
+        the claimed jobs that never started, returned to the queue.
+        Resources, results and caches stay on disk.
+        """
+        if self.dispatcher is not None and self.drain_timeout:
+            self.draining = True
+            deadline = time.time() + self.drain_timeout
+            while self._is_busy() and time.time() < deadline:
+                time.sleep(0.5)
+        self.stopping = True
+        self._wake_dispatcher()
+        self.stopped.set()
+        for thread in [self.dispatcher, self.watcher, self.sweeper]:
+            if thread is not None:
+                thread.join()
+        self.event_bus.stop()
+        if self.ingester is not None:
+            # resources left unparsed are read from their csv
+            self.ingester.shutdown(wait=False, cancel_futures=True)
+        for consumer in self.consumers.values():
             consumer.terminate()
-        self._remove_all()
+        for consumer in self.consumers.values():
+            consumer.join()
+        self._checkpoint()
+
+    def _is_busy(self):
+        """
+        Returns: whether a job is running here, counting a job split
+            into tiles as running from its first tile until it is merged.
+        """
+        return any(running_job is not None for running_job in list(self.running_jobs.values())) or \
+            any(tiled_job['started_at'] is not None for tiled_job in list(self.tiled_jobs.values()))
+
+    def _has_started(self, job):
+        tiled_job = self.tiled_jobs.get(job.parent_id or job.job_id)
+        return tiled_job is not None and tiled_job['started_at'] is not None
+
+    def _checkpoint(self):
+        """
+        Called once the Consumers are stopped: return every job this
+        node claimed to the queue, the interrupted ones reset to run
+        again from the start. The in-memory queue ends with this
+        process, so its jobs are failed instead.
+        """
+        if self.queue_backend == 'memory':
+            for job in self.job_queue.get_jobs():
+                self._publish(self.manifest.add_job_exception(job.job_id, 'server shut down before the job finished',
+                                                              status='failed', from_statuses=('enqueued', 'running')),
+                              'failed')
+            return
+        interrupted = {running_job[0].parent_id or running_job[0].job_id
+                       for running_job in self.running_jobs.values() if running_job is not None}
+        interrupted.update(job_id for job_id, tiled_job in self.tiled_jobs.items()
+                           if tiled_job['started_at'] is not None)
+        for job_id in interrupted:
+            self._reset_job(job_id)
+        queued = {job.parent_id or job.job_id for job in self.scheduler.get_jobs()}
+        self.job_queue.release(list(interrupted | queued))
+        self.job_queue.remove_node(self.node_id)
+
+    def _reset_job(self, job_id):
+        """
+        Remove what an interrupted job wrote and mark it enqueued, so
+        it runs again from the start.
+        """
+        self._forget_open_results(job_id)
+        shutil.rmtree('jobs/' + job_id, ignore_errors=True)
+        self._publish(self.manifest.update_job_status(job_id, 'enqueued', from_statuses=('running',)), 'enqueued')
+
+    def _heartbeat(self):
+        """
+        Tell nodes sharing the queue that this one is alive, and take
+        over the jobs claimed by nodes that are not: those that were
+        lost max_attempts times fail, the others are reset and queued
+        again.
+        """
+        now = time.time()
+        if now - self.last_heartbeat < self.heartbeat_interval:
+            return
+        self.last_heartbeat = now
+        self.job_queue.heartbeat(self.node_id)
+        for job, attempts, cancel_requested in self.job_queue.recover(self.node_id, self.node_timeout):
+            job_status = self.manifest.get_job_status(job.job_id)
+            if job_status not in ('enqueued', 'running'):
+                # ended, or was deleted, before its node was lost
+                self.job_queue.finish(job.job_id)
+            elif cancel_requested:
+                self._cancel_queued_job(job.job_id)
+            elif attempts >= self.max_attempts:
+                self.job_queue.finish(job.job_id)
+                self._publish(self.manifest.add_job_exception(job.job_id,
+                                                              'worker node lost {} times'.format(attempts),
+                                                              status='failed', from_statuses=('enqueued', 'running')),
+                              'failed')
+                Metrics.JOBS_RECOVERED.labels('failed').inc()
+            else:
+                self._reset_job(job.job_id)
+                self.job_queue.release([job.job_id])
+                Metrics.JOBS_RECOVERED.labels('retried').inc()
+
+    def _start_consumer(self, slot):
+        # always a fresh queue: one a killed Consumer was reading
+        # from may be left locked
+        self.job_queues[slot] = Queue()
+        self.consumers[slot] = Consumer(self.job_queues[slot], self.manifest,
+                                        archive_compression=self.archive_compression,
+                                        archive_compresslevel=self.archive_compresslevel,
+                                        matrix_cache=self.matrix_cache,
+                                        network_cache=self.network_cache,
+                                        result_queue=self.result_queue,
+                                        event_queue=self.event_bus.queue,
+                                        results_format=self.results_format,
+                                        slot=slot)
+        self.consumers[slot].start()
+        self.running_jobs[slot] = None
+        self.idle_since[slot] = time.time()
+
+    def _stop_consumer(self, slot):
+        consumer = self.consumers.pop(slot)
+        del self.job_queues[slot]
+        del self.running_jobs[slot]
+        del self.idle_since[slot]
+        consumer.terminate()
+        consumer.join(5)
+        if consumer.is_alive():
+            consumer.kill()
+            consumer.join()
+        Metrics.mark_process_dead(consumer.pid)
+
+    def _replace_consumer(self, slot):
+        self._stop_consumer(slot)
+        self._start_consumer(slot)
+
+    def _dispatch(self):
+        """
+        Dispatcher thread: hands the next scheduled job to each idle
+        Consumer, records how long finished jobs took, and supervises
+        the running ones.
+        """
+        while not self.stopping:
+            self._heartbeat()
+            self._supervise()
+            self._scale()
+            self._claim_jobs()
+            self._assign_jobs()
+            self.update_metrics()
+            try:
+                message = self.result_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if message is None:
+                # woken up by a new job
+                continue
+            slot, job_id, duration = message
+            running_job = self.running_jobs.get(slot)
+            if running_job is None or running_job[0].job_id != job_id:
+                # sent by a Consumer that was replaced since
+                continue
+            self.running_jobs[slot] = None
+            self.idle_since[slot] = time.time()
+            if running_job[0].num_tiles is None or running_job[0].parent_id is not None:
+                # the merge of a tiled job is not what its cost measures
+                self.scheduler.record_completion(running_job[0].cost, duration)
+            self._finish_task(running_job[0])
+
+    def _wake_dispatcher(self):
+        if self.dispatcher is not None:
+            self.result_queue.put(None)
+
+    def _claim_jobs(self):
+        """
+        Move jobs from the queue to this node's scheduler: all of them,
+        or with prefetch set only enough to keep every worker busy and
+        prefetch more waiting, leaving the rest to other worker nodes.
+        """
+        if self.draining:
+            return
+        limit = None
+        if self.prefetch is not None:
+            busy = sum(1 for running_job in self.running_jobs.values() if running_job is not None)
+            limit = self.max_processes - busy + self.prefetch - len(self.scheduler)
+            if limit <= 0:
+                return
+        for job in self.job_queue.claim(self.node_id, limit):
+            for task in self._split_job(job):
+                self.scheduler.push(task)
+
+    def _split_job(self, job):
+        """
+        Returns: the tasks a claimed job runs as: tiles of at most
+            tile_rows source rows if it has more and needs a matrix that
+            is not cached, else the job itself.
+        """
+        # released back to the queue after this node split it
+        job.num_tiles = None
+        if self.tile_rows is None or job.primary_rows <= self.tile_rows or not job.matrix_cells:
+            return [job]
+        if job.orders['init_kwargs'].get('network_type') == 'otp':
+            # travel times are read from a file, not computed
+            return [job]
+        cache_key = Consumer.get_matrix_cache_key(job, self.manifest, self.matrix_cache)
+        if cache_key is not None and self.matrix_cache.contains(cache_key):
+            return [job]
+        tiles = job.split(self.tile_rows)
+        self.tiled_jobs[job.job_id] = {'job': job,
+                                       'pending': {tile.job_id for tile in tiles},
+                                       'started_at': None}
+        return tiles
+
+    def _finish_task(self, job):
+        """
+        Called when a job, or a tile of one, leaves its Consumer. Once
+        the last tile of a job is done the job is queued again to merge
+        them, unless it was cancelled or failed: then the tiles still
+        queued are dropped and the running ones stopped, as cancel_job
+        does.
+        """
+        if job.parent_id is None:
+            self.tiled_jobs.pop(job.job_id, None)
+            self.job_queue.finish(job.job_id)
+            return
+        tiled_job = self.tiled_jobs.get(job.parent_id)
+        if tiled_job is None:
+            return
+        pending = tiled_job['pending']
+        pending.discard(job.job_id)
+        if self.manifest.get_job_status(job.parent_id) != 'running':
+            for tile_id in list(pending):
+                if self.scheduler.remove(tile_id) is not None:
+                    pending.discard(tile_id)
+            if pending:
+                # left to _supervise, which finishes each running tile it stops
+                with self.cancel_lock:
+                    self.cancel_requests.add(job.parent_id)
+            else:
+                self._finish_task(tiled_job['job'])
+        elif not pending:
+            self.scheduler.push(tiled_job['job'])
+
+    def _publish(self, job_ids, job_status):
+        for job_id in job_ids:
+            self.event_bus.publish(job_id, job_status)
+
+    def _cancel_queued_job(self, job_id):
+        self.tiled_jobs.pop(job_id, None)
+        self.job_queue.finish(job_id)
+        # a queued tiled job waiting to be merged is already running
+        self._publish(self.manifest.update_job_status(job_id, 'cancelled', from_statuses=('enqueued', 'running')),
+                      'cancelled')
+
+    def _cancel_tiles(self, job_id):
+        """
+        Cancel a job split into tiles: drop its queued tiles, and let
+        _supervise stop the running ones.
+        """
+        self._publish(self.manifest.update_job_status(job_id, 'cancelled', from_statuses=('enqueued', 'running')),
+                      'cancelled')
+        tiled_job = self.tiled_jobs[job_id]
+        for tile_id in list(tiled_job['pending']):
+            if self.scheduler.remove(tile_id) is not None:
+                tiled_job['pending'].discard(tile_id)
+        if not tiled_job['pending']:
+            self._finish_task(tiled_job['job'])
+
+    def get_job_timeout(self, job):
+        timeouts = [timeout for timeout in [job.timeout, self.job_timeout] if timeout]
+        return min(timeouts) if timeouts else None
+
+    def _supervise(self):
+        """
+        Replace any Consumer whose job was cancelled, ran past its
+        timeout, or that died (e.g. killed for running out of memory),
+        and record the outcome. Status updates are conditional, so a
+        job that finished in the meantime keeps its results.
+        """
+        with self.cancel_lock:
+            cancel_requests = self.cancel_requests
+            self.cancel_requests = set()
+        # cancelled through an API process on another host
+        cancel_requests |= self.job_queue.get_cancel_requests(self.node_id)
+        for job_id in cancel_requests:
+            if self.scheduler.remove(job_id) is not None:
+                self._cancel_queued_job(job_id)
+            elif job_id in self.tiled_jobs:
+                self._cancel_tiles(job_id)
+        now = time.time()
+        for slot in list(self.consumers):
+            consumer = self.consumers[slot]
+            if self.running_jobs[slot] is None:
+                if not consumer.is_alive():
+                    self._replace_consumer(slot)
+                continue
+            job, start_time = self.running_jobs[slot]
+            timeout = self.get_job_timeout(job)
+            # a tile stands for the job it belongs to, timed from its first tile
+            job_id = job.parent_id or job.job_id
+            if job_id in self.tiled_jobs:
+                start_time = self.tiled_jobs[job_id]['started_at']
+            if job_id in cancel_requests:
+                self._replace_consumer(slot)
+                self._publish(self.manifest.update_job_status(job_id, 'cancelled',
+                                                              from_statuses=('enqueued', 'running')),
+                              'cancelled')
+                self._finish_task(job)
+            elif timeout is not None and now - start_time > timeout:
+                self._replace_consumer(slot)
+                self._publish(self.manifest.add_job_exception(job_id,
+                                                              'job exceeded timeout of {} seconds'.format(timeout),
+                                                              status='timed_out',
+                                                              from_statuses=('enqueued', 'running')),
+                              'timed_out')
+                self._finish_task(job)
+            elif not consumer.is_alive():
+                exitcode = consumer.exitcode
+                self._replace_consumer(slot)
+                self._publish(self.manifest.add_job_exception(job_id,
+                                                              'worker exited with code {}'.format(exitcode),
+                                                              status='failed', from_statuses=('enqueued', 'running')),
+                              'failed')
+                self._finish_task(job)
+
+    def _scale(self):
+        """
+        Grow the pool by one Consumer when jobs are queued, every worker
+        is busy, and the queue is at least as deep as the pool or its
+        oldest job has waited scale_up_wait seconds, provided the host
+        has a worker's memory budget available. Shrink it by one idle
+        Consumer when the queue is empty and the worker has idled for
+        scale_down_idle seconds, or at once when available memory drops
+        below half a budget. The gap between the two memory thresholds
+        and scale_interval keep the pool from flapping.
+        """
+        now = time.time()
+        if now - self.last_scaled < self.scale_interval:
+            return
+        size = len(self.consumers)
+        idle_slots = sorted((self.idle_since[slot], slot) for slot, running_job in self.running_jobs.items()
+                            if running_job is None)
+        queued_jobs = len(self.scheduler) + len(self.job_queue)
+        oldest_wait = self.scheduler.get_oldest_wait()
+        host_memory = self.get_host_memory()
+        available_memory = None if host_memory is None else host_memory[1]
+        budget = self.worker_memory or Job.base_memory_bytes
+
+        if queued_jobs and not idle_slots and size < self.max_processes and \
+                (queued_jobs >= size or oldest_wait >= self.scale_up_wait):
+            if available_memory is None or available_memory >= budget:
+                self._start_consumer(next(self.slots))
+                self.last_scaled = now
+            return
+        if idle_slots and size > self.min_processes:
+            idle_since, slot = idle_slots[0]
+            low_memory = available_memory is not None and available_memory < budget / 2
+            if low_memory or (not queued_jobs and now - idle_since >= self.scale_down_idle):
+                self._stop_consumer(slot)
+                self.last_scaled = now
+
+    def update_metrics(self):
+        running_jobs = list(self.running_jobs.values())
+        busy = sum(1 for running_job in running_jobs if running_job is not None)
+        queued_jobs = len(self.scheduler)
+        if self.queue_backend == 'memory':
+            # a shared queue would be counted once per worker node
+            queued_jobs += len(self.job_queue)
+        Metrics.QUEUE_DEPTH.set(queued_jobs)
+        Metrics.WORKERS.labels('busy').set(busy)
+        Metrics.WORKERS.labels('idle').set(len(running_jobs) - busy)
+        Metrics.MANIFEST_BYTES.labels(self.manifest_backend).set(self.manifest.get_size())
+
+    def get_pool_stats(self):
+        running_jobs = list(self.running_jobs.values())
+        host_memory = self.get_host_memory()
+        return {'role': self.role,
+                'node_id': self.node_id,
+                'size': len(running_jobs),
+                'min_size': self.min_processes,
+                'max_size': self.max_processes,
+                'busy': sum(1 for running_job in running_jobs if running_job is not None),
+                'idle': sum(1 for running_job in running_jobs if running_job is None),
+                'queued_jobs': len(self.scheduler) + len(self.job_queue),
+                'oldest_wait': self.scheduler.get_oldest_wait(),
+                'worker_memory': self.worker_memory,
+                'reserved_memory': self.get_reserved_memory(),
+                'available_memory': None if host_memory is None else host_memory[1]}
+
+    @staticmethod
+    def get_host_memory():
+        """
+        Returns: (total, available) memory of the host in bytes, or
+            None where /proc/meminfo is not available.
+        """
+        try:
+            with open('/proc/meminfo') as file:
+                meminfo = dict(line.split(':', 1) for line in file)
+            return (int(meminfo['MemTotal'].split()[0]) * 1024,
+                    int(meminfo['MemAvailable'].split()[0]) * 1024)
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def get_reserved_memory(self):
+        return sum(running_job[0].peak_memory_bytes for running_job in list(self.running_jobs.values())
+                   if running_job is not None)
+
+    def admit_job(self, job):
+        """
+        Returns: how the job is admitted given its estimated peak memory:
+            'rejected' if it cannot fit even on an otherwise idle pool,
+            'routed' if it needs more than one worker's budget and will
+            run once enough of the pool's memory is free,
+            'deferred' if it fits one worker but must wait for running
+            jobs to release memory, else 'accepted'.
+        """
+        if self.worker_memory is None:
+            return 'accepted'
+        if job.peak_memory_bytes > self.worker_memory * self.max_processes:
+            return 'rejected'
+        if job.peak_memory_bytes > self.worker_memory:
+            return 'routed'
+        if not self._fits_memory(job):
+            return 'deferred'
+        return 'accepted'
+
+    def _fits_memory(self, job):
+        """
+        Returns: whether the job can start now without the pool going
+            over its memory budget or the host running out of memory.
+        """
+        if self.worker_memory is None:
+            return True
+        reserved_memory = self.get_reserved_memory()
+        if reserved_memory + job.peak_memory_bytes > self.worker_memory * self.max_processes:
+            return False
+        if reserved_memory == 0:
+            # never hold back a job that fits the budget on an idle pool
+            return True
+        host_memory = self.get_host_memory()
+        return host_memory is None or job.peak_memory_bytes <= host_memory[1]
+
+    def _assign_jobs(self):
+        for slot in list(self.consumers):
+            if self.running_jobs[slot] is not None:
+                continue
+            # jobs that do not fit in the free memory are deferred, and
+            # smaller ones behind them may start first
+            if self.draining:
+                # only the tiles and merges of jobs already running
+                job = self.scheduler.pop(accept=lambda job: self._has_started(job) and self._fits_memory(job))
+            else:
+                job = self.scheduler.pop(accept=self._fits_memory)
+            if job is None:
+                return
+            self.running_jobs[slot] = (job, time.time())
+            self.job_queues[slot].put(job)
+            tiled_job = self.tiled_jobs.get(job.parent_id or job.job_id)
+            if tiled_job is None:
+                Metrics.QUEUE_WAIT.observe(time.time() - job.enqueued_at)
+            elif tiled_job['started_at'] is None:
+                # the wait of a tiled job ends with its first tile
+                tiled_job['started_at'] = time.time()
+                Metrics.QUEUE_WAIT.observe(time.time() - job.enqueued_at)
+
+    @staticmethod
+    def get_manifest(manifest_backend):
+        if manifest_backend == 'sqlite':
+            return SqliteManifest()
+        elif manifest_backend == 'json':
+            return Manifest()
+        raise ValueError('unknown manifest backend: {}'.format(manifest_backend))
+
+    @staticmethod
+    def get_job_queue(queue_backend):
+        if queue_backend == 'sqlite':
+            return SqliteJobQueue()
+        elif queue_backend == 'memory':
+            return JobQueue()
+        raise ValueError('unknown queue backend: {}'.format(queue_backend))
 
     def get_job_status(self, job_id):
         return self.manifest.get_job_status(job_id)
 
+    def get_cache_stats(self):
+        stats = {}
+        if self.matrix_cache is not None:
+            stats['matrix'] = self.matrix_cache.get_stats()
+        if self.network_cache is not None:
+            stats['network'] = self.network_cache.get_stats()
+        return stats
+
+    def _check_resources(self, jobs):
+        """
+        Called with sweep_lock held: make sure the jobs' resources were
+        not swept since the jobs were parsed, and mark them as used.
+        Raises:
+            MissingResourceException: a resource no longer exists.
+        """
+        for job in jobs:
+            for resource_id in [job.primary_resource_id, job.secondary_resource_id]:
+                if resource_id is None:
+                    continue
+                if not self._touch('resources/' + resource_id):
+                    raise MissingResourceException(resource_id)
+
+    def get_fingerprint(self, job):
+        """
+        Returns: the job's fingerprint over its resources' hashes, or
+            None if a resource has no hash.
+        """
+        primary_hash = self.manifest.get_resource_hash(job.primary_resource_id)
+        secondary_hash = None
+        if job.secondary_resource_id is not None:
+            secondary_hash = self.manifest.get_resource_hash(job.secondary_resource_id)
+            if secondary_hash is None:
+                return None
+        if primary_hash is None:
+            return None
+        return job.get_fingerprint(primary_hash, secondary_hash)
+
+    def _coalesce(self, job, fingerprint):
+        """
+        Called with sweep_lock held: attach job to an identical job that
+        is queued, running or finished with its results still on disk,
+        as an alias that follows its status and shares its folder.
+        Returns: the job_id whose folder it shares, or None.
+        """
+        if fingerprint is None:
+            return None
+        existing_id = self.manifest.find_job(fingerprint, ('enqueued', 'running', 'finished'))
+        if existing_id is None:
+            return None
+        folder_id = self.get_job_folder_id(existing_id)
+        if self.manifest.get_job_status(existing_id) == 'finished':
+            if not os.path.exists('jobs/' + folder_id):
+                return None
+        elif folder_id not in self.get_active_references()[0]:
+            # left behind by a server that stopped before running it
+            return None
+        job_status = self.manifest.add_job_alias(job.job_id, existing_id)
+        if job_status is None:
+            return None
+        self.event_bus.publish(job.job_id, job_status)
+        Metrics.JOBS_COALESCED.labels(job_status).inc()
+        return folder_id
+
+    def _sample_profile(self, job):
+        if not job.profile and self.profile_rate and random.random() < self.profile_rate:
+            job.profile = True
+
     def add_job_to_queue(self, job):
-        self.manifest.add_job(job.job_id)
-        self.job_queue.put(job)
+        """
+        Enqueue a job, unless an identical one is queued, running or
+        finished: then job becomes another handle on that job.
+        Returns: the job_id job was coalesced with, or None.
+        Raises:
+            MissingResourceException: a resource of the job was swept.
+        """
+        with self.sweep_lock:
+            self._check_resources([job])
+            fingerprint = self.get_fingerprint(job)
+            existing_id = self._coalesce(job, fingerprint)
+            if existing_id is not None:
+                return existing_id
+            self._sample_profile(job)
+            self.manifest.add_job(job.job_id, fingerprint)
+            self.event_bus.publish(job.job_id, 'enqueued')
+            self.job_queue.push([job])
+        self._wake_dispatcher()
+        return None
+
+    def add_jobs_to_queue(self, jobs):
+        """
+        Enqueue jobs together: the new ones are recorded in the manifest
+        in one transaction, so either all of them are visible or none.
+        Jobs identical to an existing job, or to an earlier job of the
+        batch, are coalesced with it instead.
+        Returns: for each job, the job_id it was coalesced with, or None.
+        Raises:
+            MissingResourceException: a resource of a job was swept.
+        """
+        with self.sweep_lock:
+            self._check_resources(jobs)
+            coalesced_with = []
+            new_jobs = []
+            new_fingerprints = []
+            # fingerprint -> job_id of the first new job of the batch with it
+            batch_job_ids = {}
+            batch_aliases = []
+            for job in jobs:
+                fingerprint = self.get_fingerprint(job)
+                existing_id = batch_job_ids.get(fingerprint)
+                if existing_id is not None:
+                    batch_aliases.append((job, existing_id))
+                else:
+                    existing_id = self._coalesce(job, fingerprint)
+                    if existing_id is None:
+                        new_jobs.append(job)
+                        new_fingerprints.append(fingerprint)
+                        if fingerprint is not None:
+                            batch_job_ids[fingerprint] = job.job_id
+                coalesced_with.append(existing_id)
+            self.manifest.add_jobs([job.job_id for job in new_jobs], new_fingerprints)
+            for job in new_jobs:
+                self._sample_profile(job)
+                self.event_bus.publish(job.job_id, 'enqueued')
+            for job, existing_id in batch_aliases:
+                self.manifest.add_job_alias(job.job_id, existing_id)
+                self.event_bus.publish(job.job_id, 'enqueued')
+                Metrics.JOBS_COALESCED.labels('enqueued').inc()
+            self.job_queue.push(new_jobs)
+        self._wake_dispatcher()
+        return coalesced_with
+
+    def wait_for_job_status(self, job_id, known_status=None, timeout=30):
+        """
+        Block until the job leaves known_status (its current status if
+        omitted) or timeout seconds pass.
+        Returns: the latest known status of the job.
+        """
+        if known_status is None:
+            known_status = self.event_bus.get_status(job_id) or self.get_job_status(job_id)
+        if known_status in TERMINAL_STATUSES:
+            return known_status
+        return self.event_bus.wait_for_change(job_id, known_status, timeout)
+
+    def subscribe_to_jobs(self, job_ids):
+        return self.event_bus.subscribe(job_ids)
+
+    def unsubscribe_from_jobs(self, subscription):
+        self.event_bus.unsubscribe(subscription)
+
+    def get_job_statuses(self, job_ids):
+        return self.manifest.get_job_statuses(job_ids)
+
+    def cancel_job(self, job_id):
+        """
+        Returns: None if the job does not exist, False if it already
+            ended, else True. A queued job is cancelled at once, a
+            running one when the dispatcher stops its Consumer. A job
+            other handles are coalesced onto keeps running for them,
+            and only this handle is cancelled.
+        """
+        with self.sweep_lock:
+            job_status = self.manifest.get_job_status(job_id)
+            if job_status is None:
+                return None
+            folder_id = self.get_job_folder_id(job_id)
+            if job_status in ('enqueued', 'running') and self._has_other_handles(folder_id, job_id):
+                self._publish(self.manifest.update_job_status(job_id, 'cancelled', from_statuses=('enqueued', 'running'),
+                                                              with_aliases=False),
+                              'cancelled')
+                return True
+        if self.job_queue.remove(folder_id) or self.scheduler.remove(folder_id) is not None:
+            self._cancel_queued_job(folder_id)
+            return True
+        if job_status not in ('enqueued', 'running'):
+            return False
+        # claimed by a worker node, which may be this one
+        self.job_queue.request_cancel(folder_id)
+        with self.cancel_lock:
+            self.cancel_requests.add(folder_id)
+        self._wake_dispatcher()
+        return True
+
+    def _has_other_handles(self, folder_id, job_id):
+        """
+        Returns: whether a handle on the job computing into folder_id,
+            other than job_id, is still waiting for it.
+        """
+        job_ids = [folder_id] + self.manifest.get_job_aliases(folder_id)
+        statuses = self.manifest.get_job_statuses([other_id for other_id in job_ids if other_id != job_id])
+        return any(job_status in ('enqueued', 'running') for job_status, _ in statuses.values())
+
+    def get_job_folder_id(self, job_id):
+        """
+        Returns: the job_id whose folder holds the results of job_id,
+            which differs from it for a job coalesced onto another.
+        """
+        folder_id = self.manifest.get_job_folder_id(job_id)
+        if folder_id is None:
+            return job_id
+        return folder_id
+
+    def get_queue_position(self, job_id):
+        """
+        Returns: (number of jobs ahead, estimated start time as a unix
+            timestamp) for a queued job, or None if it is not queued.
+            The start time is None until a job has completed and the
+            scheduler has learned how long jobs take.
+        """
+        job_id = self.get_job_folder_id(job_id)
+        position = self.scheduler.get_position(job_id)
+        tiled_job = self.tiled_jobs.get(job_id)
+        if position is None and tiled_job is not None:
+            # a job split into tiles starts with its first tile
+            positions = [self.scheduler.get_position(tile_id) for tile_id in list(tiled_job['pending'])]
+            position = min((position for position in positions if position is not None), default=None)
+        if position is None:
+            jobs_ahead = self.job_queue.get_position(job_id)
+            if jobs_ahead is None:
+                return None
+            # not claimed by a worker node yet, so there is no estimate
+            return jobs_ahead + len(self.scheduler), None
+        jobs_ahead, cost_ahead = position
+        queued_seconds = self.scheduler.estimate_duration(cost_ahead)
+        if queued_seconds is None:
+            return jobs_ahead, None
+        now = time.time()
+        running_seconds = 0
+        running_jobs = list(self.running_jobs.values())
+        for running_job in running_jobs:
+            if running_job is not None:
+                job, start_time = running_job
+                running_seconds += max(0, self.scheduler.estimate_duration(job.cost) - (now - start_time))
+        return jobs_ahead, now + (running_seconds + queued_seconds) / max(len(running_jobs), 1)
+
+    def get_job_progress(self, job_id):
+        return JobProgress.load('jobs/' + self.get_job_folder_id(job_id) + '/')
+
+    def get_estimated_finish_time(self, job_id):
+        """
+        Returns: estimated unix time a running job finishes, or None if
+            it is not running here or no estimate is available yet.
+        """
+        job_id = self.get_job_folder_id(job_id)
+        for running_job in list(self.running_jobs.values()):
+            if running_job is not None and running_job[0].job_id == job_id:
+                job, start_time = running_job
+                duration = self.scheduler.estimate_duration(job.cost)
+                if duration is None:
+                    return None
+                return max(start_time + duration, time.time())
+        return None
+
+    def _forget_open_results(self, job_id):
+        with self.matrix_stores_lock:
+            self.matrix_stores.pop(job_id, None)
+            self.failed_matrix_builds.discard(job_id)
+        with self.results_lock:
+            # keyed by (job_id, model), model being None but for pipelines
+            for key in [key for key in self.results_stores if key[0] == job_id]:
+                del self.results_stores[key]
+            for key in [key for key in self.aggregates if key[0] == job_id]:
+                del self.aggregates[key]
 
     def delete_job_results(self, job_id):
-        self.manifest.delete_job(job_id)
-        path = 'jobs/' + job_id
+        """
+        Delete a job, and its folder unless other handles coalesced
+        onto the same job still use it.
+        Returns: whether anything was deleted.
+        """
+        folder_id = self.get_job_folder_id(job_id)
+        deleted = self.manifest.delete_job(job_id)
+        if self.manifest.count_job_references(folder_id):
+            return deleted
+        self._forget_open_results(folder_id)
+        path = 'jobs/' + folder_id
         if os.path.exists(path):
             try:
                 shutil.rmtree(path)
@@ -53,42 +971,389 @@ class ResourceManager:
                 return False
         return False
 
+    @staticmethod
+    def _touch(path):
+        """
+        Mark a resource or job folder as used: the sweeper evicts the
+        least recently modified first.
+        Returns: False if path does not exist.
+        """
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def touch_job(self, job_id):
+        """
+        Mark a job folder as read, at most once per touch_interval: the
+        folder's own mtime tells when it was last touched, so nothing
+        is kept per job in the process.
+        """
+        path = 'jobs/' + job_id
+        try:
+            if time.time() - os.stat(path).st_mtime < self.touch_interval:
+                return
+        except FileNotFoundError:
+            return
+        self._touch(path)
+
+    def get_active_references(self):
+        """
+        Returns: (job_ids, resource_ids) of the jobs queued or running
+            on any node sharing the queue, which the sweeper must not
+            delete.
+        """
+        jobs = self.scheduler.get_jobs()
+        jobs += [running_job[0] for running_job in list(self.running_jobs.values()) if running_job is not None]
+        job_ids, resource_ids = self.job_queue.get_references()
+        job_ids.update(job.parent_id or job.job_id for job in jobs)
+        resource_ids.update(resource_id for job in jobs
+                            for resource_id in [job.primary_resource_id, job.secondary_resource_id]
+                            if resource_id is not None)
+        return job_ids, resource_ids
+
+    @staticmethod
+    def _remove_resource_file(resource_id):
+        try:
+            os.remove('resources/' + resource_id)
+        except FileNotFoundError:
+            pass
+        ResourceStore.remove(resource_id)
+
     def delete_expired_resources(self):
-        expired_resources = self.manifest.delete_expired_resources(self.resource_lifespan)
-        for resource_id in expired_resources:
-            try:
-                shutil.rmtree('resources/' + resource_id)
-            except:
-                pass
+        """
+        Returns: number of resources deleted.
+        """
+        deleted = 0
+        while not self.stopping:
+            with self.sweep_lock:
+                _, active_resources = self.get_active_references()
+                expired_resources = self.manifest.delete_expired_resources(self.resource_lifespan,
+                                                                           exclude=active_resources,
+                                                                           limit=self.sweep_batch_size)
+                for resource_id in expired_resources:
+                    self._remove_resource_file(resource_id)
+            deleted += len(expired_resources)
+            if len(expired_resources) < self.sweep_batch_size:
+                break
+        return deleted
 
     def delete_expired_jobs(self):
-        expired_jobs = self.manifest.delete_expired_jobs(self.job_lifespan)
-        for job_id in expired_jobs:
-            try:
-                shutil.rmtree('jobs/' + job_id)
-            except:
-                pass
+        """
+        Returns: number of jobs deleted.
+        """
+        deleted = 0
+        while not self.stopping:
+            active_jobs, _ = self.get_active_references()
+            expired_jobs = self.manifest.delete_expired_jobs(self.job_lifespan, exclude=active_jobs,
+                                                             limit=self.sweep_batch_size)
+            # a coalesced job's folder goes with its last handle
+            for folder_id in {folder_id for _, folder_id in expired_jobs}:
+                if folder_id not in active_jobs and not self.manifest.count_job_references(folder_id):
+                    self._forget_open_results(folder_id)
+                    shutil.rmtree('jobs/' + folder_id, ignore_errors=True)
+            deleted += len(expired_jobs)
+            if len(expired_jobs) < self.sweep_batch_size:
+                break
+        return deleted
 
     @staticmethod
-    def get_zip_filename(job_id):
-        folder = 'jobs/' + job_id + '/'
-        if not os.path.exists(folder):
+    def _get_usage(directory, folders):
+        """
+        Returns: (total bytes, [(mtime, bytes, name)] least recently
+            used first) of the files, or folders, in directory.
+        """
+        entries = []
+        for entry in os.scandir(directory):
+            try:
+                if folders and entry.is_dir():
+                    size = sum(os.path.getsize(os.path.join(root, filename))
+                               for root, _, filenames in os.walk(entry.path) for filename in filenames)
+                elif not folders and entry.is_file():
+                    size = entry.stat().st_size
+                else:
+                    continue
+                entries.append((entry.stat().st_mtime, size, entry.name))
+            except FileNotFoundError:
+                # deleted while scanning
+                continue
+        entries.sort()
+        return sum(entry[1] for entry in entries), entries
+
+    def evict_resources(self):
+        """
+        Delete the least recently used resources until resources/ fits
+        resource_quota. Resources of queued and running jobs are kept,
+        and files the manifest does not know about (uploads still being
+        registered) are only removed once older than resource_lifespan.
+        Returns: number of resources deleted.
+        """
+        _, entries = self._get_usage('resources/', folders=False)
+        # a resource's columnar copy goes with it
+        entries = [(mtime, size + ResourceStore.get_size(resource_id), resource_id)
+                   for mtime, size, resource_id in entries]
+        total = sum(entry[1] for entry in entries)
+        Metrics.DISK_BYTES.labels('resources').set(total)
+        if self.resource_quota is None or total <= self.resource_quota:
+            return 0
+        deleted = 0
+        cutoff = time.time() - self.resource_lifespan
+        for start in range(0, len(entries), self.sweep_batch_size):
+            if self.stopping or total <= self.resource_quota:
+                break
+            with self.sweep_lock:
+                _, active_resources = self.get_active_references()
+                for mtime, size, resource_id in entries[start:start + self.sweep_batch_size]:
+                    if total <= self.resource_quota:
+                        break
+                    if resource_id in active_resources:
+                        continue
+                    if not self.manifest.remove_resource(resource_id) and mtime > cutoff:
+                        continue
+                    self._remove_resource_file(resource_id)
+                    total -= size
+                    deleted += 1
+        Metrics.DISK_BYTES.labels('resources').set(total)
+        return deleted
+
+    def evict_jobs(self):
+        """
+        Delete the results of the least recently used jobs until jobs/
+        fits job_quota. Jobs that are queued or running are kept.
+        Returns: number of jobs deleted.
+        """
+        total, entries = self._get_usage('jobs/', folders=True)
+        Metrics.DISK_BYTES.labels('jobs').set(total)
+        if self.job_quota is None or total <= self.job_quota:
+            return 0
+        deleted = 0
+        for start in range(0, len(entries), self.sweep_batch_size):
+            if self.stopping or total <= self.job_quota:
+                break
+            batch = entries[start:start + self.sweep_batch_size]
+            active_jobs, _ = self.get_active_references()
+            statuses = self.manifest.get_job_statuses([job_id for _, _, job_id in batch])
+            for _, size, job_id in batch:
+                if total <= self.job_quota:
+                    break
+                job_status = statuses.get(job_id, (None, None))[0]
+                if job_id in active_jobs or job_status in ('enqueued', 'running'):
+                    continue
+                for alias_id in self.manifest.get_job_aliases(job_id):
+                    self.delete_job_results(alias_id)
+                self.delete_job_results(job_id)
+                total -= size
+                deleted += 1
+        Metrics.DISK_BYTES.labels('jobs').set(total)
+        return deleted
+
+    def delete_abandoned_uploads(self):
+        """
+        Delete chunked uploads that have not received a chunk for
+        resource_lifespan seconds.
+        Returns: number of uploads deleted.
+        """
+        deleted = 0
+        cutoff = time.time() - self.resource_lifespan
+        for entry in os.scandir('uploads/'):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    self.upload_hashers.pop(entry.name, None)
+                    deleted += 1
+            except FileNotFoundError:
+                continue
+        return deleted
+
+    def sweep(self):
+        """
+        One pass of the sweeper: delete expired resources and jobs, then
+        evict the least recently used ones while resources/ or jobs/ is
+        over its quota, then abandoned uploads. Deletions happen in
+        batches of sweep_batch_size, releasing sweep_lock in between, so
+        job submissions are never held up for long.
+        """
+        for kind, reason, sweep_step in [('resource', 'expired', self.delete_expired_resources),
+                                         ('job', 'expired', self.delete_expired_jobs),
+                                         ('resource', 'quota', self.evict_resources),
+                                         ('job', 'quota', self.evict_jobs),
+                                         ('upload', 'abandoned', self.delete_abandoned_uploads)]:
+            deleted = sweep_step()
+            if deleted:
+                Metrics.SWEPT.labels(kind, reason).inc(deleted)
+
+    def _sweep_loop(self):
+        """
+        Sweeper thread: runs sweep every sweep_interval seconds.
+        """
+        while not self.stopping:
+            try:
+                self.sweep()
+            except Exception as exception:
+                print('sweep failed:', str(exception))
+            self.stopped.wait(self.sweep_interval)
+
+    def _watch(self):
+        """
+        Watcher thread of nodes sharing a queue: Consumers on other
+        hosts cannot reach this process's EventBus, so publish the
+        status changes they record in the manifest to local waiters
+        and subscribers.
+        """
+        while not self.stopping:
+            job_ids = self.event_bus.get_watched_job_ids()
+            try:
+                statuses = self.manifest.get_job_statuses(job_ids) if job_ids else {}
+            except Exception as exception:
+                print('status watch failed:', str(exception))
+                statuses = {}
+            for job_id, (job_status, _) in statuses.items():
+                if job_status != self.event_bus.get_status(job_id):
+                    self.event_bus.publish(job_id, job_status)
+            self.stopped.wait(self.watch_interval)
+
+    def get_zip_filename(self, job_id):
+        """
+        Returns: the results archive built by the Consumer when the job
+            finished, or None if there is none (yet).
+        """
+        folder_id = self.get_job_folder_id(job_id)
+        folder = 'jobs/' + folder_id + '/'
+        zip_filename = folder + folder_id + '.zip'
+        if os.path.exists(zip_filename):
+            self.touch_job(folder_id)
+            return zip_filename
+        if not os.path.exists(folder) or self.get_job_status(job_id) != 'finished':
             return None
+        # jobs that finished before archives were built at completion
+        return Consumer.build_archive(folder, folder_id, self.archive_compression,
+                                      self.archive_compresslevel)
 
-        zip_filename = folder + job_id + '.zip'
-        zip = zipfile.ZipFile(zip_filename, 'w')
-        for file in os.listdir(folder):
-            if not file.endswith('.zip'):
-                zip.write(folder + file)
+    def get_profile_filename(self, job_id):
+        """
+        Returns: the archive of the profile written while the job ran, or
+            None if it was not profiled or has not finished a run yet.
+        """
+        folder_id = self.get_job_folder_id(job_id)
+        folder = 'jobs/' + folder_id + '/'
+        if not os.path.exists(folder):
+            return None
+        zip_filename = JobProfiler.build_archive(folder)
+        if zip_filename is not None:
+            self.touch_job(folder_id)
         return zip_filename
 
+    def _build_matrix_store(self, folder_id):
+        folder = 'jobs/' + folder_id + '/'
+        try:
+            MatrixStore.build(folder + 'output.csv', folder)
+        except Exception as exception:
+            print('failed to index matrix of {}: {}'.format(folder_id, exception))
+            with self.matrix_stores_lock:
+                self.failed_matrix_builds.add(folder_id)
+        finally:
+            with self.matrix_stores_lock:
+                del self.matrix_builds[folder_id]
+
+    def get_matrix_store(self, job_id):
+        """
+        Returns: the memory-mapped matrix of a finished matrix job, or
+            None if the job has none. Open stores are kept for reuse.
+        Raises:
+            MatrixStoreNotReadyException: the job finished before
+                matrices were indexed at completion, and its matrix is
+                being indexed in the background.
+        """
+        folder_id = self.get_job_folder_id(job_id)
+        self.touch_job(folder_id)
+        with self.matrix_stores_lock:
+            if folder_id in self.matrix_stores:
+                self.matrix_stores.move_to_end(folder_id)
+                return self.matrix_stores[folder_id]
+            building = folder_id in self.matrix_builds
+        folder = 'jobs/' + folder_id + '/'
+        if building:
+            raise MatrixStoreNotReadyException()
+        if not MatrixStore.exists(folder):
+            if not os.path.exists(folder + 'output.csv') or self.get_job_status(job_id) != 'finished':
+                return None
+            # converting the whole output.csv takes too long for a request
+            with self.matrix_stores_lock:
+                if folder_id in self.failed_matrix_builds:
+                    return None
+                if folder_id not in self.matrix_builds:
+                    self.matrix_builds[folder_id] = threading.Thread(target=self._build_matrix_store,
+                                                                     args=(folder_id,), daemon=True)
+                    self.matrix_builds[folder_id].start()
+            raise MatrixStoreNotReadyException()
+        store = MatrixStore(folder)
+        with self.matrix_stores_lock:
+            self.matrix_stores[folder_id] = store
+            while len(self.matrix_stores) > self.max_open_matrix_stores:
+                self.matrix_stores.popitem(last=False)
+        return store
+
     @staticmethod
-    def get_aggregated_data(job_id):
-        filename = 'jobs/' + job_id + '/aggregate.json'
-        if not os.path.exists(filename):
+    def get_results_folder(folder_id, model=None):
+        """
+        Returns: the folder of a job's model results: the job folder,
+            or for one model of a pipeline its folder within it.
+        """
+        if model is None:
+            return 'jobs/' + folder_id + '/'
+        return 'jobs/' + folder_id + '/' + model + '/'
+
+    def get_results_store(self, job_id, model=None):
+        """
+        Returns: the results of a finished model job, or of one model
+            of a pipeline, loaded for paged reads, or None if there are
+            none.
+        """
+        folder_id = self.get_job_folder_id(job_id)
+        key = (folder_id, model)
+        self.touch_job(folder_id)
+        with self.results_lock:
+            if key in self.results_stores:
+                self.results_stores.move_to_end(key)
+                return self.results_stores[key]
+        folder = self.get_results_folder(folder_id, model)
+        if not ResultsStore.exists(folder) or self.get_job_status(job_id) != 'finished':
+            return None
+        store = ResultsStore(folder)
+        with self.results_lock:
+            self.results_stores[key] = store
+            while len(self.results_stores) > self.max_open_results_stores:
+                self.results_stores.popitem(last=False)
+        return store
+
+    def get_columnar_results_filename(self, job_id, model=None):
+        return ResultsStore.get_columnar_filename(self.get_results_folder(self.get_job_folder_id(job_id), model))
+
+    def get_aggregated_data(self, job_id, model=None):
+        """
+        Returns: the aggregate of the job, or of one model of a
+            pipeline, parsed once and kept until the file changes.
+        """
+        folder_id = self.get_job_folder_id(job_id)
+        key = (folder_id, model)
+        filename = self.get_results_folder(folder_id, model) + 'aggregate.json'
+        try:
+            mtime = os.stat(filename).st_mtime
+        except FileNotFoundError:
             return None
+        self.touch_job(folder_id)
+        with self.results_lock:
+            if key in self.aggregates and self.aggregates[key][0] == mtime:
+                self.aggregates.move_to_end(key)
+                return self.aggregates[key][1]
         with open(filename) as file:
-            return json.load(file)
+            aggregate = json.load(file)
+        with self.results_lock:
+            self.aggregates[key] = (mtime, aggregate)
+            while len(self.aggregates) > self.max_cached_aggregates:
+                self.aggregates.popitem(last=False)
+        return aggregate
 
     @staticmethod
     def job_id_is_safe(job_id):
@@ -99,32 +1364,205 @@ class ResourceManager:
         return uuid.uuid4().hex
 
     @staticmethod
-    def get_resource_hash(resource_id):
-        filename = 'resources/' + resource_id
+    def get_new_upload_id():
+        return uuid.uuid4().hex
+
+    @classmethod
+    def get_file_hash(cls, filename):
         if not os.path.exists(filename):
             return None
-        block_size = 1024
         m = hashlib.sha256()
         with open(filename, "rb") as file:
-            byte = file.read(block_size)
-            while byte != b"":
-                m.update(byte)
-                byte = file.read(block_size)
+            block = file.read(cls.chunk_size)
+            while block != b"":
+                m.update(block)
+                block = file.read(cls.chunk_size)
 
         return m.hexdigest()
 
+    @classmethod
+    def get_resource_hash(cls, resource_id):
+        return cls.get_file_hash('resources/' + resource_id)
+
+    def _copy_stream(self, stream, file, hasher, written):
+        """
+        Copy stream to file in chunk_size blocks, hashing as it goes.
+        Returns: total bytes in file.
+        Raises:
+            UploadTooLargeException: file would exceed max_file_size.
+        """
+        start_time = time.time()
+        received = 0
+        try:
+            block = stream.read(self.chunk_size)
+            while block:
+                written += len(block)
+                received += len(block)
+                if written > self.max_file_size:
+                    raise UploadTooLargeException(str(written))
+                file.write(block)
+                hasher.update(block)
+                block = stream.read(self.chunk_size)
+        finally:
+            Metrics.UPLOAD_BYTES.inc(received)
+            Metrics.UPLOAD_DURATION.observe(time.time() - start_time)
+        return written
+
+    def store_resource(self, stream):
+        """
+        Stream an upload to disk in a single pass, hashing it on the
+        way, and register it.
+        Returns: the resource_id holding the uploaded bytes.
+        """
+        resource_id = self.get_new_resource_id()
+        filename = 'resources/' + resource_id
+        hasher = hashlib.sha256()
+        try:
+            with open(filename, 'wb') as file:
+                self._copy_stream(stream, file, hasher, 0)
+        except BaseException:
+            os.remove(filename)
+            raise
+        return self._register_resource(resource_id, hasher.hexdigest())
+
     def add_resource(self, resource_id):
         resource_hash = self.get_resource_hash(resource_id)
-        self.manifest.add_resource(resource_id, resource_hash)
+        return self._register_resource(resource_id, resource_hash)
+
+    def _register_resource(self, resource_id, resource_hash):
+        """
+        If identical bytes are already stored, the new copy is discarded
+        and the existing resource_id is returned instead. New resources
+        are parsed once, in the background, into their columnar form.
+        """
+        existing_id = self.manifest.add_resource(resource_id, resource_hash)
+        if existing_id != resource_id:
+            os.remove('resources/' + resource_id)
+            self._touch('resources/' + existing_id)
+        else:
+            self._ingest(resource_id)
+        return existing_id
+
+    def _ingest(self, resource_id):
+        """
+        Queue a new resource to be parsed by the ingester. Until it is
+        done, jobs over the resource count its rows and skip the schema
+        checks, and Consumers parse its csv.
+        """
+        with self.ingester_lock:
+            for _ in range(2):
+                if self.ingester is None:
+                    self.ingester = ProcessPoolExecutor(max_workers=1, initializer=ResourceStore.init_ingester)
+                try:
+                    future = self.ingester.submit(ResourceStore.ingest, resource_id)
+                    break
+                except BrokenProcessPool:
+                    # the ingester died, e.g. out of memory on a large upload
+                    self.ingester = None
+            else:
+                return
+        future.add_done_callback(lambda future: self._ingest_done(resource_id, future))
+
+    @staticmethod
+    def _ingest_done(resource_id, future):
+        if future.cancelled():
+            return
+        exception = future.exception()
+        if exception is not None:
+            print('failed to parse resource {}: {!r}'.format(resource_id, exception))
+
+    def start_upload(self):
+        upload_id = self.get_new_upload_id()
+        open('uploads/' + upload_id, 'wb').close()
+        self.upload_hashers[upload_id] = (hashlib.sha256(), 0)
+        return upload_id
+
+    @staticmethod
+    def get_upload_offset(upload_id):
+        filename = 'uploads/' + upload_id
+        if not os.path.exists(filename):
+            return None
+        return os.path.getsize(filename)
+
+    def append_upload_chunk(self, upload_id, offset, stream):
+        """
+        Append a chunk to a partial upload. The chunk is only accepted
+        if it starts where the stored bytes end, so a client resumes by
+        asking for the current offset and re-sending from there.
+        Returns: the new offset, or None if the upload does not exist.
+        Raises:
+            ValueError: offset does not match the stored size.
+            UploadTooLargeException: upload would exceed max_file_size.
+        """
+        filename = 'uploads/' + upload_id
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'ab') as file:
+            # flock serializes appends to one upload across threads and processes
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                current_offset = os.fstat(file.fileno()).st_size
+                if offset != current_offset:
+                    raise ValueError(current_offset)
+                hasher, hashed = self.upload_hashers.get(upload_id, (None, None))
+                if hashed != current_offset:
+                    # chunks were received by another process, hash at finish instead
+                    hasher = hashlib.sha256()
+                    self.upload_hashers.pop(upload_id, None)
+                try:
+                    self._copy_stream(stream, file, hasher, current_offset)
+                except UploadTooLargeException:
+                    file.flush()
+                    file.truncate(current_offset)
+                    self.upload_hashers.pop(upload_id, None)
+                    raise
+                finally:
+                    # on a dropped connection keep what arrived so the client can resume
+                    file.flush()
+                    new_offset = os.fstat(file.fileno()).st_size
+                    if hashed == current_offset and upload_id in self.upload_hashers:
+                        self.upload_hashers[upload_id] = (hasher, new_offset)
+                return new_offset
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def finish_upload(self, upload_id):
+        """
+        Move a completed chunked upload into resources/ and register it.
+        Returns: the resource_id, or None if the upload does not exist.
+        """
+        filename = 'uploads/' + upload_id
+        if not os.path.exists(filename):
+            return None
+        hasher, hashed = self.upload_hashers.pop(upload_id, (None, None))
+        if hashed == os.path.getsize(filename):
+            resource_hash = hasher.hexdigest()
+        else:
+            resource_hash = self.get_file_hash(filename)
+        resource_id = self.get_new_resource_id()
+        os.replace(filename, 'resources/' + resource_id)
+        return self._register_resource(resource_id, resource_hash)
+
+    def abort_upload(self, upload_id):
+        self.upload_hashers.pop(upload_id, None)
+        filename = 'uploads/' + upload_id
+        if not os.path.exists(filename):
+            return False
+        os.remove(filename)
+        return True
 
     def delete_resource(self, resource_id):
-        self.manifest.delete_resource(resource_id)
-        filepath = 'resources/' + resource_id
-        if not os.path.exists(filepath):
+        remaining_references = self.manifest.delete_resource(resource_id)
+        if remaining_references is None:
             return False
-        os.remove(filepath)
+        if remaining_references == 0:
+            self._remove_resource_file(resource_id)
         return True
 
+    @staticmethod
+    def get_resource_schema(resource_id):
+        return ResourceStore.load_schema(resource_id)
+
     def extension_is_allowed(self, filename):
         if '.' not in filename:
             return False
@@ -132,15 +1570,11 @@ class ResourceManager:
         return extension in self.allowed_extensions
 
     def resource_id_exists(self, resource_id):
-        return self.manifest.resource_exists(resource_id)
+        if not self.manifest.resource_exists(resource_id):
+            return False
+        # clients check before reusing a resource
+        self._touch('resources/' + resource_id)
+        return True
 
     def resource_hash_exists(self, resource_hash):
         return self.manifest.resource_hash_exists(resource_hash)
-
-    def _remove_all(self):
-        self.manifest.clear()
-        shutil.rmtree('resources/')
-        shutil.rmtree('jobs/')
-        if os.path.exists('data/'):
-            if os.path.exists('data/osm_query_cache'):
-                shutil.rmtree('data/osm_query_cache')
\ No newline at end of file
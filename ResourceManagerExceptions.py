@@ -26,3 +26,18 @@ class MissingColumnNamesException(ResourceManagerBaseException):
 class MissingResourceException(ResourceManagerBaseException):
     """Missing resource"""
     pass
+
+
+class UploadTooLargeException(ResourceManagerBaseException):
+    """Upload exceeds max file size"""
+    pass
+
+
+class TileMismatchException(ResourceManagerBaseException):
+    """Tiles of a job have different destinations"""
+    pass
+
+
+class MatrixStoreNotReadyException(ResourceManagerBaseException):
+    """Matrix of a finished job is still being indexed"""
+    pass
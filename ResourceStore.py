@@ -0,0 +1,171 @@
+import pandas as pd
+import signal
+import json
+import time
+import os
+
+import Metrics
+
+
+class ResourceStore:
+    """
+    Parse-once form of uploaded resources. Each upload is read with
+    pandas.read_csv by the ingester process after it is registered;
+    the DataFrame is pickled to
+    resources/columnar/<resource_id>.pkl and its schema (row count and,
+    per column, dtype, nulls and numeric range) written next to it.
+    Job validates orders against the schema at submit time, and
+    Consumers read the pickle instead of parsing the csv again.
+    """
+    folder = 'resources/columnar/'
+    resource_folder = 'resources/'
+
+    @classmethod
+    def get_columnar_filename(cls, resource_id):
+        return cls.folder + resource_id + '.pkl'
+
+    @classmethod
+    def get_schema_filename(cls, resource_id):
+        return cls.folder + resource_id + '.json'
+
+    @staticmethod
+    def get_column_schema(column):
+        schema = {'name': str(column.name),
+                  'dtype': str(column.dtype),
+                  'nulls': int(column.isna().sum())}
+        if column.dtype.kind in 'iuf' and schema['nulls'] < len(column):
+            schema['min'] = float(column.min())
+            schema['max'] = float(column.max())
+        return schema
+
+    @staticmethod
+    def init_ingester():
+        """
+        Run first in the ingester process: like a Consumer, it leaves
+        interrupts and shutdown to the server that started it.
+        """
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    @classmethod
+    def ingest(cls, resource_id):
+        """
+        Parse a resource and store its columnar copy and schema. A file
+        pandas cannot parse gets a schema holding only the error, so
+        jobs over it are rejected at submit time.
+        Returns: the schema.
+        """
+        if not os.path.exists(cls.folder):
+            os.makedirs(cls.folder, exist_ok=True)
+        start_time = time.time()
+        try:
+            data = pd.read_csv(cls.resource_folder + resource_id)
+        except (ValueError, UnicodeDecodeError) as exception:
+            schema = {'error': str(exception)}
+        else:
+            schema = {'rows': len(data),
+                      'columns': [cls.get_column_schema(data[column]) for column in data.columns]}
+            tmp_filename = '{}.{}.tmp'.format(cls.get_columnar_filename(resource_id), os.getpid())
+            data.to_pickle(tmp_filename)
+            os.replace(tmp_filename, cls.get_columnar_filename(resource_id))
+        tmp_filename = '{}.{}.tmp'.format(cls.get_schema_filename(resource_id), os.getpid())
+        with open(tmp_filename, 'w') as file:
+            json.dump(schema, file)
+        os.replace(tmp_filename, cls.get_schema_filename(resource_id))
+        if not os.path.exists(cls.resource_folder + resource_id):
+            # deleted while it was being parsed
+            cls.remove(resource_id)
+        Metrics.INGEST_DURATION.observe(time.time() - start_time)
+        return schema
+
+    @classmethod
+    def load_schema(cls, resource_id):
+        """
+        Returns: the schema of a resource, or None if it is not parsed
+            yet or was stored before resources were ingested. The file
+            is small, so it is read on every call rather than kept.
+        """
+        try:
+            with open(cls.get_schema_filename(resource_id)) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    @classmethod
+    def get_size(cls, resource_id):
+        size = 0
+        for filename in [cls.get_columnar_filename(resource_id), cls.get_schema_filename(resource_id)]:
+            try:
+                size += os.path.getsize(filename)
+            except FileNotFoundError:
+                pass
+        return size
+
+    @classmethod
+    def remove(cls, resource_id):
+        for filename in [cls.get_columnar_filename(resource_id), cls.get_schema_filename(resource_id)]:
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def write_rows(cls, resource_id, start, end, filename):
+        """
+        Write rows start to end (exclusive) of a resource, with its
+        header, to a csv of their own.
+        """
+        data = pd.read_csv(cls.resource_folder + resource_id)
+        data.iloc[start:end].to_csv(filename, index=False)
+
+    @staticmethod
+    def validate_columns(schema, column_names, resource_name):
+        """
+        Returns: why column_names (hint -> column, e.g. primary_hints or
+            source_column_names) do not fit the resource, or None. lat
+            and lon must name numeric columns within range.
+        """
+        if schema is None:
+            return None
+        if 'error' in schema:
+            return '{} not parsable: {}'.format(resource_name, schema['error'])
+        if not isinstance(column_names, dict):
+            return None
+        columns = {column['name']: column for column in schema['columns']}
+        for hint, name in column_names.items():
+            if not isinstance(name, str):
+                continue
+            if name not in columns:
+                return 'column {} ({}) not in {}'.format(name, hint, resource_name)
+            limit = {'lat': 90, 'lon': 180}.get(hint)
+            if limit is None:
+                continue
+            column = columns[name]
+            if 'min' not in column:
+                return 'column {} ({}) of {} is not numeric'.format(name, hint, resource_name)
+            if column['min'] < -limit or column['max'] > limit:
+                return 'column {} ({}) of {} is out of range'.format(name, hint, resource_name)
+        return None
+
+    @classmethod
+    def install(cls):
+        """
+        Serve pandas.read_csv(<resource>) from the columnar copy. Called
+        in each Consumer process, so the patch never leaves the worker.
+        Calls with any other arguments parse the csv as before.
+        """
+        read_csv = pd.read_csv
+
+        def columnar_read_csv(filepath_or_buffer, *args, **kwargs):
+            if not args and not kwargs and isinstance(filepath_or_buffer, str) and \
+                    filepath_or_buffer.startswith(cls.resource_folder):
+                resource_id = filepath_or_buffer[len(cls.resource_folder):]
+                try:
+                    data = pd.read_pickle(cls.get_columnar_filename(resource_id))
+                    Metrics.CACHE_LOOKUPS.labels('columnar', 'hit').inc()
+                    return data
+                except Exception:
+                    Metrics.CACHE_LOOKUPS.labels('columnar', 'miss').inc()
+            return read_csv(filepath_or_buffer, *args, **kwargs)
+
+        pd.read_csv = columnar_read_csv
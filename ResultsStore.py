@@ -0,0 +1,125 @@
+import pandas as pd
+import os
+
+try:
+    import pyarrow
+    import pyarrow.feather
+except ImportError:
+    pyarrow = None
+
+
+COLUMNAR_FILENAMES = {'parquet': 'results.parquet',
+                      'arrow': 'results.arrow'}
+
+OPERATORS = {'lt': lambda column, value: column < value,
+             'le': lambda column, value: column <= value,
+             'gt': lambda column, value: column > value,
+             'ge': lambda column, value: column >= value,
+             'eq': lambda column, value: column == value,
+             'ne': lambda column, value: column != value}
+
+
+class ResultsStore:
+    """
+    Model results of one job, loaded once (from the columnar copy when
+    there is one, else from results.csv) and kept in memory to serve
+    paged and filtered reads.
+    """
+    csv_filename = 'results.csv'
+
+    def __init__(self, job_folder):
+        self.results = self.load(job_folder)
+        self.results.index = self.results.index.astype(str)
+        self.results.index.name = 'source'
+
+    @classmethod
+    def exists(cls, job_folder):
+        return os.path.exists(job_folder + cls.csv_filename)
+
+    @staticmethod
+    def get_columnar_filename(job_folder):
+        """
+        Returns: the columnar copy of the results, or None.
+        """
+        for filename in COLUMNAR_FILENAMES.values():
+            if os.path.exists(job_folder + filename):
+                return job_folder + filename
+        return None
+
+    @classmethod
+    def load(cls, job_folder):
+        columnar_filename = cls.get_columnar_filename(job_folder)
+        if columnar_filename is not None and pyarrow is not None:
+            if columnar_filename.endswith('.parquet'):
+                return pd.read_parquet(columnar_filename)
+            return pyarrow.feather.read_table(columnar_filename).to_pandas()
+        return pd.read_csv(job_folder + cls.csv_filename, index_col=0)
+
+    @staticmethod
+    def write_columnar(results, job_folder, results_format):
+        """
+        Write a columnar copy of a model's results next to results.csv.
+        Returns: the filename written, or None if pyarrow is missing.
+        """
+        if pyarrow is None:
+            print('pyarrow is not installed, skipping {} results'.format(results_format))
+            return None
+        filename = job_folder + COLUMNAR_FILENAMES[results_format]
+        tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        if results_format == 'parquet':
+            results.to_parquet(tmp_filename)
+        else:
+            pyarrow.feather.write_feather(pyarrow.Table.from_pandas(results), tmp_filename)
+        os.replace(tmp_filename, filename)
+        return filename
+
+    @staticmethod
+    def coerce_value(column, value):
+        """
+        Returns: value, given as a string, converted to the type of the
+            column's values.
+        Raises:
+            ValueError: value is not comparable to the column.
+        """
+        try:
+            if pd.api.types.is_bool_dtype(column):
+                if value.lower() not in ('true', 'false'):
+                    raise ValueError(value)
+                return value.lower() == 'true'
+            if pd.api.types.is_numeric_dtype(column):
+                return float(value)
+        except ValueError:
+            raise ValueError('value for {} not comparable'.format(column.name))
+        return value
+
+    def query(self, sources=None, columns=None, filters=None, offset=0, limit=1000):
+        """
+        Returns: (number of matching rows, the requested page of them).
+            filters is a list of (column, operator, value), with
+            operator one of OPERATORS and value a string converted to
+            the column's type.
+        Raises:
+            KeyError: unknown column or operator.
+            ValueError: a filter value is not comparable to its column.
+        """
+        results = self.results
+        if sources is not None:
+            results = results[results.index.isin(sources)]
+        for column, operator, value in filters or []:
+            compare = OPERATORS[operator]
+            value = self.coerce_value(results[column], value)
+            try:
+                results = results[compare(results[column], value)]
+            except TypeError:
+                raise ValueError('value for {} not comparable'.format(column))
+        if columns is not None:
+            missing = [column for column in columns if column not in results.columns]
+            if missing:
+                raise KeyError(missing[0])
+            results = results[columns]
+        return len(results), results.iloc[offset:offset + limit]
+
+    @staticmethod
+    def to_records(page):
+        page = page.astype(object).where(page.notna(), None)
+        return [{'source': source, **values} for source, values in zip(page.index, page.to_dict('records'))]
@@ -0,0 +1,197 @@
+from collections import OrderedDict
+import itertools
+import threading
+import heapq
+import time
+
+
+class Scheduler:
+    """
+    Orders queued jobs for dispatch to the Consumers.
+
+    - Higher job.priority is always dispatched first.
+    - Among jobs of equal priority, clients share the workers fairly:
+      each client accrues virtual time equal to the estimated cost of
+      the work dispatched for it, and the client with the least virtual
+      time goes next. A client that was idle rejoins at the current
+      minimum, so it cannot bank credit.
+    - Within a client, cheaper jobs go first, so short jobs overtake
+      long ones; a job that has waited longer than starvation_seconds
+      is dispatched ahead of its client's cheaper jobs.
+    """
+    def __init__(self, starvation_seconds=3600):
+        self.starvation_seconds = starvation_seconds
+        self.lock = threading.Lock()
+        self.jobs = {}
+        # client_id -> heap of (-priority, cost, sequence, job_id)
+        self.queues = {}
+        # client_id -> OrderedDict of job_id -> enqueue time, oldest first
+        self.arrivals = {}
+        self.virtual_times = {}
+        self.sequence = itertools.count()
+        self.version = 0
+        self._order = None
+        # learned from completed jobs, used for start time estimates
+        self.seconds_per_cost = None
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __contains__(self, job_id):
+        return job_id in self.jobs
+
+    def _min_virtual_time(self):
+        active = [self.virtual_times[client_id] for client_id in self.queues]
+        return min(active) if active else 0.0
+
+    def push(self, job):
+        with self.lock:
+            client_id = job.client_id
+            if client_id not in self.queues:
+                self.virtual_times[client_id] = max(self.virtual_times.get(client_id, 0.0),
+                                                    self._min_virtual_time())
+                self.queues[client_id] = []
+                self.arrivals[client_id] = OrderedDict()
+            if job.enqueued_at is None:
+                job.enqueued_at = time.time()
+            self.jobs[job.job_id] = job
+            heapq.heappush(self.queues[client_id], (-job.priority, job.cost, next(self.sequence), job.job_id))
+            self.arrivals[client_id][job.job_id] = job.enqueued_at
+            self.version += 1
+
+    def _head(self, queues, arrivals, client_id, now):
+        """
+        Returns: the job_id this client would dispatch next.
+        """
+        heap = queues[client_id]
+        while heap[0][3] not in arrivals[client_id]:
+            heapq.heappop(heap)
+        oldest_id, enqueued_at = next(iter(arrivals[client_id].items()))
+        if now - enqueued_at > self.starvation_seconds:
+            return oldest_id
+        return heap[0][3]
+
+    def _select(self, queues, arrivals, virtual_times, now):
+        best = None
+        for client_id in queues:
+            job = self.jobs[self._head(queues, arrivals, client_id, now)]
+            key = (-job.priority, virtual_times[client_id], job.cost, job.enqueued_at)
+            if best is None or key < best[0]:
+                best = (key, client_id, job)
+        _, client_id, job = best
+        del arrivals[client_id][job.job_id]
+        virtual_times[client_id] += job.cost
+        if not arrivals[client_id]:
+            del queues[client_id]
+            del arrivals[client_id]
+        return job
+
+    def _discard(self, job):
+        del self.jobs[job.job_id]
+        self.version += 1
+
+    def pop(self, accept=None):
+        """
+        Returns: the next job to dispatch, or None if the queue is empty.
+            If accept is given, only a job for which accept(job) is true
+            is dispatched, skipping over the others unless the next job
+            in line has waited longer than starvation_seconds.
+        """
+        with self.lock:
+            if accept is None:
+                if not self.jobs:
+                    return None
+                job = self._select(self.queues, self.arrivals, self.virtual_times, time.time())
+                self._discard(job)
+                return job
+            for position, job in enumerate(self._get_order()):
+                if position == 0 and not accept(job) and \
+                        time.time() - job.enqueued_at > self.starvation_seconds:
+                    # stop other jobs overtaking a starving one for good
+                    return None
+                if accept(job):
+                    self._remove(job.job_id)
+                    client_id = job.client_id
+                    self.virtual_times[client_id] = self.virtual_times.get(client_id, 0.0) + job.cost
+                    return job
+            return None
+
+    def _remove(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        self._discard(job)
+        arrivals = self.arrivals[job.client_id]
+        del arrivals[job_id]
+        if not arrivals:
+            del self.queues[job.client_id]
+            del self.arrivals[job.client_id]
+        return job
+
+    def get_jobs(self):
+        """
+        Returns: a snapshot of the queued jobs.
+        """
+        with self.lock:
+            return list(self.jobs.values())
+
+    def remove(self, job_id):
+        """
+        Returns: the removed job, or None if it is not queued.
+        """
+        with self.lock:
+            return self._remove(job_id)
+
+    def _get_order(self):
+        """
+        Returns: queued jobs in the order they would be dispatched,
+            memoized until the queue changes.
+        """
+        if self._order is None or self._order[0] != self.version:
+            queues = {client_id: list(heap) for client_id, heap in self.queues.items()}
+            arrivals = {client_id: OrderedDict(jobs) for client_id, jobs in self.arrivals.items()}
+            virtual_times = dict(self.virtual_times)
+            now = time.time()
+            order = []
+            while queues:
+                order.append(self._select(queues, arrivals, virtual_times, now))
+            self._order = (self.version, order, {job.job_id: position for position, job in enumerate(order)})
+        return self._order[1]
+
+    def get_position(self, job_id):
+        """
+        Returns: (number of jobs ahead, total estimated cost of those
+            jobs), or None if the job is not queued.
+        """
+        with self.lock:
+            if job_id not in self.jobs:
+                return None
+            order = self._get_order()
+            position = self._order[2][job_id]
+            return position, sum(job.cost for job in order[:position])
+
+    def get_oldest_wait(self):
+        """
+        Returns: seconds the longest waiting job has been queued, 0 if
+            the queue is empty.
+        """
+        with self.lock:
+            if not self.arrivals:
+                return 0
+            oldest = min(next(iter(jobs.values())) for jobs in self.arrivals.values())
+        return time.time() - oldest
+
+    def record_completion(self, cost, duration):
+        if cost <= 0:
+            return
+        with self.lock:
+            seconds_per_cost = duration / cost
+            if self.seconds_per_cost is None:
+                self.seconds_per_cost = seconds_per_cost
+            else:
+                self.seconds_per_cost = 0.8 * self.seconds_per_cost + 0.2 * seconds_per_cost
+
+    def estimate_duration(self, cost):
+        if self.seconds_per_cost is None:
+            return None
+        return cost * self.seconds_per_cost
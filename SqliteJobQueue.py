@@ -0,0 +1,197 @@
+from contextlib import contextmanager
+import threading
+import sqlite3
+import pickle
+import time
+import os
+
+
+TABLES = [
+    '''CREATE TABLE IF NOT EXISTS queue (
+        job_id TEXT PRIMARY KEY,
+        priority INTEGER NOT NULL,
+        enqueued_at REAL NOT NULL,
+        primary_resource_id TEXT,
+        secondary_resource_id TEXT,
+        node_id TEXT,
+        cancel_requested INTEGER NOT NULL DEFAULT 0,
+        job BLOB NOT NULL)''',
+    '''CREATE TABLE IF NOT EXISTS nodes (
+        node_id TEXT PRIMARY KEY,
+        heartbeat REAL NOT NULL)''',
+]
+
+# columns added after the initial schema, created on existing databases
+COLUMNS = [
+    ('queue', 'attempts', 'INTEGER NOT NULL DEFAULT 0'),
+]
+
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS queue_order ON queue (node_id, priority, enqueued_at)',
+]
+
+
+class SqliteJobQueue:
+    """
+    JobQueue backed by an SQLite database in WAL mode, so API processes
+    enqueue jobs that worker processes on other hosts claim. Every host
+    must see the same database file, and the same resources/ and jobs/
+    folders. Jobs are stored pickled, and stay queued across restarts.
+    Worker nodes send heartbeats, so the jobs claimed by a node that
+    died can be recovered by another one, or by itself once restarted.
+    """
+    def __init__(self, filename='queue.db'):
+        self.filename = filename
+        self._local = threading.local()
+        with self._transaction() as connection:
+            for statement in TABLES:
+                connection.execute(statement)
+            for table, column, declaration in COLUMNS:
+                existing = [row[1] for row in connection.execute('PRAGMA table_info({})'.format(table))]
+                if column not in existing:
+                    connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, declaration))
+            for statement in INDEXES:
+                connection.execute(statement)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connect(self):
+        # one connection per (process, thread), as in SqliteManifest
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.filename, timeout=30,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM queue WHERE node_id IS NULL').fetchone()[0]
+
+    def push(self, jobs):
+        rows = []
+        for job in jobs:
+            job.enqueued_at = time.time()
+            rows.append((job.job_id, job.priority, job.enqueued_at, job.primary_resource_id,
+                         job.secondary_resource_id, pickle.dumps(job)))
+        with self._transaction() as connection:
+            connection.executemany('INSERT INTO queue (job_id, priority, enqueued_at, primary_resource_id, '
+                                   'secondary_resource_id, job) VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def claim(self, node_id, limit=None):
+        """
+        Returns: up to limit unclaimed jobs, highest priority and then
+            longest waiting first, now claimed by node_id.
+        """
+        # polled by every worker's dispatcher, so only take the write
+        # lock when there is something to claim
+        if self._connect().execute('SELECT 1 FROM queue WHERE node_id IS NULL LIMIT 1').fetchone() is None:
+            return []
+        with self._transaction() as connection:
+            rows = connection.execute('SELECT job_id, job FROM queue WHERE node_id IS NULL '
+                                      'ORDER BY priority DESC, enqueued_at LIMIT ?',
+                                      (-1 if limit is None else limit,)).fetchall()
+            connection.executemany('UPDATE queue SET node_id = ? WHERE job_id = ?',
+                                   [(node_id, row[0]) for row in rows])
+        return [pickle.loads(row[1]) for row in rows]
+
+    def release(self, job_ids):
+        """
+        Return claimed jobs that never started to the queue.
+        """
+        with self._transaction() as connection:
+            connection.executemany('UPDATE queue SET node_id = NULL WHERE job_id = ?',
+                                   [(job_id,) for job_id in job_ids])
+
+    def remove(self, job_id):
+        """
+        Returns: whether the job was unclaimed and is now removed.
+        """
+        with self._transaction() as connection:
+            cursor = connection.execute('DELETE FROM queue WHERE job_id = ? AND node_id IS NULL', (job_id,))
+            return cursor.rowcount > 0
+
+    def finish(self, job_id):
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM queue WHERE job_id = ?', (job_id,))
+
+    def request_cancel(self, job_id):
+        with self._transaction() as connection:
+            connection.execute('UPDATE queue SET cancel_requested = 1 WHERE job_id = ?', (job_id,))
+
+    def get_cancel_requests(self, node_id):
+        """
+        Returns: job_ids claimed by node_id that should be cancelled.
+        """
+        rows = self._connect().execute('SELECT job_id FROM queue WHERE node_id = ? AND cancel_requested = 1',
+                                       (node_id,)).fetchall()
+        return {row[0] for row in rows}
+
+    def get_position(self, job_id):
+        """
+        Returns: number of unclaimed jobs that will be claimed before
+            this one, or None if it is not waiting to be claimed.
+        """
+        connection = self._connect()
+        row = connection.execute('SELECT priority, enqueued_at FROM queue WHERE job_id = ? AND node_id IS NULL',
+                                 (job_id,)).fetchone()
+        if row is None:
+            return None
+        priority, enqueued_at = row
+        return connection.execute('SELECT COUNT(*) FROM queue WHERE node_id IS NULL AND '
+                                  '(priority > ? OR (priority = ? AND enqueued_at < ?))',
+                                  (priority, priority, enqueued_at)).fetchone()[0]
+
+    def heartbeat(self, node_id):
+        with self._transaction() as connection:
+            connection.execute('INSERT OR REPLACE INTO nodes (node_id, heartbeat) VALUES (?, ?)',
+                               (node_id, time.time()))
+
+    def remove_node(self, node_id):
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM nodes WHERE node_id = ?', (node_id,))
+
+    def recover(self, node_id, node_timeout):
+        """
+        Claim for node_id the jobs held by nodes that sent no heartbeat
+        for node_timeout seconds, counting one more attempt for each.
+        Returns: (job, attempts, cancel_requested) of each job claimed.
+        """
+        cutoff = time.time() - node_timeout
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM nodes WHERE heartbeat < ?', (cutoff,))
+            rows = connection.execute('SELECT job_id, job, attempts, cancel_requested FROM queue '
+                                      'WHERE node_id IS NOT NULL AND node_id NOT IN (SELECT node_id FROM nodes)'
+                                      ).fetchall()
+            connection.executemany('UPDATE queue SET node_id = ?, attempts = attempts + 1 WHERE job_id = ?',
+                                   [(node_id, row[0]) for row in rows])
+        return [(pickle.loads(row[1]), row[2] + 1, bool(row[3])) for row in rows]
+
+    def get_references(self):
+        """
+        Returns: (job_ids, resource_ids) of every queued or claimed job.
+        """
+        rows = self._connect().execute('SELECT job_id, primary_resource_id, secondary_resource_id '
+                                       'FROM queue').fetchall()
+        return ({row[0] for row in rows},
+                {resource_id for row in rows for resource_id in row[1:] if resource_id is not None})
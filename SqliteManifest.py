@@ -0,0 +1,377 @@
+from contextlib import contextmanager
+import threading
+import sqlite3
+import json
+import time
+import os
+
+import Metrics
+
+
+TABLES = [
+    '''CREATE TABLE IF NOT EXISTS resources (
+        resource_id TEXT PRIMARY KEY,
+        hash TEXT,
+        timestamp REAL NOT NULL)''',
+    '''CREATE TABLE IF NOT EXISTS jobs (
+        job_id TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        timestamp REAL NOT NULL,
+        exception_message TEXT)''',
+]
+
+# columns added after the initial schema, created on existing databases
+COLUMNS = [
+    ('resources', 'ref_count', 'INTEGER NOT NULL DEFAULT 1'),
+    ('jobs', 'fingerprint', 'TEXT'),
+    ('jobs', 'alias_of', 'TEXT'),
+]
+
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS resources_hash ON resources (hash)',
+    'CREATE INDEX IF NOT EXISTS resources_timestamp ON resources (timestamp)',
+    'CREATE INDEX IF NOT EXISTS jobs_timestamp ON jobs (timestamp)',
+    'CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)',
+    'CREATE INDEX IF NOT EXISTS jobs_fingerprint ON jobs (fingerprint)',
+    'CREATE INDEX IF NOT EXISTS jobs_alias_of ON jobs (alias_of)',
+]
+
+
+class SqliteManifest:
+    """
+    Manifest backed by an embedded SQLite database in WAL mode.
+    Exposes the same interface as Manifest, but every lookup is an
+    indexed query and every update an atomic single-row statement.
+    """
+    def __init__(self, filename='manifest.db', json_filename='manifest.json'):
+        self.filename = filename
+        self.json_filename = json_filename
+        self._local = threading.local()
+        with self._transaction() as connection:
+            for statement in TABLES:
+                connection.execute(statement)
+            for table, column, declaration in COLUMNS:
+                existing = [row[1] for row in connection.execute('PRAGMA table_info({})'.format(table))]
+                if column not in existing:
+                    connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, declaration))
+            for statement in INDEXES:
+                connection.execute(statement)
+        if os.path.exists(self.json_filename):
+            self.migrate_from_json(self.json_filename)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connect(self):
+        # connections must not cross a fork or be shared between threads,
+        # so keep one per (process, thread)
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.filename, timeout=30,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._connect()
+        # timed from before the write lock is taken, so contention shows
+        start_time = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        Metrics.MANIFEST_LATENCY.labels('sqlite', 'write').observe(time.time() - start_time)
+
+    def _query_one(self, query, params=()):
+        with Metrics.MANIFEST_LATENCY.labels('sqlite', 'read').time():
+            return self._connect().execute(query, params).fetchone()
+
+    def get_size(self):
+        """
+        Returns: bytes on disk of the database and its write-ahead log.
+        """
+        return sum(os.path.getsize(self.filename + suffix) for suffix in ['', '-wal']
+                   if os.path.exists(self.filename + suffix))
+
+    def migrate_from_json(self, json_filename):
+        """
+        Import every resource and job from a legacy manifest.json,
+        then move the json file aside so it is only imported once.
+        """
+        try:
+            with open(json_filename, 'r') as file:
+                manifest = json.load(file)
+        except ValueError:
+            manifest = {'resources': {},
+                        'jobs': {}}
+        with self._transaction() as connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO resources (resource_id, hash, timestamp, ref_count) VALUES (?, ?, ?, ?)',
+                [(resource_id, values.get('hash'), values['timestamp'], values.get('ref_count', 1))
+                 for resource_id, values in manifest.get('resources', {}).items()])
+            connection.executemany(
+                '''INSERT OR IGNORE INTO jobs (job_id, status, timestamp, exception_message, fingerprint, alias_of)
+                VALUES (?, ?, ?, ?, ?, ?)''',
+                [(job_id, values['status'], values['timestamp'], values.get('exception_message'),
+                  values.get('fingerprint'), values.get('alias_of'))
+                 for job_id, values in manifest.get('jobs', {}).items()])
+        os.replace(json_filename, json_filename + '.migrated')
+
+    def clear(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.filename + suffix):
+                os.remove(self.filename + suffix)
+
+    def add_resource(self, resource_id, resource_hash):
+        """
+        Register a resource, or take another reference on the
+        resource that already holds identical bytes.
+        Returns: the resource_id that owns resource_hash.
+        """
+        with self._transaction() as connection:
+            row = connection.execute('SELECT resource_id FROM resources WHERE hash = ? LIMIT 1',
+                                     (resource_hash,)).fetchone()
+            if row is not None:
+                connection.execute('UPDATE resources SET ref_count = ref_count + 1, timestamp = ? WHERE resource_id = ?',
+                                   (time.time(), row[0]))
+                return row[0]
+            connection.execute('INSERT INTO resources (resource_id, hash, timestamp, ref_count) VALUES (?, ?, ?, 1)',
+                               (resource_id, resource_hash, time.time()))
+            return resource_id
+
+    def delete_resource(self, resource_id):
+        """
+        Drop one reference to a resource.
+        Returns: None if the resource does not exist, else the
+            number of references left (0 once it is removed).
+        """
+        with self._transaction() as connection:
+            row = connection.execute('SELECT ref_count FROM resources WHERE resource_id = ?',
+                                     (resource_id,)).fetchone()
+            if row is None:
+                return None
+            if row[0] > 1:
+                connection.execute('UPDATE resources SET ref_count = ref_count - 1 WHERE resource_id = ?',
+                                   (resource_id,))
+                return row[0] - 1
+            connection.execute('DELETE FROM resources WHERE resource_id = ?', (resource_id,))
+            return 0
+
+    def add_job(self, job_id, fingerprint=None):
+        with self._transaction() as connection:
+            connection.execute('INSERT OR REPLACE INTO jobs (job_id, status, timestamp, fingerprint) VALUES (?, ?, ?, ?)',
+                               (job_id, 'enqueued', time.time(), fingerprint))
+
+    def add_jobs(self, job_ids, fingerprints=None):
+        if fingerprints is None:
+            fingerprints = [None] * len(job_ids)
+        with self._transaction() as connection:
+            connection.executemany('INSERT OR REPLACE INTO jobs (job_id, status, timestamp, fingerprint) '
+                                   'VALUES (?, ?, ?, ?)',
+                                   [(job_id, 'enqueued', time.time(), fingerprint)
+                                    for job_id, fingerprint in zip(job_ids, fingerprints)])
+
+    def add_job_alias(self, job_id, existing_id):
+        """
+        Register job_id as another handle on the job existing_id is a
+        handle on, starting from existing_id's status.
+        Returns: that status, or None if existing_id no longer exists.
+        """
+        with self._transaction() as connection:
+            row = connection.execute('SELECT status, exception_message, fingerprint, alias_of FROM jobs '
+                                     'WHERE job_id = ?', (existing_id,)).fetchone()
+            if row is None:
+                return None
+            job_status, exception_message, fingerprint, alias_of = row
+            connection.execute('INSERT OR REPLACE INTO jobs (job_id, status, timestamp, exception_message, '
+                               'fingerprint, alias_of) VALUES (?, ?, ?, ?, ?, ?)',
+                               (job_id, job_status, time.time(), exception_message, fingerprint,
+                                alias_of or existing_id))
+            return job_status
+
+    def find_job(self, fingerprint, statuses):
+        """
+        Returns: the most recent job or alias with fingerprint and one
+            of statuses, or None.
+        """
+        statuses = tuple(statuses)
+        row = self._query_one('SELECT job_id FROM jobs WHERE fingerprint = ? AND status IN ({}) '
+                              'ORDER BY timestamp DESC LIMIT 1'.format(', '.join('?' * len(statuses))),
+                              (fingerprint,) + statuses)
+        if row is None:
+            return None
+        return row[0]
+
+    def get_job_folder_id(self, job_id):
+        """
+        Returns: the job_id whose folder holds job_id's results, or
+            None if job_id does not exist.
+        """
+        row = self._query_one('SELECT alias_of FROM jobs WHERE job_id = ?', (job_id,))
+        if row is None:
+            return None
+        return row[0] or job_id
+
+    def get_job_aliases(self, job_id):
+        rows = self._connect().execute('SELECT job_id FROM jobs WHERE alias_of = ?', (job_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def count_job_references(self, folder_id):
+        """
+        Returns: number of jobs, the job itself or its aliases, whose
+            results live in folder_id.
+        """
+        return self._query_one('SELECT COUNT(*) FROM jobs WHERE job_id = ? OR alias_of = ?',
+                               (folder_id, folder_id))[0]
+
+    def delete_job(self, job_id):
+        with self._transaction() as connection:
+            cursor = connection.execute('DELETE FROM jobs WHERE job_id = ?', (job_id,))
+            return cursor.rowcount > 0
+
+    def resource_exists(self, resource_id):
+        return self._query_one('SELECT 1 FROM resources WHERE resource_id = ?', (resource_id,)) is not None
+
+    def resource_hash_exists(self, resource_hash):
+        row = self._query_one('SELECT resource_id FROM resources WHERE hash = ? LIMIT 1', (resource_hash,))
+        if row is None:
+            return False
+        return row[0]
+
+    def get_resource_hash(self, resource_id):
+        row = self._query_one('SELECT hash FROM resources WHERE resource_id = ?', (resource_id,))
+        if row is None:
+            return None
+        return row[0]
+
+    def job_exists(self, job_id):
+        return self._query_one('SELECT 1 FROM jobs WHERE job_id = ?', (job_id,)) is not None
+
+    def get_job_status(self, job_id):
+        row = self._query_one('SELECT status FROM jobs WHERE job_id = ?', (job_id,))
+        if row is None:
+            return None
+        return row[0]
+
+    def get_job_statuses(self, job_ids):
+        """
+        Returns: job_id -> (status, exception_message) for each of
+            job_ids that exists.
+        """
+        job_ids = list(job_ids)
+        statuses = {}
+        connection = self._connect()
+        # stay under SQLite's limit on bound parameters
+        for start in range(0, len(job_ids), 500):
+            batch = job_ids[start:start + 500]
+            rows = connection.execute('SELECT job_id, status, exception_message FROM jobs WHERE job_id IN ({})'
+                                      .format(', '.join('?' * len(batch))), batch).fetchall()
+            for job_id, status, exception_message in rows:
+                statuses[job_id] = (status, exception_message)
+        return statuses
+
+    def get_job_exception_message(self, job_id):
+        row = self._query_one('SELECT exception_message FROM jobs WHERE job_id = ?', (job_id,))
+        if row is None:
+            return None
+        return row[0]
+
+    @staticmethod
+    def _status_condition(from_statuses):
+        if from_statuses is None:
+            return '', ()
+        from_statuses = tuple(from_statuses)
+        return ' AND status IN ({})'.format(', '.join('?' * len(from_statuses))), from_statuses
+
+    def _update_job(self, job_id, assignments, params, from_statuses, with_aliases):
+        condition, status_params = self._status_condition(from_statuses)
+        target = '(job_id = ? OR alias_of = ?)' if with_aliases else 'job_id = ?'
+        target_params = (job_id, job_id) if with_aliases else (job_id,)
+        with self._transaction() as connection:
+            updated = [row[0] for row in connection.execute('SELECT job_id FROM jobs WHERE ' + target + condition,
+                                                            target_params + status_params)]
+            connection.executemany('UPDATE jobs SET {} WHERE job_id = ?'.format(assignments),
+                                   [params + (updated_id,) for updated_id in updated])
+            return updated
+
+    def update_job_status(self, job_id, status, from_statuses=None, with_aliases=True):
+        """
+        Set the status of a job and, with_aliases, of every alias of it.
+        If from_statuses is given, only jobs currently in one of them
+        are updated.
+        Returns: the job_ids updated.
+        """
+        return self._update_job(job_id, 'status = ?', (status,), from_statuses, with_aliases)
+
+    def add_job_exception(self, job_id, exception_message, status='exception', from_statuses=None,
+                          with_aliases=True):
+        return self._update_job(job_id, 'status = ?, exception_message = ?', (status, exception_message),
+                                from_statuses, with_aliases)
+
+    def get_expired_jobs(self, lifespan):
+        rows = self._connect().execute('SELECT job_id FROM jobs WHERE timestamp < ?',
+                                       (time.time() - lifespan,)).fetchall()
+        return [row[0] for row in rows]
+
+    def get_expired_resources(self, lifespan):
+        rows = self._connect().execute('SELECT resource_id FROM resources WHERE timestamp < ?',
+                                       (time.time() - lifespan,)).fetchall()
+        return [row[0] for row in rows]
+
+    @staticmethod
+    def _delete_expired(connection, table, key, cutoff, exclude, limit, columns=''):
+        rows = connection.execute('SELECT {}{} FROM {} WHERE timestamp < ? ORDER BY timestamp'
+                                  .format(key, columns, table), (cutoff,))
+        expired = []
+        for row in rows:
+            if row[0] in exclude:
+                continue
+            expired.append(row)
+            if limit is not None and len(expired) >= limit:
+                break
+        connection.executemany('DELETE FROM {} WHERE {} = ?'.format(table, key),
+                               [(row[0],) for row in expired])
+        return expired
+
+    def delete_expired_jobs(self, lifespan, exclude=(), limit=None):
+        """
+        Delete up to limit jobs older than lifespan, oldest first,
+        skipping the job_ids in exclude.
+        Returns: (job_id, folder_id) of each deleted job, folder_id
+            being the job_id whose folder holds its results.
+        """
+        with self._transaction() as connection:
+            expired = self._delete_expired(connection, 'jobs', 'job_id', time.time() - lifespan, exclude, limit,
+                                           columns=', alias_of')
+            return [(job_id, alias_of or job_id) for job_id, alias_of in expired]
+
+    def delete_expired_resources(self, lifespan, exclude=(), limit=None):
+        with self._transaction() as connection:
+            expired = self._delete_expired(connection, 'resources', 'resource_id', time.time() - lifespan,
+                                           exclude, limit)
+            return [row[0] for row in expired]
+
+    def remove_resource(self, resource_id):
+        """
+        Remove a resource whatever its reference count.
+        """
+        with self._transaction() as connection:
+            cursor = connection.execute('DELETE FROM resources WHERE resource_id = ?', (resource_id,))
+            return cursor.rowcount > 0
@@ -0,0 +1,602 @@
+"""
+Load test for the API against a stand-in for spatial_access.
+
+The server is started in a scratch directory with a fake, deterministic
+TransitMatrix and models whose run time and output size are set on the
+command line, then client threads drive a mix of upload, submit, poll,
+download and delete requests. Reports latency percentiles per request
+type, jobs per second, manifest lock and transaction latency from
+/metrics, and the memory of the API and worker processes.
+
+    python benchmark.py --duration 60 --clients 16 --job_seconds 0.5
+    python benchmark.py --output after.json --baseline before.json
+
+Arguments after -- are passed to server.py, e.g. -- --manifest_backend json
+"""
+from http.client import HTTPConnection
+from urllib.parse import urlencode
+import subprocess
+import threading
+import tempfile
+import argparse
+import random
+import signal
+import socket
+import shutil
+import types
+import json
+import time
+import sys
+import os
+import re
+
+
+class FakeNetworkInterface:
+    """
+    Stands in for spatial_access.NetworkInterface: a fixed two node
+    network, so NetworkCache and the progress hooks work unchanged.
+    """
+    def __init__(self, network_type, *args, **kwargs):
+        self.network_type = network_type
+        self.bbox = None
+        self.nodes = None
+        self.edges = None
+
+    def _try_create_cache(self):
+        pass
+
+    def _get_bbox(self, primary_data, secondary_data, secondary_input, epsilon):
+        self.bbox = [41.0, -88.0, 42.0, -87.0]
+
+    def load_network(self, primary_data, secondary_data, secondary_input, epsilon):
+        import pandas as pd
+        self._get_bbox(primary_data, secondary_data, secondary_input, epsilon)
+        self.nodes = pd.DataFrame({'id': [0, 1], 'x': [0.0, 1.0], 'y': [0.0, 1.0]})
+        self.edges = pd.DataFrame({'from': [0], 'to': [1], 'distance': [1.0]})
+
+
+class FakeTransitMatrix:
+    """
+    Stands in for spatial_access.p2p.TransitMatrix: sleeps job_seconds
+    in process() and writes an output_rows x output_columns matrix of
+    travel times that depend only on the cell.
+    """
+    job_seconds = 1.0
+    output_rows = 100
+    output_columns = 100
+
+    def __init__(self, network_type='walk', primary_input=None, secondary_input=None,
+                 read_from_file=None, primary_hints=None, secondary_hints=None,
+                 debug=False, configs=None):
+        self.network_interface = FakeNetworkInterface(network_type)
+        self.primary_hints = primary_hints
+        self.secondary_hints = secondary_hints
+
+    def process(self):
+        FakeNetworkInterface.load_network(self.network_interface, None, None, None, 0)
+        time.sleep(self.job_seconds)
+
+    @staticmethod
+    def get_travel_time(row, column):
+        return (row * 31 + column * 17) % 3600
+
+    def write_csv(self, filename):
+        with open(filename, 'w') as file:
+            file.write(',' + ','.join('d{}'.format(column) for column in range(self.output_columns)) + '\n')
+            for row in range(self.output_rows):
+                file.write('o{},'.format(row))
+                file.write(','.join(str(self.get_travel_time(row, column))
+                                    for column in range(self.output_columns)) + '\n')
+
+    def write_tmx(self, filename):
+        with open(filename, 'w') as file:
+            json.dump([self.output_rows, self.output_columns], file)
+
+
+class FakeModelData:
+    """
+    Stands in for spatial_access.BaseModel.ModelData: loads the fake
+    network, but no matrix, unless given a matrix file.
+    """
+    def __init__(self, network_type='walk', sources_filename=None, destinations_filename=None,
+                 source_column_names=None, dest_column_names=None, transit_matrix_filename=None,
+                 **kwargs):
+        self.network_type = network_type
+        self.transit_matrix = None
+        self.model_results = None
+        self.aggregated_results = None
+        self._source_file_hints = None
+        self._dest_file_hints = None
+        self.load_transit_matrix(transit_matrix_filename)
+
+    def load_transit_matrix(self, read_from_file=None):
+        self.transit_matrix = FakeTransitMatrix(self.network_type, read_from_file=read_from_file)
+        if read_from_file is None:
+            FakeNetworkInterface.load_network(self.transit_matrix.network_interface, None, None, None, 0)
+        self.reload_sources()
+        self.reload_dests()
+
+    def reload_sources(self, filename=None):
+        pass
+
+    def reload_dests(self, filename=None):
+        pass
+
+
+class FakeModel(FakeModelData):
+    """
+    Stands in for the spatial_access.Models classes: sleeps job_seconds
+    in calculate() and produces output_rows results.
+    """
+
+    def calculate(self, **kwargs):
+        import pandas as pd
+        time.sleep(FakeTransitMatrix.job_seconds)
+        sources = ['o{}'.format(row) for row in range(FakeTransitMatrix.output_rows)]
+        self.model_results = pd.DataFrame({'score': [FakeTransitMatrix.get_travel_time(row, 0) / 60
+                                                     for row in range(len(sources))]},
+                                          index=sources)
+
+    def write_results(self, filename):
+        self.model_results.to_csv(filename)
+
+    def aggregate(self, **kwargs):
+        self.aggregated_results = {'score': float(self.model_results['score'].mean())}
+
+    def write_aggregated_results(self, filename):
+        with open(filename, 'w') as file:
+            json.dump(self.aggregated_results, file)
+
+    def write_transit_matrix_to_tmx(self, filename):
+        FakeTransitMatrix().write_tmx(filename)
+
+
+def install_fake_engine(job_seconds, output_rows, output_columns):
+    """
+    Register the stand-ins as the spatial_access modules. Must run
+    before server is imported; Consumers inherit them when forked.
+    """
+    FakeTransitMatrix.job_seconds = job_seconds
+    FakeTransitMatrix.output_rows = output_rows
+    FakeTransitMatrix.output_columns = output_columns
+    package = types.ModuleType('spatial_access')
+    p2p = types.ModuleType('spatial_access.p2p')
+    p2p.TransitMatrix = FakeTransitMatrix
+    models = types.ModuleType('spatial_access.Models')
+    for model_type in ['TSFCA', 'Coverage', 'DestSum', 'AccessTime', 'AccessCount', 'AccessModel']:
+        setattr(models, model_type, type(model_type, (FakeModel,), {}))
+    base_model = types.ModuleType('spatial_access.BaseModel')
+    base_model.ModelData = FakeModelData
+    network_interface = types.ModuleType('spatial_access.NetworkInterface')
+    network_interface.NetworkInterface = FakeNetworkInterface
+    package.p2p, package.Models, package.NetworkInterface = p2p, models, network_interface
+    package.BaseModel = base_model
+    sys.modules.update({'spatial_access': package,
+                        'spatial_access.p2p': p2p,
+                        'spatial_access.Models': models,
+                        'spatial_access.BaseModel': base_model,
+                        'spatial_access.NetworkInterface': network_interface})
+
+
+def serve(args, server_args):
+    install_fake_engine(args.job_seconds, args.output_rows, args.output_columns)
+    sys.argv = ['server.py'] + server_args
+    import Metrics
+    Metrics.setup(clear=True)
+    import server
+    server.application.run(host='127.0.0.1', port=server.args.port, threaded=True)
+
+
+class Client(threading.Thread):
+    """
+    One simulated user: picks requests by weight from the mix and
+    keeps track of its own resources and jobs.
+    """
+    hints = {'idx': 'id', 'lat': 'lat', 'lon': 'lon'}
+
+    def __init__(self, number, port, mix, input_rows, model_share, deadline, seed):
+        threading.Thread.__init__(self, daemon=True)
+        self.number = number
+        self.port = port
+        self.operations, self.weights = zip(*mix.items())
+        self.input_rows = input_rows
+        self.model_share = model_share
+        self.deadline = deadline
+        self.random = random.Random(seed + number)
+        self.uploads = 0
+        self.resource_ids = []
+        self.pending_jobs = []
+        self.finished_jobs = []
+        self.submitted_jobs = []
+        # operation -> [latency in seconds], and -> count of 5xx or failed requests
+        self.latencies = {}
+        self.errors = {}
+
+    def request(self, operation, method, path, body=None, headers=None):
+        connection = HTTPConnection('127.0.0.1', self.port, timeout=120)
+        start_time = time.time()
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            status, data = response.status, response.read()
+        except OSError:
+            status, data = None, b''
+        finally:
+            connection.close()
+        self.latencies.setdefault(operation, []).append(time.time() - start_time)
+        if status is None or status >= 500:
+            self.errors[operation] = self.errors.get(operation, 0) + 1
+        return status, data
+
+    def run(self):
+        while time.time() < self.deadline:
+            operation = self.random.choices(self.operations, self.weights)[0]
+            getattr(self, operation)()
+
+    def upload(self):
+        self.uploads += 1
+        lines = ['id,lat,lon,weight']
+        # unique bytes per upload, so deduplication does not skip the write
+        for row in range(self.input_rows):
+            lines.append('c{}u{}r{},{:.6f},{:.6f},{}'.format(self.number, self.uploads, row,
+                                                             41.8 + row * 1e-4, -87.6 - row * 1e-4, row % 10))
+        status, data = self.request('upload', 'POST', '/uploadResource?filename=bench.csv',
+                                    body='\n'.join(lines).encode())
+        if status == 201:
+            self.resource_ids.append(json.loads(data)['resource_id'])
+
+    def submit(self):
+        while len(self.resource_ids) < 2 and time.time() < self.deadline:
+            self.upload()
+        if len(self.resource_ids) < 2:
+            return
+        primary_id, secondary_id = self.random.sample(self.resource_ids, 2)
+        if self.random.random() < self.model_share:
+            fields = {'job_type': 'model', 'model_type': 'AccessTime',
+                      'orders': json.dumps({'init_kwargs': {'network_type': 'walk',
+                                                            'source_column_names': self.hints,
+                                                            'dest_column_names': self.hints},
+                                            'calculate_kwargs': {}})}
+        else:
+            fields = {'job_type': 'matrix',
+                      'orders': json.dumps({'init_kwargs': {'network_type': 'walk',
+                                                            'primary_hints': self.hints,
+                                                            'secondary_hints': self.hints}})}
+        fields.update(primary_resource=primary_id, secondary_resource=secondary_id,
+                      client_id='client{}'.format(self.number))
+        status, data = self.request('submit', 'POST', '/submitJob', body=urlencode(fields).encode(),
+                                    headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        if status == 200:
+            job_id = json.loads(data)['job_id']
+            self.pending_jobs.append(job_id)
+            self.submitted_jobs.append(job_id)
+
+    def poll(self):
+        if not self.pending_jobs:
+            return self.submit()
+        job_id = self.random.choice(self.pending_jobs)
+        status, data = self.request('poll', 'GET', '/checkJobStatus/' + job_id)
+        if status is None or status == 404:
+            return
+        job_status = json.loads(data).get('job_status')
+        if job_status not in ('enqueued', 'running'):
+            self.pending_jobs.remove(job_id)
+            if job_status == 'finished':
+                self.finished_jobs.append(job_id)
+
+    def download(self):
+        if not self.finished_jobs:
+            return self.poll()
+        self.request('download', 'GET', '/getResultsForJob/' + self.random.choice(self.finished_jobs))
+
+    def delete(self):
+        if self.finished_jobs:
+            self.request('delete', 'DELETE', '/deleteJobResults/' + self.finished_jobs.pop(0))
+        elif len(self.resource_ids) > 2 and not self.pending_jobs:
+            self.request('delete', 'DELETE', '/deleteResource/' + self.resource_ids.pop(0))
+
+
+class MemorySampler(threading.Thread):
+    """
+    Samples the resident memory of the server process and its worker
+    processes from /proc until stopped.
+    """
+    def __init__(self, pid, interval=0.5):
+        threading.Thread.__init__(self, daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.stopping = threading.Event()
+        # pid -> peak resident bytes
+        self.peaks = {}
+
+    @staticmethod
+    def get_rss(pid):
+        try:
+            with open('/proc/{}/status'.format(pid)) as file:
+                for line in file:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def get_workers(self):
+        workers = []
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open('/proc/{}/stat'.format(entry)) as file:
+                    parent_pid = int(file.read().rsplit(')', 1)[1].split()[1])
+                with open('/proc/{}/cmdline'.format(entry), 'rb') as file:
+                    cmdline = file.read()
+            except (OSError, IndexError, ValueError):
+                continue
+            # multiprocessing's helper processes are not workers
+            if parent_pid == self.pid and b'resource_tracker' not in cmdline:
+                workers.append(int(entry))
+        return workers
+
+    def run(self):
+        while not self.stopping.is_set():
+            for pid in [self.pid] + self.get_workers():
+                rss = self.get_rss(pid)
+                if rss is not None:
+                    self.peaks[pid] = max(self.peaks.get(pid, 0), rss)
+            self.stopping.wait(self.interval)
+
+    def get_report(self):
+        workers = {pid: rss for pid, rss in self.peaks.items() if pid != self.pid}
+        return {'api_peak_bytes': self.peaks.get(self.pid),
+                'worker_peak_bytes': workers,
+                'worker_mean_peak_bytes': sum(workers.values()) / len(workers) if workers else None}
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def get(port, path):
+    connection = HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def wait_until_up(port, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('server exited with code {}'.format(process.returncode))
+        try:
+            if get(port, '/getPoolStatus')[0] == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('server did not start within {} seconds'.format(timeout))
+
+
+def get_manifest_metrics(port):
+    """
+    Returns: (backend, operation) -> (count, total seconds) scraped
+        from /metrics.
+    """
+    pattern = re.compile(r'^spatial_access_manifest_seconds_(sum|count)\{(.*)\} (\S+)$')
+    metrics = {}
+    for line in get(port, '/metrics')[1].decode().splitlines():
+        match = pattern.match(line)
+        if match is None:
+            continue
+        labels = dict(re.findall(r'(\w+)="([^"]*)"', match.group(2)))
+        key = (labels.get('backend'), labels.get('operation'))
+        count, total = metrics.get(key, (0, 0.0))
+        if match.group(1) == 'count':
+            count = float(match.group(3))
+        else:
+            total = float(match.group(3))
+        metrics[key] = (count, total)
+    return metrics
+
+
+def get_job_statuses(port, job_ids):
+    statuses = {}
+    for start in range(0, len(job_ids), 500):
+        connection = HTTPConnection('127.0.0.1', port, timeout=60)
+        try:
+            connection.request('POST', '/jobStatuses', body=json.dumps({'job_ids': job_ids[start:start + 500]}),
+                               headers={'Content-Type': 'application/json'})
+            jobs = json.loads(connection.getresponse().read())['jobs']
+        finally:
+            connection.close()
+        statuses.update({job_id: job['job_status'] for job_id, job in jobs.items()})
+    return statuses
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        operation, weight = item.split('=')
+        if operation not in ('upload', 'submit', 'poll', 'download', 'delete'):
+            raise argparse.ArgumentTypeError('unknown operation: {}'.format(operation))
+        weights[operation] = float(weight)
+    return weights
+
+
+def run_benchmark(args, server_args):
+    port = get_free_port()
+    work_dir = tempfile.mkdtemp(prefix='spatial_access_benchmark_')
+    command = [sys.executable, os.path.abspath(__file__), '--serve',
+               '--job_seconds', str(args.job_seconds),
+               '--output_rows', str(args.output_rows),
+               '--output_columns', str(args.output_columns),
+               '--', '--port', str(port), '--num_workers', str(args.num_workers)] + server_args
+    process = subprocess.Popen(command, cwd=work_dir)
+    try:
+        wait_until_up(port, process)
+        sampler = MemorySampler(process.pid)
+        sampler.start()
+        manifest_before = get_manifest_metrics(port)
+        start_time = time.time()
+        clients = [Client(number, port, args.mix, args.input_rows, args.model_share,
+                          start_time + args.duration, args.seed)
+                   for number in range(args.clients)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        job_ids = [job_id for client in clients for job_id in client.submitted_jobs]
+        statuses = get_job_statuses(port, job_ids)
+        while args.drain and any(status in ('enqueued', 'running') for status in statuses.values()):
+            time.sleep(0.5)
+            statuses = get_job_statuses(port, job_ids)
+        elapsed = time.time() - start_time
+        manifest_after = get_manifest_metrics(port)
+        sampler.stopping.set()
+        sampler.join()
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    latency = {}
+    for operation in args.mix:
+        values = [value for client in clients for value in client.latencies.get(operation, [])]
+        if not values:
+            continue
+        latency[operation] = {'count': len(values),
+                              'errors': sum(client.errors.get(operation, 0) for client in clients),
+                              'p50': percentile(values, 0.5),
+                              'p99': percentile(values, 0.99),
+                              'mean': sum(values) / len(values)}
+    outcomes = {}
+    for status in statuses.values():
+        outcomes[status] = outcomes.get(status, 0) + 1
+    done = sum(count for status, count in outcomes.items() if status not in ('enqueued', 'running'))
+    manifest = {}
+    for key, (count, total) in manifest_after.items():
+        count_before, total_before = manifest_before.get(key, (0, 0.0))
+        count -= count_before
+        if count:
+            manifest['/'.join(key)] = {'count': int(count),
+                                       'mean': (total - total_before) / count,
+                                       'per_second': count / elapsed}
+    return {'config': {'duration': args.duration, 'clients': args.clients, 'mix': args.mix,
+                       'job_seconds': args.job_seconds, 'output_rows': args.output_rows,
+                       'output_columns': args.output_columns, 'input_rows': args.input_rows,
+                       'num_workers': args.num_workers, 'server_args': server_args},
+            'elapsed': elapsed,
+            'latency': latency,
+            'jobs': {'submitted': len(job_ids),
+                     'outcomes': outcomes,
+                     'jobs_per_second': done / elapsed},
+            'manifest': manifest,
+            'memory': sampler.get_report()}
+
+
+def print_report(report):
+    print('{:<10}{:>8}{:>8}{:>10}{:>10}{:>10}'.format('request', 'count', 'errors', 'p50 ms', 'p99 ms', 'mean ms'))
+    for operation, values in report['latency'].items():
+        print('{:<10}{:>8}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}'.format(operation, values['count'], values['errors'],
+                                                                   values['p50'] * 1000, values['p99'] * 1000,
+                                                                   values['mean'] * 1000))
+    jobs = report['jobs']
+    print('\njobs: {} submitted, {}, {:.2f} jobs/s'.format(jobs['submitted'], jobs['outcomes'],
+                                                          jobs['jobs_per_second']))
+    print('\n{:<20}{:>10}{:>10}{:>10}'.format('manifest', 'count', 'mean ms', 'per s'))
+    for operation, values in sorted(report['manifest'].items()):
+        print('{:<20}{:>10}{:>10.2f}{:>10.1f}'.format(operation, values['count'], values['mean'] * 1000,
+                                                      values['per_second']))
+    memory = report['memory']
+    to_mb = lambda value: '-' if value is None else '{:.0f} MB'.format(value / 1048576)
+    print('\nmemory: api peak {}, worker mean peak {}, worker peaks {}'.format(
+        to_mb(memory['api_peak_bytes']), to_mb(memory['worker_mean_peak_bytes']),
+        ', '.join(to_mb(value) for value in memory['worker_peak_bytes'].values()) or '-'))
+
+
+def compare(report, baseline, tolerance):
+    """
+    Returns: descriptions of the p99 latencies and throughput that are
+        worse than baseline by more than tolerance.
+    """
+    regressions = []
+    for operation, values in report['latency'].items():
+        if operation in baseline['latency']:
+            base = baseline['latency'][operation]['p99']
+            if values['p99'] > base * (1 + tolerance):
+                regressions.append('{} p99 {:.1f} ms, baseline {:.1f} ms'.format(
+                    operation, values['p99'] * 1000, base * 1000))
+    base = baseline['jobs']['jobs_per_second']
+    if report['jobs']['jobs_per_second'] < base * (1 - tolerance):
+        regressions.append('{:.2f} jobs/s, baseline {:.2f} jobs/s'.format(
+            report['jobs']['jobs_per_second'], base))
+    return regressions
+
+
+parser = argparse.ArgumentParser(description='Load test the spatial_access ReST API against a stand-in engine')
+parser.add_argument('--duration', metavar='-t', type=float, default=30,
+                    help='Seconds to generate load for.')
+parser.add_argument('--clients', metavar='-c', type=int, default=8,
+                    help='Concurrent simulated clients.')
+parser.add_argument('--mix', metavar='-m', type=parse_mix,
+                    default='upload=1,submit=2,poll=10,download=2,delete=1',
+                    help='Relative weights of upload, submit, poll, download and delete requests.')
+parser.add_argument('--job_seconds', metavar='-s', type=float, default=1.0,
+                    help='Seconds each fake matrix or model takes to compute.')
+parser.add_argument('--output_rows', metavar='-r', type=int, default=100,
+                    help='Rows of each fake matrix and model result.')
+parser.add_argument('--output_columns', metavar='-o', type=int, default=100,
+                    help='Columns of each fake matrix.')
+parser.add_argument('--input_rows', metavar='-i', type=int, default=1000,
+                    help='Rows of each uploaded resource.')
+parser.add_argument('--model_share', metavar='-a', type=float, default=0.5,
+                    help='Fraction of submitted jobs that are model jobs.')
+parser.add_argument('--num_workers', metavar='-w', type=int, default=2,
+                    help='Workers of the server under test.')
+parser.add_argument('--seed', metavar='-e', type=int, default=0,
+                    help='Seed for the request mix.')
+parser.add_argument('--drain', action='store_true',
+                    help='Wait for submitted jobs to finish before measuring throughput.')
+parser.add_argument('--output', metavar='-f', type=str, default=None,
+                    help='Write the report as JSON to this file.')
+parser.add_argument('--baseline', metavar='-b', type=str, default=None,
+                    help='JSON report to compare against; exits with status 1 on a regression.')
+parser.add_argument('--tolerance', metavar='-l', type=float, default=0.2,
+                    help='Fraction by which p99 latency or throughput may be worse than the baseline.')
+parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+
+
+if __name__ == '__main__':
+    if '--' in sys.argv:
+        split = sys.argv.index('--')
+        args, server_args = parser.parse_args(sys.argv[1:split]), sys.argv[split + 1:]
+    else:
+        args, server_args = parser.parse_args(), []
+    if args.serve:
+        serve(args, server_args)
+        sys.exit(0)
+    report = run_benchmark(args, server_args)
+    print_report(report)
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        for regression in regressions:
+            print('regression:', regression)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,35 @@
+import os
+import sys
+
+# every web worker and its Consumers write metrics to this directory,
+# and /metrics in any worker aggregates all of them
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', 'data/metrics/')
+
+# seconds a stopping worker has before it is killed; the server's
+# --drain_timeout must stay below this, or jobs are killed mid-checkpoint
+graceful_timeout = 60
+
+
+def on_starting(server):
+    import Metrics
+    # samples left by a previous run would be counted again; web workers
+    # inherit the metrics set up here
+    Metrics.setup(clear=True)
+
+
+def post_fork(server, worker):
+    import Metrics
+    Metrics.setup()
+
+
+def child_exit(server, worker):
+    import Metrics
+    Metrics.mark_process_dead(worker.pid)
+
+
+def worker_exit(server, worker):
+    # stop the worker's jobs and return them to the queue, as python server.py
+    # does on SIGINT or SIGTERM; a worker that never loaded the app has none
+    app = sys.modules.get('server')
+    if app is not None:
+        app.resource_manager.shutdown()
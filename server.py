@@ -1,7 +1,17 @@
-from flask import Flask, request, Response, jsonify, send_file
+import Metrics
+from flask import Flask, request, Response, jsonify, send_file, stream_with_context
+from werkzeug.datastructures import MultiDict
 from ResourceManager import ResourceManager
+from ResourceManagerExceptions import UploadTooLargeException
+from ResourceManagerExceptions import MissingResourceException
+from ResourceManagerExceptions import MatrixStoreNotReadyException
+from EventBus import TERMINAL_STATUSES
 from Job import Job
 import signal
+import os
+import queue
+import json
+import math
 import sys
 import argparse
 
@@ -17,12 +27,90 @@ parser.add_argument('--max_file_size', metavar='-m', type=int,
                     default=536870912, help='Max file size (in bytes) to allow users to upload.')
 parser.add_argument('--port', metavar='-p', type=int,
                     default=5000, help='Port number to listen on.')
+parser.add_argument('--manifest_backend', metavar='-b', type=str, default='sqlite',
+                    choices=['sqlite', 'json'], help='Storage backend for the job and resource manifest.')
+parser.add_argument('--archive_compression', metavar='-c', type=str, default='deflated',
+                    choices=['stored', 'deflated', 'bzip2', 'lzma'],
+                    help='Compression codec for job result archives.')
+parser.add_argument('--archive_compresslevel', metavar='-l', type=int, default=None,
+                    help='Compression level for job result archives (codec default if omitted).')
+parser.add_argument('--use_x_sendfile', action='store_true',
+                    help='Let a fronting web server (nginx, Apache) send result archives via X-Sendfile.')
+parser.add_argument('--matrix_cache_dir', metavar='-d', type=str, default='data/matrix_cache/',
+                    help='Directory for the transit matrix cache shared by all jobs.')
+parser.add_argument('--matrix_cache_size', metavar='-s', type=int, default=10737418240,
+                    help='Max size (in bytes) of the transit matrix cache; 0 disables it.')
+parser.add_argument('--network_cache_dir', metavar='-n', type=str, default='data/network_cache/',
+                    help='Directory for the street network cache; may be shared between hosts.')
+parser.add_argument('--network_cache_memory', metavar='-g', type=int, default=1073741824,
+                    help='Max memory (in bytes) each worker may use to keep street networks loaded.')
+parser.add_argument('--network_cache_size', metavar='-k', type=int, default=10737418240,
+                    help='Max size (in bytes) of the on-disk street network cache; 0 disables it.')
+parser.add_argument('--job_timeout', metavar='-t', type=int, default=None,
+                    help='Max wall-clock time (in seconds) any job may run before its worker is replaced.')
+parser.add_argument('--worker_memory', metavar='-a', type=int, default=None,
+                    help='Memory budget (in bytes) of each worker for admission control '
+                         '(host memory divided by --num_workers if omitted).')
+parser.add_argument('--min_workers', metavar='-i', type=int, default=None,
+                    help='Fewest workers to keep when idle (defaults to --num_workers).')
+parser.add_argument('--max_workers', metavar='-x', type=int, default=None,
+                    help='Most workers to start when the queue backs up (defaults to --num_workers).')
+parser.add_argument('--results_format', metavar='-f', type=str, default=None,
+                    choices=['parquet', 'arrow'],
+                    help='Also write model results in a columnar format (requires pyarrow).')
+parser.add_argument('--resource_quota', metavar='-q', type=int, default=None,
+                    help='Max size (in bytes) of uploaded resources; least recently used are evicted first.')
+parser.add_argument('--job_quota', metavar='-u', type=int, default=None,
+                    help='Max size (in bytes) of job results; least recently used are evicted first.')
+parser.add_argument('--sweep_interval', metavar='-e', type=int, default=60,
+                    help='Seconds between sweeps for expired and over-quota resources and jobs.')
+parser.add_argument('--role', metavar='-o', type=str, default='all', choices=['api', 'worker', 'all'],
+                    help='Serve the API, run jobs, or both; api and worker need a shared --queue_backend.')
+parser.add_argument('--queue_backend', metavar='-v', type=str, default='sqlite', choices=['memory', 'sqlite'],
+                    help='Job queue: in queue.db, kept across restarts and shared by API and worker processes, '
+                         'or in this process.')
+parser.add_argument('--prefetch', metavar='-z', type=int, default=None,
+                    help='Queued jobs a worker claims beyond those it can start (all of them if omitted).')
+parser.add_argument('--tile_rows', metavar='-y', type=int, default=None,
+                    help='Split jobs with more source rows into tiles of this many rows run in parallel.')
+parser.add_argument('--drain_timeout', metavar='-D', type=int, default=0,
+                    help='Seconds shutdown waits for running jobs to finish before returning them to the queue.')
+parser.add_argument('--profile_rate', metavar='-P', type=float, default=0,
+                    help='Share of jobs, from 0 to 1, run under the CPU and memory profiler.')
 parser.add_argument('--deploy', action='store_true', help='Deploy to accept incoming connections.')
 args = parser.parse_args()
+if args.role != 'all' and args.queue_backend == 'memory':
+    parser.error('--role {} needs --queue_backend sqlite'.format(args.role))
+if __name__ == '__main__':
+    # before the Consumers start; under gunicorn, gunicorn.conf.py does it
+    Metrics.setup(clear=True)
 
 resource_manager = ResourceManager(num_processes=args.num_workers,
                                    resource_lifespan=args.resource_expiration,
-                                   job_lifespan=args.job_expiration)
+                                   job_lifespan=args.job_expiration,
+                                   manifest_backend=args.manifest_backend,
+                                   max_file_size=args.max_file_size,
+                                   archive_compression=args.archive_compression,
+                                   archive_compresslevel=args.archive_compresslevel,
+                                   matrix_cache_dir=args.matrix_cache_dir,
+                                   matrix_cache_size=args.matrix_cache_size,
+                                   network_cache_dir=args.network_cache_dir,
+                                   network_cache_memory=args.network_cache_memory,
+                                   network_cache_size=args.network_cache_size,
+                                   job_timeout=args.job_timeout,
+                                   worker_memory=args.worker_memory,
+                                   min_processes=args.min_workers,
+                                   max_processes=args.max_workers,
+                                   results_format=args.results_format,
+                                   resource_quota=args.resource_quota,
+                                   job_quota=args.job_quota,
+                                   sweep_interval=args.sweep_interval,
+                                   role=args.role,
+                                   queue_backend=args.queue_backend,
+                                   prefetch=args.prefetch,
+                                   tile_rows=args.tile_rows,
+                                   drain_timeout=args.drain_timeout,
+                                   profile_rate=args.profile_rate)
 
 
 def sigint_handler(sig, frame):
@@ -31,30 +119,118 @@ def sigint_handler(sig, frame):
     sys.exit(0)
 
 
-# register sigint handler
-signal.signal(signal.SIGINT, sigint_handler)
+if __name__ == '__main__':
+    # register sigint handler, and shut down the same way when a deploy stops the server;
+    # under gunicorn, the worker_exit hook in gunicorn.conf.py does it
+    signal.signal(signal.SIGINT, sigint_handler)
+    signal.signal(signal.SIGTERM, sigint_handler)
 
 resource_manager.start()
 
 application = Flask(__name__)
 application.config['MAX_CONTENT_LENGTH'] = args.max_file_size
 application.config['PROPAGATE_EXCEPTIONS'] = True
+application.config['USE_X_SENDFILE'] = args.use_x_sendfile
+
+# longest a long-poll request may block, and the keepalive interval of event streams
+MAX_WAIT_SECONDS = 60
+KEEPALIVE_SECONDS = 15
+
+
+def parse_wait(value):
+    """
+    Returns: the seconds a long-poll request asked to block, capped at
+        MAX_WAIT_SECONDS, or None unless value is a finite number >= 0.
+    """
+    try:
+        wait = float(value)
+    except ValueError:
+        return None
+    if not 0 <= wait < math.inf:
+        return None
+    return min(wait, MAX_WAIT_SECONDS)
 
 
 @application.route('/uploadResource', methods=['POST'])
 def upload_resource():
+    if 'file' in request.files:
+        file = request.files['file']
+        filename = file.filename
+        stream = file.stream
+    elif 'filename' in request.args:
+        # raw request body, streamed to disk without multipart parsing
+        filename = request.args['filename']
+        stream = request.stream
+    else:
+        return Response(status=400)
+    if not resource_manager.extension_is_allowed(filename=filename):
+        return Response(status=403)
+    try:
+        resource_id = resource_manager.store_resource(stream)
+    except UploadTooLargeException:
+        return Response(status=413)
+    return jsonify(resource_id=resource_id), 201
 
-    if 'file' not in request.files:
+
+@application.route('/startUpload', methods=['POST'])
+def start_upload():
+    filename = request.values.get('filename')
+    if filename is None:
         return Response(status=400)
-    resource_id = resource_manager.get_new_resource_id()
-    file = request.files['file']
-    if not resource_manager.extension_is_allowed(filename=file.filename):
+    if not resource_manager.extension_is_allowed(filename=filename):
         return Response(status=403)
-    file.save("resources/" + resource_id)
-    resource_manager.add_resource(resource_id)
+    upload_id = resource_manager.start_upload()
+    return jsonify(upload_id=upload_id, offset=0), 201
+
+
+@application.route('/uploadChunk/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    if not resource_manager.job_id_is_safe(upload_id):
+        return jsonify(upload_id=upload_id), 403
+    try:
+        offset = int(request.args['offset'])
+    except (KeyError, ValueError):
+        return jsonify(upload_id=upload_id), 400
+    try:
+        new_offset = resource_manager.append_upload_chunk(upload_id, offset, request.stream)
+    except ValueError as exception:
+        return jsonify(upload_id=upload_id, offset=exception.args[0]), 409
+    except UploadTooLargeException:
+        return jsonify(upload_id=upload_id, offset=offset), 413
+    if new_offset is None:
+        return jsonify(upload_id=upload_id), 404
+    return jsonify(upload_id=upload_id, offset=new_offset), 200
+
+
+@application.route('/checkUpload/<upload_id>', methods=['GET'])
+def check_upload(upload_id):
+    if not resource_manager.job_id_is_safe(upload_id):
+        return jsonify(upload_id=upload_id), 403
+    offset = resource_manager.get_upload_offset(upload_id)
+    if offset is None:
+        return jsonify(upload_id=upload_id), 404
+    return jsonify(upload_id=upload_id, offset=offset), 200
+
+
+@application.route('/finishUpload/<upload_id>', methods=['POST'])
+def finish_upload(upload_id):
+    if not resource_manager.job_id_is_safe(upload_id):
+        return jsonify(upload_id=upload_id), 403
+    resource_id = resource_manager.finish_upload(upload_id)
+    if resource_id is None:
+        return jsonify(upload_id=upload_id), 404
     return jsonify(resource_id=resource_id), 201
 
 
+@application.route('/abortUpload/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    if not resource_manager.job_id_is_safe(upload_id):
+        return jsonify(upload_id=upload_id), 403
+    if resource_manager.abort_upload(upload_id):
+        return Response(status=200)
+    return Response(status=404)
+
+
 @application.route('/checkResourceById/<resource_id>', methods=['GET'])
 def check_resource_by_id(resource_id):
     if resource_manager.resource_id_exists(resource_id=resource_id):
@@ -72,6 +248,16 @@ def check_resource_by_hash(resource_hash):
     return Response(404)
 
 
+@application.route('/getResourceSchema/<resource_id>', methods=['GET'])
+def get_resource_schema(resource_id):
+    if not resource_manager.job_id_is_safe(resource_id):
+        return jsonify(resource_id=resource_id), 403
+    schema = resource_manager.get_resource_schema(resource_id)
+    if schema is None or not resource_manager.resource_id_exists(resource_id):
+        return jsonify(resource_id=resource_id), 404
+    return jsonify(resource_id=resource_id, schema=schema), 200
+
+
 @application.route('/deleteResource/<resource_id>', methods=['DELETE'])
 def delete_resource(resource_id):
     if not resource_manager.job_id_is_safe(resource_id):
@@ -84,23 +270,154 @@ def delete_resource(resource_id):
 
 @application.route('/submitJob', methods=['POST'])
 def submit_job():
-    job = Job(request.values)
+    job = Job(request.values, client_id=request.remote_addr)
     if job.error_status is not None:
         return jsonify(error=job.error_status), 400
-    resource_manager.add_job_to_queue(job)
-    return jsonify(job_id=job.job_id), 200
+    admission = resource_manager.admit_job(job)
+    if admission == 'rejected':
+        return jsonify(error='job exceeds worker memory budget',
+                       estimate=job.get_estimate()), 400
+    try:
+        coalesced_with = resource_manager.add_job_to_queue(job)
+    except MissingResourceException as exception:
+        return jsonify(error='missing resource: {}'.format(exception)), 400
+    if coalesced_with is not None:
+        return jsonify(job_id=job.job_id, admission='coalesced', coalesced_with=coalesced_with,
+                       estimate=job.get_estimate()), 200
+    return jsonify(job_id=job.job_id, admission=admission, estimate=job.get_estimate()), 200
+
+
+@application.route('/submitJobs', methods=['POST'])
+def submit_jobs():
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        body = body.get('jobs')
+    if not isinstance(body, list) or not all(isinstance(job_request, dict) for job_request in body):
+        return jsonify(error='expected a list of jobs'), 400
+    jobs = []
+    errors = {}
+    for index, job_request in enumerate(body):
+        job_request = dict(job_request)
+        if 'orders' in job_request and not isinstance(job_request['orders'], str):
+            job_request['orders'] = json.dumps(job_request['orders'])
+        job = Job(MultiDict(job_request), client_id=request.remote_addr)
+        if job.error_status is None and resource_manager.admit_job(job) == 'rejected':
+            job.error_status = 'job exceeds worker memory budget'
+        if job.error_status is not None:
+            errors[index] = job.error_status
+        jobs.append(job)
+    # all or nothing: one bad job rejects the whole batch
+    if errors:
+        return jsonify(errors=errors), 400
+    try:
+        coalesced_with = resource_manager.add_jobs_to_queue(jobs)
+    except MissingResourceException as exception:
+        return jsonify(error='missing resource: {}'.format(exception)), 400
+    return jsonify(job_ids=[job.job_id for job in jobs],
+                   coalesced_with=coalesced_with,
+                   estimates=[job.get_estimate() for job in jobs]), 200
+
+
+@application.route('/jobStatuses', methods=['GET', 'POST'])
+def job_statuses():
+    body = request.get_json(silent=True)
+    if isinstance(body, dict) and isinstance(body.get('job_ids'), list):
+        job_ids = body['job_ids']
+    elif 'job_ids' in request.values:
+        job_ids = request.values['job_ids'].split(',')
+    else:
+        return jsonify(error='job_ids not specified'), 400
+    statuses = resource_manager.get_job_statuses(job_ids)
+    jobs = {}
+    for job_id in job_ids:
+        job_status, exception_message = statuses.get(job_id, ('not_found', None))
+        jobs[job_id] = {'job_status': job_status}
+        if exception_message is not None:
+            jobs[job_id]['exception_message'] = exception_message
+    return jsonify(jobs=jobs), 200
+
+
+@application.route('/jobEvents', methods=['GET'])
+def job_events():
+    if 'job_ids' not in request.args:
+        return jsonify(error='job_ids not specified'), 400
+    job_ids = request.args['job_ids'].split(',')
+    # subscribe before reading the current statuses so no transition is missed
+    subscription = resource_manager.subscribe_to_jobs(job_ids)
+    statuses = resource_manager.get_job_statuses(job_ids)
+
+    def format_event(job_id, job_status):
+        return 'event: status\ndata: {}\n\n'.format(json.dumps({'job_id': job_id, 'job_status': job_status}))
+
+    def generate():
+        try:
+            pending = set(job_ids)
+            for job_id in job_ids:
+                job_status = statuses.get(job_id, ('not_found', None))[0]
+                yield format_event(job_id, job_status)
+                if job_status in TERMINAL_STATUSES or job_status == 'not_found':
+                    pending.discard(job_id)
+            while pending:
+                try:
+                    job_id, job_status = subscription.events.get(timeout=KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield format_event(job_id, job_status)
+                if job_status in TERMINAL_STATUSES:
+                    pending.discard(job_id)
+        finally:
+            resource_manager.unsubscribe_from_jobs(subscription)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@application.route('/cancelJob/<job_id>', methods=['POST'])
+def cancel_job(job_id):
+    if not resource_manager.job_id_is_safe(job_id):
+        return jsonify(job_id=job_id), 403
+    cancelled = resource_manager.cancel_job(job_id)
+    if cancelled is None:
+        return jsonify(job_id=job_id), 404
+    if not cancelled:
+        return jsonify(job_id=job_id, job_status=resource_manager.get_job_status(job_id)), 409
+    return jsonify(job_id=job_id), 200
 
 
 @application.route('/checkJobStatus/<job_id>', methods=['GET'])
 def check_job_status(job_id):
     if not resource_manager.manifest.job_exists(job_id):
         return jsonify(job_id=job_id), 404
+    if 'wait' in request.args:
+        # long-poll: hold the request until the status changes
+        wait = parse_wait(request.args['wait'])
+        if wait is None:
+            return jsonify(job_id=job_id, error='wait must be a number of seconds'), 400
+        resource_manager.wait_for_job_status(job_id, request.args.get('status'), wait)
     job_status = resource_manager.get_job_status(job_id)
-    if job_status == 'exception' or job_status == 'failed':
+    if job_status in ('exception', 'failed', 'timed_out'):
         exception_message  = resource_manager.manifest.get_job_exception_message(job_id)
         return jsonify(job_id=job_id,
                        job_status=job_status,
-                       exception_message=exception_message), 500
+                       exception_message=exception_message,
+                       progress=resource_manager.get_job_progress(job_id)), 500
+    if job_status == 'enqueued':
+        queue_position = resource_manager.get_queue_position(job_id)
+        if queue_position is not None:
+            jobs_ahead, estimated_start_time = queue_position
+            return jsonify(job_id=job_id,
+                           job_status=job_status,
+                           queue_position=jobs_ahead,
+                           estimated_start_time=estimated_start_time), 200
+    progress = resource_manager.get_job_progress(job_id)
+    if job_status == 'running':
+        return jsonify(job_id=job_id,
+                       job_status=job_status,
+                       progress=progress,
+                       estimated_finish_time=resource_manager.get_estimated_finish_time(job_id)), 200
+    if progress is not None:
+        return jsonify(job_id=job_id, job_status=job_status, progress=progress), 200
     return jsonify(job_id=job_id, job_status=job_status), 200
 
 
@@ -124,21 +441,150 @@ def get_results_for_job(job_id):
         return jsonify(job_id=job_id, exception_message=exception_message), 500
     zip_filename = resource_manager.get_zip_filename(job_id)
     if zip_filename is not None:
-        return send_file(zip_filename)
+        # conditional responses honour Range, If-Range and If-None-Match against the
+        # archive's ETag; full downloads go through the WSGI file wrapper (sendfile).
+        # Flask resolves relative paths against the app's folder, not the working directory
+        return send_file(os.path.abspath(zip_filename), conditional=True)
     return jsonify(job_id=job_id), 404
 
 
+@application.route('/getResultsPageForJob/<job_id>', methods=['GET'])
+def get_results_page_for_job(job_id):
+    model = request.args.get('model')
+    if not resource_manager.job_id_is_safe(job_id) or (model is not None and not resource_manager.job_id_is_safe(model)):
+        return jsonify(job_id=job_id), 403
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', 1000))
+    except ValueError:
+        return jsonify(error='offset and limit must be integers'), 400
+    if offset < 0 or limit < 0:
+        return jsonify(error='offset and limit must not be negative'), 400
+    sources = request.args['source'].split(',') if 'source' in request.args else None
+    columns = request.args['columns'].split(',') if 'columns' in request.args else None
+    filters = []
+    for where in request.args.getlist('where'):
+        try:
+            column, operator, value = where.rsplit(',', 2)
+        except ValueError:
+            return jsonify(error='where must be <column>,<operator>,<value>'), 400
+        filters.append((column, operator, value))
+    store = resource_manager.get_results_store(job_id, model)
+    if store is None:
+        return jsonify(job_id=job_id), 404
+    try:
+        total, page = store.query(sources=sources, columns=columns, filters=filters,
+                                  offset=offset, limit=limit)
+    except KeyError as exception:
+        return jsonify(job_id=job_id, error='unknown column or operator: {}'.format(exception.args[0])), 400
+    except ValueError as exception:
+        return jsonify(job_id=job_id, error=str(exception)), 400
+    return jsonify(job_id=job_id, total=total, offset=offset, limit=limit,
+                   results=store.to_records(page)), 200
+
+
+@application.route('/getColumnarResultsForJob/<job_id>', methods=['GET'])
+def get_columnar_results_for_job(job_id):
+    model = request.args.get('model')
+    if not resource_manager.job_id_is_safe(job_id) or (model is not None and not resource_manager.job_id_is_safe(model)):
+        return jsonify(job_id=job_id), 403
+    filename = resource_manager.get_columnar_results_filename(job_id, model)
+    if filename is None:
+        return jsonify(job_id=job_id), 404
+    return send_file(os.path.abspath(filename), conditional=True)
+
+
 @application.route('/getAggregatedResultsForJob/<job_id>', methods=['GET'])
 def get_aggregated_results_for_job(job_id):
-    if not resource_manager.job_id_is_safe(job_id):
+    model = request.args.get('model')
+    if not resource_manager.job_id_is_safe(job_id) or (model is not None and not resource_manager.job_id_is_safe(model)):
         return jsonify(job_id=job_id), 403
-    results = resource_manager.get_aggregated_data(job_id)
+    results = resource_manager.get_aggregated_data(job_id, model)
     if results is not None:
         return jsonify(results=results), 200
     return jsonify(job_id=job_id), 404
 
 
+@application.route('/getProfileForJob/<job_id>', methods=['GET'])
+def get_profile_for_job(job_id):
+    if not resource_manager.job_id_is_safe(job_id):
+        return jsonify(job_id=job_id), 403
+    zip_filename = resource_manager.get_profile_filename(job_id)
+    if zip_filename is None:
+        return jsonify(job_id=job_id), 404
+    return send_file(os.path.abspath(zip_filename), conditional=True)
+
+
+@application.route('/matrix/<job_id>/od', methods=['GET'])
+def get_travel_time(job_id):
+    if not resource_manager.job_id_is_safe(job_id):
+        return jsonify(job_id=job_id), 403
+    if 'origin' not in request.args or 'dest' not in request.args:
+        return jsonify(error='origin and dest required'), 400
+    try:
+        store = resource_manager.get_matrix_store(job_id)
+    except MatrixStoreNotReadyException:
+        return jsonify(job_id=job_id, job_status='indexing_matrix'), 202
+    if store is None:
+        return jsonify(job_id=job_id), 404
+    origin, dest = request.args['origin'], request.args['dest']
+    try:
+        travel_time = store.get_travel_time(origin, dest)
+    except KeyError as exception:
+        return jsonify(job_id=job_id, error='unknown id: {}'.format(exception.args[0])), 404
+    return jsonify(origin=origin, dest=dest, travel_time=travel_time), 200
+
+
+@application.route('/matrix/<job_id>/row', methods=['GET'])
+def get_travel_time_row(job_id):
+    if not resource_manager.job_id_is_safe(job_id):
+        return jsonify(job_id=job_id), 403
+    if 'origin' not in request.args:
+        return jsonify(error='origin required'), 400
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError:
+        return jsonify(error='offset and limit must be integers'), 400
+    if offset < 0 or (limit is not None and limit < 0):
+        return jsonify(error='offset and limit must not be negative'), 400
+    dests = request.args['dest'].split(',') if 'dest' in request.args else None
+    try:
+        store = resource_manager.get_matrix_store(job_id)
+    except MatrixStoreNotReadyException:
+        return jsonify(job_id=job_id, job_status='indexing_matrix'), 202
+    if store is None:
+        return jsonify(job_id=job_id), 404
+    origin = request.args['origin']
+    try:
+        travel_times = store.get_row(origin, dest_ids=dests, offset=offset, limit=limit)
+    except KeyError as exception:
+        return jsonify(job_id=job_id, error='unknown id: {}'.format(exception.args[0])), 404
+    return jsonify(origin=origin, travel_times=travel_times), 200
+
+
+@application.route('/getCacheStats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(resource_manager.get_cache_stats()), 200
+
+
+@application.route('/metrics', methods=['GET'])
+def metrics():
+    resource_manager.update_metrics()
+    data, content_type = Metrics.generate_metrics()
+    return Response(data, content_type=content_type)
+
+
+@application.route('/getPoolStatus', methods=['GET'])
+def get_pool_status():
+    return jsonify(resource_manager.get_pool_stats()), 200
+
+
 if __name__ == "__main__":
+    if args.role == 'worker':
+        # no API: run jobs until interrupted
+        while True:
+            signal.pause()
     if args.deploy:
         hostname='0.0.0.0'
     else: